@@ -5,20 +5,30 @@ import pandas as pd
 import re
 import sys
 import numpy as np
-from itertools import chain
-
-try:
-    # load db_config from file
-    config_df = pd.read_csv('config\\db_config.csv', index_col=0)
-    db_config = config_df.loc['config'].dropna().to_dict()
-    db_address = config_df.loc['address'].dropna().to_dict()
-except FileNotFoundError:
-    print('db_config.csv is not found in config!')
-    sys.exit(1)
+import csv
+import os
+import pickle
+import json
+import copy
+import hashlib
+import ast
+import operator
+import threading
+import time
+import gzip
+import multiprocessing
+from functools import lru_cache, partial
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain, repeat
 
 
 # A standard python dictionary class
 class Dict:
+    # subclasses keep their own instance layout, e.g. __slots__ of CDMGroup
+    __slots__ = ()
+
     def __init__(self):
         self._dict = {}
 
@@ -57,11 +67,335 @@ class Dict:
         return self._dict
 
 
+class LazyDict(Dict):
+    """A Dict which is filled by the loader on first access"""
+    def __init__(self, loader):
+        self._loader = loader
+        self._loaded = None
+
+    @property
+    def _dict(self):
+        if self._loaded is None:
+            self._loaded = self._loader()
+        return self._loaded
+
+
+@lru_cache(maxsize=None)
+def read_config(filename):
+    """
+    read a CSV in config once per process
+    :param filename: CSV file name in config
+    :return: header and a tuple of rows(dictionary of col: value), empty cells are dropped from each row
+    """
+    try:
+        with open(f'config\\{filename}', newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            return header, tuple(
+                {col: value for col, value in zip(header, row) if value}
+                for row in reader
+            )
+    except FileNotFoundError:
+        print(f'{filename} is not found in config!')
+        sys.exit(1)
+
+
+def config_dict(filename, index_col=0, value_col=None):
+    """
+    key the rows of a config CSV by index_col, a later row replaces an earlier one like DataFrame.to_dict
+    :param filename: CSV file name in config
+    :param index_col: column name or position used as the key
+    :param value_col: keep only the value of this column instead of the whole row
+    :return: dictionary
+    """
+    header, rows = read_config(filename)
+    if not isinstance(index_col, str):
+        index_col = header[index_col]
+    return {
+        row[index_col]: row[value_col] if value_col else {col: value for col, value in row.items() if col != index_col}
+        for row in rows
+        if index_col in row and (not value_col or value_col in row)
+    }
+
+
+def config_groups(filename, index_col, value_col):
+    """group the value_col of a config CSV into lists by index_col like DataFrame.groupby"""
+    groups = {}
+    for row in read_config(filename)[1]:
+        if index_col in row:
+            groups.setdefault(row[index_col], []).append(row.get(value_col, ''))
+    return groups
+
+
+# db_config and db_address are only read when a connection or an address is first needed
+db_config = LazyDict(lambda: config_dict('db_config.csv')['config'])
+db_address = LazyDict(lambda: config_dict('db_config.csv')['address'])
+
+
+# the read-only object of map_chunks, set once in each process of the pool
+chunk_context = {}
+
+
+def set_chunk_context(owner):
+    chunk_context['owner'] = owner
+
+
+def run_chunk(func, chunk):
+    return func(chunk_context['owner'], chunk)
+
+
+def map_chunks(func, owner, chunks, workers):
+    """
+    run func(owner, chunk) for every chunk, in a process pool if there are more than one chunk and worker,
+    a process of another pool, e.g. of --plan or --validate, runs its chunks itself so that pools are never nested
+    :param func: function which only reads owner, e.g. Fas.parse_fas_rows
+    :param owner: object of lookups, e.g. a Fas or Table without its DataFrames, sent once to each process
+    :param chunks: list of chunks
+    :param workers: number of processes
+    :return: list of results in the order of chunks
+    """
+    workers = min(workers, len(chunks))
+    if workers <= 1 or multiprocessing.parent_process() is not None:
+        return [func(owner, chunk) for chunk in chunks]
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_chunk_context, initargs=(owner,)) as executor:
+        return list(executor.map(run_chunk, repeat(func), chunks))
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    yield a temp path next to path and rename it to path at the end, so that a reader never sees a partial file
+    :param path: path of the file to write, its folder is created if it is missing
+    :return: temp path with the same extension, removed if the writing fails
+    """
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    root, ext = os.path.splitext(path)
+    temp_path = f'{root}.{os.getpid()}.{threading.get_ident()}.tmp{ext}'
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# for expanding YYYY period in Table
+PERIOD_PATTERN = re.compile(r'\[(.*?)\]')
+PERIOD_OPERATORS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.USub: operator.neg, ast.UAdd: operator.pos
+}
+
+
+class FileCache:
+    """
+    Pickle results derived from a source file into cache folder,
+    a cached result is only used while the path, size and mtime of the source file are unchanged
+    """
+    folder = 'cache'
+
+    def __init__(self, name):
+        self.name = name
+        # a disabled cache never serves or keeps a result, e.g. so that a query capture has every query
+        self.enabled = True
+
+    @staticmethod
+    def file_key(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    def get_path(self, path):
+        digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(type(self).folder, self.name, f'{digest}.pickle')
+
+    def load(self, path):
+        """return the cached result of path or None if it is missing, outdated or the cache is disabled"""
+        if not self.enabled:
+            return None
+        try:
+            with open(self.get_path(path), 'rb') as f:
+                key, result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        return result if key == self.file_key(path) else None
+
+    def save(self, path, result):
+        """save result of path, parallel workers never read a partial cache"""
+        if not self.enabled:
+            return
+        with atomic_write(self.get_path(path)) as temp_path, open(temp_path, 'wb') as f:
+            pickle.dump((self.file_key(path), result), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class ReferenceCache(FileCache):
+    """Pickle reference data from DB by name instead of a source file, so that it can be used without DB"""
+    @staticmethod
+    def file_key(name):
+        return name
+
+    def get_path(self, name):
+        return os.path.join(type(self).folder, self.name, f'{name}.pickle')
+
+
+class QueryCapture:
+    """
+    Record every query with its result set into a capture file, or replay a capture file without DB,
+    a query is matched by its SQL and the results of the same SQL are served in the recorded order,
+    so that a replay does not depend on which thread runs first
+    """
+    def __init__(self, path, replay=False, latency=0.0):
+        """
+        :param path: capture file path
+        :param replay: replay path instead of recording into it
+        :param latency: seconds added to every round trip of a replay
+        """
+        self.path = path
+        self.replay = replay
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.db_time = 0.0
+        if replay:
+            with gzip.open(path, 'rb') as f:
+                entries = pickle.load(f)
+            self.entries = {}
+            for key, result in entries:
+                self.entries.setdefault(key, deque()).append(result)
+        else:
+            self.entries = []
+
+    def connect(self):
+        return CaptureConnection(self, None if self.replay else pymssql.connect(**db_config.dict))
+
+    def count(self, start):
+        with self.lock:
+            self.round_trips += 1
+            self.db_time += time.perf_counter() - start
+
+    def execute(self, conn, sql, as_dict):
+        """
+        run sql on conn and record it, or take its result from the capture when replaying
+        :return: the rows, an error of the query is raised again when replaying
+        """
+        start = time.perf_counter()
+        if self.replay:
+            with self.lock:
+                results = self.entries.get((sql, as_dict))
+                result = results.popleft() if results else None
+            if result is None:
+                print(f'The query is not in capture {self.path} : {sql}')
+                sys.exit(1)
+            time.sleep(self.latency)
+        else:
+            cursor = conn.cursor(as_dict=as_dict)
+            try:
+                cursor.execute(sql)
+                result = ('rows', cursor.fetchall() if cursor.description else [])
+            except pymssql.Error as e:
+                result = ('error', type(e).__name__, e.args)
+            with self.lock:
+                self.entries.append(((sql, as_dict), result))
+        self.count(start)
+        if result[0] == 'error':
+            raise getattr(pymssql, result[1])(*result[2])
+        return result[1]
+
+    def commit(self, conn, rollback=False):
+        start = time.perf_counter()
+        if self.replay:
+            time.sleep(self.latency)
+        elif rollback:
+            conn.rollback()
+        else:
+            conn.commit()
+        self.count(start)
+
+    def save(self):
+        """save the recorded queries"""
+        if self.replay:
+            return
+        with self.lock:
+            entries = list(self.entries)
+        with atomic_write(self.path) as temp_path, gzip.open(temp_path, 'wb') as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def summary(self):
+        return f'{self.round_trips} round trip(s), {self.db_time:.3f}s in DB'
+
+
+class CaptureConnection:
+    """the part of a pymssql connection used by Connection, with the queries going through QueryCapture"""
+    def __init__(self, capture, conn):
+        self.capture = capture
+        self.conn = conn
+
+    def cursor(self, as_dict=False):
+        return CaptureCursor(self, as_dict)
+
+    def commit(self):
+        self.capture.commit(self.conn)
+
+    def rollback(self):
+        self.capture.commit(self.conn, rollback=True)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+class CaptureCursor:
+    def __init__(self, connection, as_dict):
+        self.connection = connection
+        self.as_dict = as_dict
+        self.rows = []
+
+    def execute(self, sql):
+        self.rows = self.connection.capture.execute(self.connection.conn, sql, self.as_dict)
+
+    def fetchall(self):
+        return self.rows
+
+
 class Connection:
     # class variable
+    # one pooled connection per thread is shared by all objects, so it stays open(warm) from table to table
+    # and objects loaded concurrently in different threads never share a connection
+    _local = threading.local()
+    # all pooled connections, closed by close_all at exit
+    connections = []
+    connections_lock = threading.Lock()
+    # QueryCapture for recording or replaying all queries, e.g. for performance tests without the server
+    capture = None
 
     def __init__(self):
-        self._conn = pymssql.connect(**db_config)
+        pass
+
+    @property
+    def _conn(self):
+        """connect on first use so that objects which never query never pay for a connection"""
+        if getattr(Connection._local, 'conn', None) is None:
+            if Connection.capture:
+                Connection._local.conn = Connection.capture.connect()
+            else:
+                Connection._local.conn = pymssql.connect(**db_config.dict)
+            with Connection.connections_lock:
+                Connection.connections.append(Connection._local.conn)
+        return Connection._local.conn
+
+    @staticmethod
+    def close_all():
+        """close the pooled connections of all threads, e.g. at exit, uncommitted work is rolled back by the server"""
+        with Connection.connections_lock:
+            connections, Connection.connections = Connection.connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except pymssql.Error:
+                pass
+        Connection._local = threading.local()
 
     @staticmethod
     def _sql_string(value):
@@ -72,6 +406,11 @@ class Connection:
         else:
             return repr(value)
 
+    @staticmethod
+    def _sql_nstring(value):
+        """N'' literal of a string, e.g. a Chinese description in VALUES"""
+        return "N'{}'".format(str(value).replace("'", "''"))
+
     def select_sql(self, selector='', addr='', where=None, addition='', replace_sql='', get_df=False, df_index=None):
         """
         select function
@@ -99,66 +438,138 @@ class Connection:
         rs = cursor.fetchall()
         return pd.DataFrame(rs, index=df_index) if get_df else rs[0][0] if len(rs) > 0 else 0
 
-    def insert_sql(self, addr, insert):
+    def transaction_sql(self, sql, select_sql, get_df=False):
         """
-        Insert insert_dictionary (key=field, value=value)
-        :param addr: the table address
-        :param insert: dictionary (key=field, value=value)
+        run sql in one transaction which is rolled back as a whole if any statement fails,
+        the session options are reset at the end even if it fails, as the connection is kept for the next queries
+        :param sql: statements of the transaction
+        :param select_sql: the query of the result, it is run last so that no statement is left after the result
+        :param get_df: bool to return a df or a value
+        :return: the result of select_sql like select_sql
         """
-        insert_list = [
-            [col, self._sql_string(value)] for col, value in insert.items()
-        ]
-        # join the transposed list
-        cols, values = map(', '.join, list(zip(*insert_list)))
-        values = values.replace('\\n', "' + CHAR(10) + '")
-        sql = f'INSERT INTO {addr} ({cols}) VALUES ({values})'
-        sql = sql.replace("\\", "")
-        cursor = self._conn.cursor()
         try:
-            cursor.execute(sql)
+            result = self.select_sql(
+                replace_sql=(
+                    'SET NOCOUNT ON; SET XACT_ABORT ON; '
+                    f'BEGIN TRY BEGIN TRANSACTION; {sql} COMMIT TRANSACTION; END TRY '
+                    'BEGIN CATCH IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION; '
+                    'SET XACT_ABORT OFF; SET NOCOUNT OFF; THROW; END CATCH; '
+                    f'SET XACT_ABORT OFF; SET NOCOUNT OFF; {select_sql}'
+                ),
+                get_df=get_df
+            )
             self._conn.commit()
-            # Uncomment to show what is inserted
-            # print('{} is added in {} at {}.'.format(values, cols, addr))
-        except pymssql.IntegrityError:
-            print(f'An entry has already existed in {addr}.')
-            print('Please check if all the fas names are correctly filled, e.g. CC Group has a different fas_name')
-            print('Or the same theme has duplicate sv and cc.')
-            # sys.exit(1)
+            return result
+        except pymssql.Error:
+            # an error like a missing table aborts the batch before CATCH can reset the options
+            self._conn.rollback()
+            self._conn.cursor().execute('SET XACT_ABORT OFF; SET NOCOUNT OFF')
+            raise
+
+    @staticmethod
+    def _identity_insert_sql(addr, sql):
+        """allow explicit ids in sql, OFF always runs as only one table of a session can have IDENTITY_INSERT ON"""
+        return (
+            f'SET IDENTITY_INSERT {addr} ON; BEGIN TRY {sql}; END TRY '
+            f'BEGIN CATCH SET IDENTITY_INSERT {addr} OFF; THROW; END CATCH; SET IDENTITY_INSERT {addr} OFF'
+        )
 
-    def update_sql(self, addr, col, col_value, condition_col, condition_col_value):
+    def update_cols_sql(self, addr, update, condition_col, condition_col_value):
         """
-        Update sql query
+        Update several fields of the matched rows in one query
         :param addr: the table address
-        :param col: field
-        :param col_value: field value
+        :param update: dictionary (key=field, value=value)
         :param condition_col: check field
         :param condition_col_value: check field value
         :return:
         """
         sql = (
-            f'UPDATE {addr} SET {col} = {self._sql_string(col_value)} '
+            f"UPDATE {addr} SET {', '.join(f'{col} = {self._sql_string(value)}' for col, value in update.items())} "
             f'WHERE {condition_col} = {self._sql_string(condition_col_value)}'
         )
         cursor = self._conn.cursor()
         try:
             cursor.execute(sql)
             self._conn.commit()
-            print(f'{col_value} is updated in {col} at {addr}.')
+            print(f"{', '.join(map(str, update.values()))} is updated in {', '.join(update)} at {addr}.")
         except pymssql.IntegrityError:
             print(f'Error in updating {addr}.')
             return 1
 
-    def get_latest_id(self, addr, col):
-        """get latest id in a table"""
-        cursor = self._conn.cursor()
-        sql = f'SELECT MAX({col}) FROM {addr}'
-        cursor.execute(sql)
-        rs = cursor.fetchall()
-        if len(rs) > 0:
-            result = rs[0][0]
-            return result
-        else:
-            return 0
+
+class IdAllocator(Connection):
+    """
+    Reserve contiguous blocks of ids per table from a locked allocation row in ID_BLOCK,
+    ids of a block are assigned locally so that concurrent loaders never get the same id without a round trip per row
+    """
+    block_size = 100
+
+    def __init__(self):
+        Connection.__init__(self)
+        # addr: [next id, end of the reserved block(exclusive)]
+        self.blocks = {}
+        self.identity = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, addr, col, count=0):
+        """
+        reserve a block of at least count ids for col of addr, the unused ids of the current block are kept,
+        only the row of addr in ID_BLOCK is locked, ID_BLOCK is created by migrations\\ID_BLOCK.sql
+        """
+        count = max(count, type(self).block_size)
+        id_block = f"{db_address['insert']}.[ID_BLOCK]"
+        table_name = self._sql_string(addr)
+        try:
+            end = int(self.transaction_sql(
+                f'IF NOT EXISTS (SELECT 1 FROM {id_block} WITH (UPDLOCK, HOLDLOCK) WHERE [table_name] = {table_name}) '
+                f'INSERT INTO {id_block} ([table_name], [next_id]) VALUES ({table_name}, 1); '
+                # ids inserted without the allocator are skipped, the table itself is not locked
+                f'DECLARE @max_id BIGINT = (SELECT ISNULL(MAX({col}), 0) + 1 FROM {addr}); '
+                'DECLARE @end BIGINT; '
+                f'UPDATE {id_block} '
+                f'SET @end = [next_id] = (CASE WHEN [next_id] < @max_id THEN @max_id ELSE [next_id] END) + {count} '
+                f'WHERE [table_name] = {table_name};',
+                'SELECT @end'
+            ))
+        except pymssql.ProgrammingError as e:
+            print(f'Ids of {addr} cannot be reserved, please check if {id_block} is created by '
+                  f'migrations\\ID_BLOCK.sql : {e}')
+            sys.exit(1)
+        with self.lock:
+            block = self.blocks.get(addr)
+            # a new block follows the current one only if no other loader reserved in between
+            if block and block[1] == end - count:
+                block[1] = end
+            else:
+                self.blocks[addr] = [end - count, end]
+
+    def take_ids(self, addr, col, count):
+        """
+        take count contiguous ids of the reserved block, a new block is reserved if the rest is not enough
+        :return: the first id taken
+        """
+        while True:
+            with self.lock:
+                block = self.blocks.get(addr)
+                if block and block[1] - block[0] >= count:
+                    block[0] += count
+                    return block[0] - count
+            self.reserve(addr, col, count)
+
+    def return_ids(self, addr, start, count, used):
+        """give back the ids of take_ids after the first used ones, unless other ids were taken after them"""
+        with self.lock:
+            block = self.blocks.get(addr)
+            if block and block[0] == start + count:
+                block[0] = start + used
+
+    def is_identity(self, addr, col):
+        """whether col of addr is an identity column, then an explicit id needs IDENTITY_INSERT"""
+        if addr not in self.identity:
+            self.identity[addr] = bool(self.select_sql(
+                replace_sql=f"SELECT COLUMNPROPERTY(OBJECT_ID('{addr}'), '{col.strip('[]')}', 'IsIdentity')"
+            ))
+        return self.identity[addr]
 
 
 class CommonDataModel(Dict):
@@ -174,39 +585,16 @@ class CommonDataModel(Dict):
             str_list.append(f'--In {cdm_code}, there is/are {", ".join(cdm.keys())}.')
         return '\n'.join(str_list)
 
-    def all_ids(self, include_child=False):
-        """iterate over all id"""
-        for cdm in self.values():
-            if not include_child:
-                yield cdm.id
-            else:
-                for cdm_child in cdm.values():
-                    yield cdm.id, cdm_child.id
-
-    def all_ccg(self):
-        """iterate over all ccg_id"""
-        for cdm in self.values():
-            for cdm_child in cdm.values():
-                yield cdm_child.ccg_id
-
-    def update_cdm(self, cdm_code, **kwargs):
-        """Update after inserting into DB and getting the id back"""
-        for attr_field, attr_value in kwargs.items():
-            self[cdm_code].set_attr(attr_field, attr_value)
-
-    def update_cdm_child(self, cdm_code, cdm_child_code, **kwargs):
-        """Update after inserting into DB and getting the id back"""
-        for attr_field, attr_value in kwargs.items():
-            self[cdm_code][cdm_child_code].set_attr(attr_field, attr_value)
-
     def get_id_by_desc(self, desc, *args, **kwargs):
         """for use in parsing fas data"""
         results_list = []
-        for cdm in self.values():
+        for cdm_code, cdm in self:
             for cdm_child_code, cdm_child in cdm:
                 if cdm_child.desc.lower() == desc.lower() or cdm_child.alt_desc.lower() == desc.lower():
                     if all(cdm_child.get_attr(key) == value for key, value in kwargs.items()):
-                        result_dict = {'code': cdm_child_code, 'id': cdm.id, 'child_id': cdm_child.id}
+                        result_dict = {
+                            'cdm_code': cdm_code, 'code': cdm_child_code, 'id': cdm.id, 'child_id': cdm_child.id
+                        }
                         for attr in args:
                             result_dict[attr] = cdm_child.get_attr(attr)
                         results_list.append(result_dict)
@@ -219,21 +607,35 @@ class CommonDataModel(Dict):
 
 class CDM:
     """CDM basic unit, e.g. CC/SV"""
+    # the known attributes are slots, __dict__ is only created for an instance given any other attribute
+    __slots__ = (
+        'id', 'ccg_id', 'seq', 'ccg', 'desc', 'desc_tc', 'alt_desc', 'alt_desc_tc', 'fas', 'footnote', 'parent_cc_code',
+        'mdt', '__dict__'
+    )
+
     def __init__(self, desc, desc_tc, alt_desc, alt_desc_tc, **kwargs):
         self.id = 0
         self.desc = desc
         self.desc_tc = desc_tc
         self.alt_desc = alt_desc
         self.alt_desc_tc = alt_desc_tc
-        self.__dict__.update(kwargs)
+        for key, value in kwargs.items():
+            self.set_attr(key, value)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def attr_name(key):
+        return key.replace(' ', '').lower()
 
     def get_attr(self, key, default=0):
         """for getting attribute"""
         return getattr(self, key, default)
 
     def set_attr(self, key, value):
-        """for setting attribute"""
-        key = key.replace(' ', '').lower()
+        """for setting attribute, the ids from DB are stored as int"""
+        key = CDM.attr_name(key)
+        if key in ('id', 'ccg_id') and value is not None:
+            value = int(value)
         setattr(self, key, value)
 
     def get_tb_desc(self, tc=False):
@@ -246,10 +648,11 @@ class CDM:
 
 class CDMGroup(Dict, CDM):
     """CDM basic unit when with child, e.g. CV, SP"""
+    __slots__ = ('_dict', 'type', 'unit', 'unit_desc', 'unit_desc_tc', 'dec', 'multi', 'sep')
+
     def __init__(self, desc, desc_tc, alt_desc, alt_desc_tc, **kwargs):
         Dict.__init__(self)
-        CDM.__init__(self, desc, desc_tc, alt_desc, alt_desc_tc)
-        self.__dict__.update(kwargs)
+        CDM.__init__(self, desc, desc_tc, alt_desc, alt_desc_tc, **kwargs)
 
 
 class Table(Dict):
@@ -263,6 +666,7 @@ class Table(Dict):
         'dollar': '#,##0_ ',
         'dollar_dot': '#,##0.0_ '
     }
+    input_cache = FileCache('input')
 
     def __init__(self):
         Dict.__init__(self)
@@ -278,11 +682,17 @@ class Table(Dict):
         self.id = 0
         self.cv_cc = CommonDataModel('CV')
         self.sp_sv = CommonDataModel('SP')
-        self.mdt = []
+        # MDT rows by codes from init_mdt_keys
+        self.mdt_keys = []
 
     def load_csv(self, path):
         """load csv and parse the split the first two and the rest into two DataFrames"""
         print('This file will be loaded : ' + path)
+        # skip parsing if the file is unchanged since it was last parsed
+        cached = type(self).input_cache.load(path)
+        if cached:
+            self.config_df, self.cdm_df = cached
+            return
         if path.lower().endswith('csv'):
             df = pd.read_csv(path, header=None, dtype=str)
         else:
@@ -293,37 +703,71 @@ class Table(Dict):
         self.cdm_df = df.rename(columns=df.iloc[2]).iloc[3:, :].dropna(axis=1, how='all').reset_index(drop=True)
         # fillna as undefined, usually SV that cannot be found in FAS Table
         self.cdm_df['FAS field name'] = self.cdm_df['FAS field name'].fillna('undefined')
+        type(self).input_cache.save(path, (self.config_df, self.cdm_df))
+
+    @staticmethod
+    def get_code(config_df):
+        return config_df.iloc[0, 1].zfill(3)
+
+    @classmethod
+    def read_code(cls, path):
+        """get the table code of a file, only its config block is read if the file is not cached"""
+        cached = cls.input_cache.load(path)
+        if cached:
+            config_df = cached[0]
+        elif path.lower().endswith('csv'):
+            config_df = pd.read_csv(path, header=None, dtype=str, nrows=2)
+        else:
+            config_df = pd.read_excel(path, header=None, dtype=str, nrows=2)
+        return cls.get_code(config_df.dropna(axis=1, how='all'))
 
     def parse_config_df(self):
         """parse the config_df"""
-        self.code = self.config_df.iloc[0, 1].zfill(3)
+        self.code = type(self).get_code(self.config_df)
         self.title = f'Table {self.code} : {self.config_df.iloc[0, 2]}'
         self.title_tc = f'表{self.code}：{self.config_df.iloc[0, 3]}'
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def eval_period(expr):
+        """safely evaluate the arithmetic inside a bracket of period, e.g. 2019-1"""
+        def _eval(node):
+            if isinstance(node, ast.Expression):
+                return _eval(node.body)
+            if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+                return node.value
+            if isinstance(node, ast.UnaryOp) and type(node.op) in PERIOD_OPERATORS:
+                return PERIOD_OPERATORS[type(node.op)](_eval(node.operand))
+            if isinstance(node, ast.BinOp) and type(node.op) in PERIOD_OPERATORS:
+                return PERIOD_OPERATORS[type(node.op)](_eval(node.left), _eval(node.right))
+            raise ValueError(f'{expr} is not a valid period expression!')
+        return _eval(ast.parse(expr.strip(), mode='eval'))
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def period_yyyy(period, year):
+        """replace YYYY with year and eval the content inside [] so that [YYYY-1] will be evaluated"""
+        if not isinstance(period, str):
+            return period
+        return PERIOD_PATTERN.sub(lambda x: str(Table.eval_period(x.group(1))), period.replace('YYYY', year))
+
     def parse_cdm_df(self):
         """parse the cdm_df, expand the period, e.g. YYYY according to years in the same CSV"""
         def expand_period(cv_df):
-            def enum_cc(series):
-                """for CC Code"""
-                series['CC Code'] = str(int(series.name) + 1)
-                return series
-
-            def period_yyyy(series, year):
-                """eval the content inside YYYY so that YYYY-1 will be evaluated"""
-                s = series['CC Description'].replace('YYYY', year)
-                series['CC Description'] = re.sub(
-                    r'\[(.*?)\]', lambda x: str(eval(x.group(1))), s
-                )
-                return series
-
-            return pd.concat([
-                pd.concat([
-                    cc_df.copy().apply(lambda x: period_yyyy(x, year), axis=1)
-                    for year in cv_df['CV'][cv_df['CV']['FAS field name'] == 'year']['CC Description']
-                ], ignore_index=True).apply(enum_cc, axis=1)
-                if cc_fas == 'period' else cc_df
-                for cc_fas, cc_df in cv_df['CV'].groupby('FAS field name', sort=False)
-            ], ignore_index=True)
+            """repeat the period CC for every year, in the order of year then period, and renumber the CC Code"""
+            years = cv_df.loc[cv_df['FAS field name'] == 'year', 'CC Description'].to_list()
+            cc_df_list = []
+            for cc_fas, cc_df in cv_df.groupby('FAS field name', sort=False):
+                if cc_fas == 'period':
+                    periods = cc_df['CC Description'].to_list()
+                    cc_df = cc_df.iloc[np.tile(np.arange(len(cc_df)), len(years))].reset_index(drop=True)
+                    cc_df['CC Description'] = [
+                        type(self).period_yyyy(period, year) for year in years for period in periods
+                    ]
+                    cc_df['CC Code'] = np.arange(1, len(cc_df) + 1).astype(str)
+                cc_df_list.append(cc_df)
+            return pd.concat(cc_df_list, ignore_index=True)
+
         # split the df into different section and assign a key according to its first column
         df_dict = {
             field: field_df.dropna(axis=1, how='all')
@@ -334,6 +778,16 @@ class Table(Dict):
         # update the self dictionary
         self.update(df_dict)
 
+    def get_descs(self):
+        """English descriptions in CSV which may be translated"""
+        return {
+            desc
+            for field_df in self.values()
+            for col in ['FAS description', 'Alternate', 'CC Description', 'CC Alternate', 'SP Desc']
+            if col in field_df
+            for desc in field_df[col].dropna()
+        }
+
     def get_theme_code(self):
         return self.config_df.iloc[1, 1].zfill(3)
 
@@ -343,7 +797,23 @@ class Table(Dict):
         self.src = footnote.parse('Source: ', src=True)
         self.src_tc = footnote.parse('資料來源：', src=True, tc=True)
 
+    @staticmethod
+    def optional_col(df, col, default=None):
+        """get a column as a list, NaN and a missing column are filled by default"""
+        if col in df:
+            return [default if pd.isnull(value) else value for value in df[col].to_list()]
+        return [default] * len(df)
+
+    @staticmethod
+    def is_number(desc):
+        try:
+            float(desc.replace(',', '').replace(' ', ''))
+            return True
+        except ValueError:
+            return False
+
     def init_cv_cc(self, translator, fas_dict):
+        roman_pattern = re.compile(r'^(\()(ix|iv|v?i{0,3}|x?i{0,3})(\))$')
         for cv_code, cv_cc_df in self['CV'].groupby('Common Data Model Code', sort=False):
             cv_cc_df = cv_cc_df.dropna(axis='columns', how='all')
             cv_cols = ['Common Data Model Code', 'FAS description']
@@ -353,49 +823,48 @@ class Table(Dict):
             for cv_values, cc_df in cv_cc_df.groupby(cv_cols, sort=False):
                 cv_dict = {cv_cols[i]: value for i, value in enumerate(cv_values) if value}
                 cv_desc = cv_dict['FAS description']
-                cv_desc_tc = cv_dict.get('FAS description Chinese', translator.translate(cv_desc))
+                cv_desc_tc = cv_dict.get('FAS description Chinese') or translator.translate(cv_desc)
                 if 'Alternate' in cv_dict:
                     cv_alt_desc = cv_dict['Alternate']
-                    cv_alt_desc_tc = cv_dict.get('Alternate Chi', translator.translate(cv_alt_desc))
+                    cv_alt_desc_tc = cv_dict.get('Alternate Chi') or translator.translate(cv_alt_desc)
                 else:
                     cv_alt_desc = ''
                     cv_alt_desc_tc = ''
                 self.cv_cc[cv_code] = CDMGroup(cv_desc, cv_desc_tc, cv_alt_desc, cv_alt_desc_tc)
 
-                for cc_seq, (cc_code, cc_series) in enumerate(cc_df.set_index('CC Code').iterrows(), start=1):
-                    cc_series.dropna(inplace=True)
-                    cc_fas = cc_series['FAS field name']
-                    cc_desc = cc_series['CC Description']
-                    ccg = int(cc_series['CC Group']) if 'CC Group' in cc_series else 1
-                    parent_cc_code = cc_series['Parent CC Code'] if 'Parent CC Code' in cc_series else ''
-                    if 'CC Alternate' in cc_series:
-                        cc_alt_desc = cc_series['CC Alternate']
-                        cc_alt_desc_tc = cc_series[
-                            'CC Alternate Chi'
-                        ] if 'CC Alternate Chi' in cc_series else translator.translate(cc_alt_desc)
+                # optional columns are resolved once for the whole group
+                cc_codes = cc_df['CC Code'].to_list()
+                cc_fas_list = cc_df['FAS field name'].to_list()
+                cc_desc_list = cc_df['CC Description'].to_list()
+                cc_desc_tc_list = type(self).optional_col(cc_df, 'CC Description Chinese')
+                ccg_list = [int(ccg) for ccg in type(self).optional_col(cc_df, 'CC Group', 1)]
+                parent_list = type(self).optional_col(cc_df, 'Parent CC Code', '')
+                cc_alt_desc_list = type(self).optional_col(cc_df, 'CC Alternate', '')
+                cc_alt_desc_tc_list = type(self).optional_col(cc_df, 'CC Alternate Chi')
+
+                cc_seq_list = []
+                for i, (cc_code, cc_fas, cc_desc) in enumerate(zip(cc_codes, cc_fas_list, cc_desc_list)):
+                    is_year = len(str(cc_code)) == 4 and str(cc_code).isdigit()
+                    cc_seq_list.append(cc_code if is_year else i + 1)
+                    if is_year or roman_pattern.match(cc_desc) or type(self).is_number(cc_desc):
+                        cc_desc_tc_list[i] = cc_desc
+                    elif cc_desc_tc_list[i] is None and cc_fas == 'period' and cv_code == 'M3M':
+                        cc_desc_tc_list[i] = cc_desc
+                # translate the rest in one batch
+                translated = translator.translate_all(chain(
+                    (cc_desc for cc_desc, cc_desc_tc in zip(cc_desc_list, cc_desc_tc_list) if cc_desc_tc is None),
+                    (alt for alt, alt_tc in zip(cc_alt_desc_list, cc_alt_desc_tc_list) if alt and alt_tc is None)
+                ))
+
+                for cc_code, cc_fas, cc_desc, cc_desc_tc, cc_alt_desc, cc_alt_desc_tc, ccg, parent_cc_code, cc_seq \
+                        in zip(cc_codes, cc_fas_list, cc_desc_list, cc_desc_tc_list, cc_alt_desc_list,
+                               cc_alt_desc_tc_list, ccg_list, parent_list, cc_seq_list):
+                    if cc_alt_desc:
+                        cc_alt_desc_tc = cc_alt_desc_tc if cc_alt_desc_tc is not None else translated[cc_alt_desc]
                     else:
-                        cc_alt_desc = ''
                         cc_alt_desc_tc = ''
-
-                    if len(str(cc_code)) == 4 and str(cc_code).isdigit():
-                        cc_seq = cc_code
-                        cc_desc_tc = cc_desc
-                    elif re.match(r'^(\()(ix|iv|v?i{0,3}|x?i{0,3})(\))$', cc_desc):
-                        cc_desc_tc = cc_desc
-                    else:
-                        try:
-                            float(cc_desc.replace(',', '').replace(' ', ''))
-                            cc_desc_tc = cc_desc
-                        except ValueError:
-                            if 'CC Description Chinese' in cc_series:
-                                cc_desc_tc = cc_series['CC Description Chinese']
-                            elif cc_fas == 'period' and cv_code == 'M3M':
-                                cc_desc_tc = cc_desc
-                            else:
-                                cc_desc_tc = translator.translate(cc_desc)
-
-                    verify = cc_desc.lower()
-                    cc_footnote = fas_dict['CV'][cc_fas].get(verify, {})
+                    cc_desc_tc = cc_desc_tc if cc_desc_tc is not None else translated[cc_desc]
+                    cc_footnote = fas_dict['CV'][cc_fas].get(cc_desc.lower(), {})
                     self.cv_cc[cv_code][cc_code] = CDM(
                         cc_desc, cc_desc_tc, cc_alt_desc, cc_alt_desc_tc,
                         fas=cc_fas, footnote=cc_footnote, seq=cc_seq, ccg=ccg, parent_cc_code=parent_cc_code
@@ -417,7 +886,7 @@ class Table(Dict):
                 sp_dict = {sp_cols[i]: value for i, value in enumerate(sp_values) if value}
                 if 'SP Desc' in sp_dict:
                     sp_desc = sp_dict['SP Desc']
-                    sp_desc_tc = sp_dict.get('SP Desc Chi', translator.translate(sp_desc))
+                    sp_desc_tc = sp_dict.get('SP Desc Chi') or translator.translate(sp_desc)
                 else:
                     sp_desc = ''
                     sp_desc_tc = ''
@@ -426,8 +895,7 @@ class Table(Dict):
                 sp_type = sp_dict['SP Type']
                 unit = sp_dict['Unit']
                 unit_desc = sp_dict['Unit description']
-                unit_desc_tc = sp_dict.get(
-                    'Unit description Chinese', translator.translate(unit_desc, is_unit=True))
+                unit_desc_tc = sp_dict.get('Unit description Chinese') or translator.translate(unit_desc, is_unit=True)
                 dec = int(sp_dict['decimal'])
                 multi = int(sp_dict['unit multipler'])
                 sep = type(self).format_dict.get(sp_dict['NUMBERFORMAT'], '') if 'NUMBERFORMAT' in sp_dict else ''
@@ -440,249 +908,526 @@ class Table(Dict):
                                                type=sp_type, unit=unit, unit_desc=unit_desc, unit_desc_tc=unit_desc_tc,
                                                dec=dec, multi=multi, sep=sep, footnote=sp_footnote)
                 # SV
-                sv_df = sv_df.set_index('Common Data Model Code')
-                for sv_code, sv_series in sv_df.iterrows():
-                    sv_series.dropna(inplace=True)
-                    sv_fas = sv_series['FAS field name']
-                    sv_mdt = sv_series['FAS SP field name']
-                    sv_desc = sv_series['FAS description']
-                    sv_desc_tc = sv_series.get(
-                        'FAS description Chinese', translator.translate(sv_desc))
+                sv_codes = sv_df['Common Data Model Code'].to_list()
+                sv_fas_list = sv_df['FAS field name'].to_list()
+                sv_mdt_list = sv_df['FAS SP field name'].to_list()
+                sv_desc_list = sv_df['FAS description'].to_list()
+                sv_desc_tc_list = type(self).optional_col(sv_df, 'FAS description Chinese')
+                sv_alt_desc_list = type(self).optional_col(sv_df, 'Alternate', '')
+                sv_alt_desc_tc_list = type(self).optional_col(sv_df, 'Alternate Chi')
+                translated = translator.translate_all(chain(
+                    (sv_desc for sv_desc, sv_desc_tc in zip(sv_desc_list, sv_desc_tc_list) if sv_desc_tc is None),
+                    (alt for alt, alt_tc in zip(sv_alt_desc_list, sv_alt_desc_tc_list) if alt and alt_tc is None)
+                ))
+                for sv_code, sv_fas, sv_mdt, sv_desc, sv_desc_tc, sv_alt_desc, sv_alt_desc_tc in zip(
+                        sv_codes, sv_fas_list, sv_mdt_list, sv_desc_list, sv_desc_tc_list, sv_alt_desc_list,
+                        sv_alt_desc_tc_list):
+                    sv_desc_tc = sv_desc_tc if sv_desc_tc is not None else translated[sv_desc]
                     verify = sv_desc.lower()
-                    if 'Alternate' in sv_series:
-                        sv_alt_desc = sv_series['Alternate']
-                        sv_alt_desc_tc = sv_series.get('Alternate Chi', translator.translate(sv_alt_desc))
+                    if sv_alt_desc:
+                        sv_alt_desc_tc = sv_alt_desc_tc if sv_alt_desc_tc is not None else translated[sv_alt_desc]
                         verify = sv_alt_desc.lower()
                     else:
-                        sv_alt_desc = ''
                         sv_alt_desc_tc = ''
-
                     sv_footnote = fas_dict['SV'][sv_fas].get(verify, {})
                     self.sp_sv[sp_code][sv_code] = CDM(sv_desc, sv_desc_tc, sv_alt_desc, sv_alt_desc_tc,
                                                        fas=sv_fas, footnote=sv_footnote, mdt=sv_mdt)
 
-    def get_sp_sv_id(self, desc, fas, sp_fas):
+    def lookup_copy(self):
+        """a copy without the DataFrames of the input file, e.g. for saving a plan or matching in other processes"""
+        table = copy.copy(self)
+        table.config_df = None
+        table.cdm_df = None
+        table._dict = {}
+        return table
+
+    def get_sp_sv_codes(self, desc, fas, sp_fas):
         return [
-            [sv_result['id'], sv_result['child_id']]
-            for sv_result in self.sp_sv.get_id_by_desc(desc, fas=fas, mdt=sp_fas)
+            (sv_result['cdm_code'], sv_result['code'])
+            for sv_result in self.sp_sv.get_id_by_desc(desc, fas=fas, mdt=sp_fas) or []
         ]
 
-    def init_mdt(self, theme, fas):
-        for mdt_dict in fas.data:
-            cvs_cc_id = {}
+    def init_mdt_keys(self, fas):
+        """
+        match the parsed FAS rows to CC and SV, the rows are kept as ((CV code, CC code), ...), SP code, SV code,
+        obs_value and sd_value so that no id is needed before LoadPlan.get_mdt_rows,
+        a large table is matched in chunks of rows in parallel
+        :param fas: Fas after update_footnote_and_parse_fas_df
+        """
+        undefined_sv = fas.get('SV', {}).get('undefined')
+        chunks = [fas.data[i:i + Fas.chunk_rows] for i in range(0, len(fas.data), Fas.chunk_rows)]
+        owner = self if len(chunks) <= 1 else self.lookup_copy()
+        match = partial(type(self).match_mdt_rows, undefined_sv=undefined_sv)
+        for mdt_keys in map_chunks(match, owner, chunks, Fas.workers):
+            self.mdt_keys.extend(mdt_keys)
+
+    def match_mdt_rows(self, data, undefined_sv=None):
+        """
+        match rows of Fas.data to CC and SV codes, only the CV/SP models are read
+        :param data: list of mdt_dict
+        :param undefined_sv: descriptions of the undefined SV fas
+        :return: list of rows for mdt_keys
+        """
+        mdt_keys = []
+        # the same desc appears in many rows, so each one is only matched once
+        cc_lookup = {}
+        sv_lookup = {}
+        for mdt_dict in data:
             all_cc_results = []
             multiple = []
             # split possibly multiple results
             for cc_fas, value in mdt_dict['CV'].items():
-                cc_results = self.cv_cc.get_id_by_desc(value, 'parent_cc_code', 'ccg', fas=cc_fas)
+                if (value, cc_fas) not in cc_lookup:
+                    cc_lookup[value, cc_fas] = self.cv_cc.get_id_by_desc(
+                        value, 'parent_cc_code', 'ccg', fas=cc_fas) or []
+                cc_results = cc_lookup[value, cc_fas]
                 if len(cc_results) > 1:
                     multiple.extend(cc_results)
                 else:
                     all_cc_results.extend(cc_results)
 
-            cc_filter_df = pd.DataFrame(all_cc_results)
             # codes for non-multiple item(likely to be parent)
+            cc_filter = list(all_cc_results)
             if multiple:
-                multiple_df = pd.DataFrame(multiple)
+                codes = {cc_result['code'] for cc_result in cc_filter}
                 # so that always child of child will be processed later and the code of parent will present
-                multiple_df = multiple_df.sort_values(by='ccg')
-                # insert the result if it's parent_cc_code is used in this record
-                for _, row in multiple_df.iterrows():
-                    if row['parent_cc_code'] in cc_filter_df['code'].values:
-                        cc_filter_df = cc_filter_df.append(row)
-            # group by id and compare their ccg value(max is child)
-            cc_filter_df = cc_filter_df[cc_filter_df.groupby(['id'])['ccg'].transform(max) == cc_filter_df['ccg']]
-
-            # convert the data into respective cv?_cc_id col and cc_id
-            for _, cc_result in cc_filter_df.iterrows():
-                cv_pos = int(re.search(r'\d+', theme[cc_result['id']]).group(0))
-                cv_cc_id = f'[cv{cv_pos}_cc_id]'
-                cvs_cc_id[cv_cc_id] = cc_result['child_id']
+                for cc_result in sorted(multiple, key=lambda x: x['ccg']):
+                    # insert the result if it's parent_cc_code is used in this record
+                    if cc_result['parent_cc_code'] in codes:
+                        cc_filter.append(cc_result)
+                        codes.add(cc_result['code'])
+            # group by CV and compare their ccg value(max is child)
+            max_ccg = {}
+            for cc_result in cc_filter:
+                max_ccg[cc_result['cdm_code']] = max(
+                    max_ccg.get(cc_result['cdm_code'], cc_result['ccg']), cc_result['ccg'])
+            cvs = tuple(
+                (cc_result['cdm_code'], cc_result['code'])
+                for cc_result in cc_filter if cc_result['ccg'] == max_ccg[cc_result['cdm_code']]
+            )
             #
-            if cvs_cc_id:
+            if cvs:
                 for sp_fas, value_dict in mdt_dict['MDT'].items():
-                    obs_value = value_dict['obs_value']
-                    sd_value = value_dict['sd_value']
-
-                    sp_sv_id = []
-                    if mdt_dict['SV']:
-                        for sv_fas, sv_desc in mdt_dict['SV'].items():
-                            sp_sv_id.extend(self.get_sp_sv_id(sv_desc, sv_fas, sp_fas))
-                    else:
-                        try:
-                            for sv_desc in fas['SV']['undefined']:
-                                sp_sv_id.extend(self.get_sp_sv_id(sv_desc, 'undefined', sp_fas))
-                        except KeyError:
+                    sv_descs = list(mdt_dict['SV'].items())
+                    if not sv_descs:
+                        if undefined_sv is not None:
+                            sv_descs = [('undefined', sv_desc) for sv_desc in undefined_sv]
+                        else:
                             print('Something went wrong with SV, please check the FAS field of SV!')
                             # sys.exit(1)
-                    if sp_sv_id:
-                        for sp_id, sv_id in sp_sv_id:
-                            insert_dict = {
-                                '[theme_id]': theme.id,
-                                '[sv_id]': sv_id,
-                                '[sp_id]': sp_id,
-                                '[obs_value]': obs_value,
-                                '[sd_value]': sd_value
-                            }
-                            insert_dict.update(cvs_cc_id)
-                            self.mdt.append(insert_dict)
+                    for sv_fas, sv_desc in sv_descs:
+                        if (sv_desc, sv_fas, sp_fas) not in sv_lookup:
+                            sv_lookup[sv_desc, sv_fas, sp_fas] = self.get_sp_sv_codes(sv_desc, sv_fas, sp_fas)
+                        for sp_code, sv_code in sv_lookup[sv_desc, sv_fas, sp_fas]:
+                            mdt_keys.append((cvs, sp_code, sv_code, value_dict['obs_value'], value_dict['sd_value']))
+        return mdt_keys
 
 
 class Theme(Dict, Connection):
-    try:
-        theme_dict = pd.read_csv('config\\theme.csv', dtype=str, index_col='THEME').to_dict()
-    except FileNotFoundError:
-        print('a file is not found in config!')
-        sys.exit(1)
+    theme_dict = LazyDict(lambda: config_dict('theme.csv', 'THEME'))
+    slot_cols = [f'cv{x}_id' for x in range(1, 21)]
 
     #
     def __init__(self, theme_code):
         Dict.__init__(self)
         Connection.__init__(self)
         self.code = theme_code
-        self.desc = type(self).theme_dict['THEME_DESC_ENG'][theme_code]
-        self.desc_tc = type(self).theme_dict['THEME_DESC_CHI'][theme_code]
+        self.desc = type(self).theme_dict[theme_code].get('THEME_DESC_ENG', '')
+        self.desc_tc = type(self).theme_dict[theme_code].get('THEME_DESC_CHI', '')
         self.id = 0
 
+    def select_slots(self, lock=False):
+        """
+        get cv1_id, cv2_id...cv20_id in THEME
+        :param lock: lock the THEME row until commit so that other loaders cannot assign the same slot
+        :return: dictionary of cv_id: cv?_id
+        """
+        theme_df = self.select_sql(
+            selector=', '.join(f'[{col}]' for col in type(self).slot_cols),
+            addr=f"{db_address['insert']}.[THEME]{' WITH (UPDLOCK, HOLDLOCK)' if lock else ''}",
+            where={
+                '[theme_id]': self.id
+            },
+            get_df=True
+        )
+        if theme_df.empty:
+            return {}
+        return {int(cv_id): col for col, cv_id in theme_df.iloc[0].items() if pd.notnull(cv_id)}
+
     def load_dict(self):
-        try:
-            # get cv1_id, cv2_id...cv20_id in THEME
-            theme_df = self.select_sql(
-                selector=', '.join([f'[cv{x}_id]' for x in range(1, 21)]),
-                addr=f"{db_address['insert']}.[THEME]",
-                where={
-                    '[theme_id]': self.id
-                },
-                get_df=True,
-                df_index=['cv_id']
-            )
-            # Transpose the df
-            theme_df = theme_df.T
-            # dropna
-            theme_df = theme_df[pd.notnull(theme_df['cv_id'])]
-            theme_df.index.name = 'cvs_id'
-            theme_df.reset_index(level=0, inplace=True)
-            theme_df.set_index('cv_id', inplace=True)
-            theme_dict = theme_df['cvs_id'].to_dict()
-            # convert to dictionary
-            self.update(theme_dict)
-        except AttributeError:
-            pass
-
-    def insert_cv_id(self, cv_id):
-        # cv?_id col, ? is the current length + 1 so that it is the next one
-        self.update_sql(
-            addr=f"{db_address['insert']}.[THEME]",
-            col=f'[cv{len(self) + 1}_id]',
-            col_value=cv_id,
-            condition_col='[theme_id]',
-            condition_col_value=self.id
+        self.update(self.select_slots())
+
+    def check_slots(self, cv_codes):
+        """
+        exit before a table is written if THEME does not have a free cv?_id for every CV of it without one
+        :param cv_codes: class_var of all CVs of the table
+        """
+        addr = db_address['insert']
+        slot_df = self.select_sql(
+            replace_sql=(
+                f'SELECT [CV].[class_var] FROM {addr}.[THEME] AS [T] '
+                f"CROSS APPLY (VALUES {', '.join(f'([T].[{col}])' for col in type(self).slot_cols)}) AS [S] ([cv_id]) "
+                f'LEFT JOIN {addr}.[CV] AS [CV] ON [CV].[cv_id] = [S].[cv_id] '
+                f'WHERE [T].[theme] = {self._sql_string(self.code)} AND [S].[cv_id] IS NOT NULL'
+            ),
+            get_df=True
         )
-        self.load_dict()
+        slotted = set() if slot_df.empty else set(slot_df['class_var'].dropna())
+        new_cv_codes = [cv_code for cv_code in dict.fromkeys(cv_codes) if cv_code not in slotted]
+        if len(new_cv_codes) > len(type(self).slot_cols) - len(slot_df):
+            print(f'THEME {self.code} does not have a free cv?_id for each of {new_cv_codes}, '
+                  f'{len(slot_df)} of {len(type(self).slot_cols)} are used! Nothing is written.')
+            sys.exit(1)
+
+    def insert_cv_ids(self, cv_ids):
+        """assign the next free cv?_id slots to all new cv_ids and write them in one UPDATE"""
+        if all(cv_id in self for cv_id in cv_ids):
+            return
+        # slots may have been taken by another loader since load_dict
+        slot_dict = self.select_slots(lock=True)
+        new_cv_ids = [cv_id for cv_id in dict.fromkeys(cv_ids) if cv_id not in slot_dict]
+        free_cols = [col for col in type(self).slot_cols if col not in slot_dict.values()]
+        if len(new_cv_ids) > len(free_cols):
+            # release the lock
+            self._conn.commit()
+            print(f'THEME {self.code} does not have enough cv?_id for {new_cv_ids[len(free_cols):]}!')
+            sys.exit(1)
+        new_slot_dict = dict(zip(new_cv_ids, free_cols))
+        if new_slot_dict:
+            if self.update_cols_sql(
+                addr=f"{db_address['insert']}.[THEME]",
+                update={f'[{col}]': cv_id for cv_id, col in new_slot_dict.items()},
+                condition_col='[theme_id]',
+                condition_col_value=self.id
+            ):
+                print(f'cv?_id of THEME {self.code} are not updated!')
+                sys.exit(1)
+        else:
+            # release the lock
+            self._conn.commit()
+        slot_dict.update(new_slot_dict)
+        self.update(slot_dict)
+
+
+class ThemeStore:
+    """
+    Output DataFrames of every table kept per DB and theme by tb_id, so that a theme workbook is merged from all
+    tables processed so far and processing a table again only replaces the rows of that table
+    """
+    # sheets that are not merged, the ones of the latest stored table are used
+    shared_sheets = ['THEME', 'SD']
+
+    def __init__(self, theme_code):
+        self.theme_code = theme_code
+        self.cache = ReferenceCache(os.path.join('theme', type(self).get_db_key(), theme_code))
+
+    @staticmethod
+    def get_db_key():
+        """folder name of the DB written to, as tb_id is only unique in a DB"""
+        address = f"{db_config.dict.get('server', '')}|{db_address['insert']}"
+        return hashlib.sha1(address.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def get_tb_id(df_dict):
+        return int(df_dict['TB_INFO'].index[0])
+
+    def get_folder(self):
+        return os.path.join(type(self.cache).folder, self.cache.name)
+
+    def tb_ids(self):
+        try:
+            names = os.listdir(self.get_folder())
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[2:-7]) for name in names if re.fullmatch(r'TB\d+\.pickle', name))
+
+    def update(self, df_dict, path=None):
+        """
+        replace the stored DataFrames of a table, a table moved from another theme is removed from there
+        :param df_dict: output DataFrames of the table
+        :param path: input file of the table, the table is pruned once the file is gone
+        """
+        tb_id = type(self).get_tb_id(df_dict)
+        self.cache.save(f'TB{tb_id}', {'stored': time.time_ns(), 'path': path, 'df_dict': df_dict})
+        theme_folder = os.path.dirname(self.get_folder())
+        for theme_code in os.listdir(theme_folder):
+            if theme_code != self.theme_code:
+                try:
+                    os.remove(os.path.join(theme_folder, theme_code, f'TB{tb_id}.pickle'))
+                except FileNotFoundError:
+                    pass
+
+    def prune(self, db_tb_ids):
+        """
+        remove the stored tables which are no longer in DB or whose input file is gone
+        :param db_tb_ids: the stored tb_ids found in TB_INFO
+        :return: the removed tb_ids
+        """
+        removed = []
+        for tb_id in self.tb_ids():
+            entry = self.cache.load(f'TB{tb_id}')
+            if tb_id not in db_tb_ids or (entry and entry.get('path') and not os.path.exists(entry['path'])):
+                try:
+                    os.remove(self.cache.get_path(f'TB{tb_id}'))
+                except FileNotFoundError:
+                    pass
+                removed.append(tb_id)
+        return removed
+
+    def merge(self, tb_ids=None):
+        """
+        merge the sheets of the stored tables in the order of tb_id
+        :param tb_ids: merge only these tables instead of all stored ones
+        """
+        entries = [self.cache.load(f'TB{tb_id}') for tb_id in self.tb_ids() if tb_ids is None or tb_id in tb_ids]
+        entries = [entry for entry in entries if entry]
+        if not entries:
+            return {}
+        latest = max(entries, key=lambda x: x['stored'])['df_dict']
+        sheets_dict = {}
+        for entry in entries:
+            for sheet_name, sheet in entry['df_dict'].items():
+                sheets_dict.setdefault(sheet_name, []).append(sheet)
+        merged_df_dict = {}
+        for sheet_name, sheets in sheets_dict.items():
+            if sheet_name in type(self).shared_sheets:
+                merged_df_dict[sheet_name] = latest.get(sheet_name, sheets[-1])
+            else:
+                merged_df_dict[sheet_name] = pd.concat(sheets, sort=False)
+        # cv?_cc_id columns used by some of the tables are object after concat
+        if 'MDT' in merged_df_dict:
+            merged_df_dict['MDT'] = Converter.compact_mdt_df(merged_df_dict['MDT'])
+        return merged_df_dict
 
 
 class Converter(Connection):
     out_df_dict = {}
     theme_df_dict = {}
+    # input path and df_dict of the tables processed in this run which are not in ThemeStore yet
+    unstored_df_dict = {}
+    # merge the theme workbooks with the tables stored in previous runs, otherwise only with the ones of this run
+    merge_stored = True
+    checkpoint_cache = FileCache('checkpoint')
+    id_allocator = IdAllocator()
+    # number of processes for writing workbooks
+    workers = 1
+    # number of threads writing the independent tables of a plan
+    write_workers = 4
+    # rows of a statement of merge_rows, a VALUES clause has at most 1000 rows
+    merge_batch_rows = 1000
+    # MDT columns
+    mdt_id_cols = ['[theme_id]', '[sv_id]', '[sp_id]']
+    mdt_cv_cols = [f'[cv{i}_cc_id]' for i in range(1, 21)]
 
     def __init__(self, theme_code, tb_code):
         Connection.__init__(self)
         self.theme_code = theme_code
         self.tb_code = tb_code
         self.df_dict = {}
+        # input file of the table
+        self.path = None
 
     def save_df_dict(self):
         if self.theme_code not in type(self).out_df_dict:
             type(self).out_df_dict[self.theme_code] = {}
         type(self).out_df_dict[self.theme_code][self.tb_code] = self.df_dict
+        type(self).unstored_df_dict.setdefault(self.theme_code, []).append((self.path, self.df_dict))
+
+    @classmethod
+    def clear_df_dict(cls):
+        """forget the tables and themes of a finished batch, the stored ones are merged again from ThemeStore"""
+        cls.out_df_dict.clear()
+        cls.theme_df_dict.clear()
+        cls.unstored_df_dict.clear()
+
+    def save_checkpoint(self, path):
+        """save df_dict of a completed table, it is valid until the input file is changed"""
+        type(self).checkpoint_cache.save(path, {
+            'theme_code': self.theme_code,
+            'tb_code': self.tb_code,
+            'df_dict': self.df_dict
+        })
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        """
+        :param path: input file path
+        :return: the checkpoint of a table completed in a previous run or None if the table has to be processed
+        """
+        return cls.checkpoint_cache.load(path)
+
+    @classmethod
+    def restore_checkpoint(cls, checkpoint, path=None):
+        """
+        put df_dict of a checkpoint into out_df_dict like a table processed in this run
+        :param checkpoint: the checkpoint from load_checkpoint
+        :param path: input file of the checkpoint
+        """
+        converter = cls(checkpoint['theme_code'], checkpoint['tb_code'])
+        converter.df_dict = checkpoint['df_dict']
+        converter.path = path
+        converter.save_df_dict()
+        return converter
+
+    @classmethod
+    def compact_mdt_df(cls, mdt_df):
+        """
+        type MDT as nullable int32 ids, float64 obs_value and int16 sd_value,
+        cv?_cc_id columns unused by all rows are kept as sparse columns
+        """
+        mdt_df = mdt_df.reindex(columns=cls.mdt_id_cols + ['[obs_value]', '[sd_value]'] + cls.mdt_cv_cols)
+        typed_dict = {}
+        for col in cls.mdt_id_cols + cls.mdt_cv_cols:
+            values = pd.to_numeric(mdt_df[col].astype(object))
+            if values.notna().any():
+                typed_dict[col] = values.astype('Int32')
+            else:
+                typed_dict[col] = pd.arrays.SparseArray(np.full(len(mdt_df), np.nan))
+        typed_dict['[obs_value]'] = pd.to_numeric(mdt_df['[obs_value]'].astype(object)).astype('float64')
+        typed_dict['[sd_value]'] = pd.to_numeric(mdt_df['[sd_value]'].astype(object)).astype('Int16')
+        typed_df = pd.DataFrame(typed_dict, index=mdt_df.index, columns=mdt_df.columns)
+        typed_df.index.name = mdt_df.index.name
+        return typed_df
 
     @classmethod
     def merge_df(cls):
+        """
+        store the tables processed since the last merge in ThemeStore, and merge each of their themes with the tables
+        stored in previous runs which are still in DB, or only with the tables of this run if not merge_stored
+        """
         for theme_code, table_df_dict in cls.out_df_dict.items():
-            merged_df_dict = {}
-            for df_dict in table_df_dict.values():
-                for sheet_name, sheet in df_dict.items():
-                    # if sheet.index.name:
-                    #     sheet = sheet.reset_index()
-                    if sheet_name not in merged_df_dict:
-                        merged_df_dict[sheet_name] = pd.DataFrame()
-                    if sheet_name == 'THEME' or sheet_name == 'SD':
-                        merged_df_dict[sheet_name] = sheet
-                    else:
-                        merged_df_dict[sheet_name] = pd.concat(
-                            [merged_df_dict[sheet_name], sheet], sort=False
-                        )
-            cls.theme_df_dict[theme_code] = merged_df_dict
-
-    def process_part(self, table_name, get_field, insert_dict, df_col=None, concat=False,
-                     additional_dict: dict = None, where_dict: dict = None):
-        """
-        Insert data from insert_dict into database
-        Create a DataFrame from the inserted data
-        :param table_name: table name of the Database. e.g. THEME, TB_INFO, CV, CC, SV...
-        :param get_field: get field needs to be returned from this function. e.g. cv_id, sp_id, ccg_id...
-        :param insert_dict: insert_dictionary
+            theme_store = ThemeStore(theme_code)
+            for path, df_dict in cls.unstored_df_dict.pop(theme_code, []):
+                theme_store.update(df_dict, path)
+            if cls.merge_stored:
+                theme_store.prune(cls.select_tb_ids(theme_store.tb_ids()))
+                cls.theme_df_dict[theme_code] = theme_store.merge()
+            else:
+                cls.theme_df_dict[theme_code] = theme_store.merge(
+                    {ThemeStore.get_tb_id(df_dict) for df_dict in table_df_dict.values()})
+
+    @staticmethod
+    def select_tb_ids(tb_ids):
+        """
+        :param tb_ids: list of tb_id
+        :return: set of the tb_ids in TB_INFO
+        """
+        if not tb_ids:
+            return set()
+        df = Connection().select_sql(
+            replace_sql=f"SELECT [tb_id] FROM {db_address['insert']}.[TB_INFO] "
+                        f"WHERE [tb_id] IN ({', '.join(str(tb_id) for tb_id in tb_ids)})",
+            get_df=True
+        )
+        return set(df['tb_id']) if len(df) else set()
+
+    @staticmethod
+    def rows_df(rows, get_field=None, df_col=None):
+        """
+        Create a DataFrame from the rows written by merge_rows, indexed by get_field
+        :param rows: list of insert_dictionary with get_field
+        :param get_field: the index, None for a table without id
         :param df_col: additional df_col. e.g. cv1_id, cv2_id, cv3_id...
-        :param concat: concat the newly created DataFrame and the old DataFrame in out_df
-        :param additional_dict: additional dictionary
-        :param where_dict: checking_dictionary
-        :return: return the value of get_field
-        """
-        # if df_col has arg, then df_col = column in insert_dict + df_col
-        if df_col:
-            df_col = [col for col in insert_dict.keys() if col not in df_col] + df_col
-        # if there an additional dictionary, update insert_dict
-        if additional_dict:
-            insert_dict.update(additional_dict)
-        # if out_df[table_name] is not a DataFrame, create an empty DataFrame with df_col in out_df[table_name]
-        if not isinstance(self.df_dict.get(table_name, 0), pd.DataFrame):
-            self.df_dict[table_name] = pd.DataFrame(columns=df_col)
-            if get_field != '1':
-                self.df_dict[table_name].index.name = get_field
+        :return: DataFrame
+        """
+        df_col = df_col or []
+        cols = [col for col in dict.fromkeys(chain.from_iterable(rows)) if col != get_field and col not in df_col]
+        # df_col are object, so that an id set later, e.g. cv?_id of THEME, stays int
+        df = pd.DataFrame(rows, columns=([get_field] if get_field else []) + cols + df_col).astype(
+            {col: object for col in df_col})
+        return df.set_index(get_field) if get_field else df
+
+    @classmethod
+    def _merge_value(cls, value):
+        """a value of merge_rows as a string literal, so that a column of VALUES has one type"""
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return 'NULL'
+        value = cls._sql_string(value if isinstance(value, str) else str(value))
+        return value.replace('\\n', "' + CHAR(10) + '").replace('\\', '')
+
+    def merge_rows(self, table_name, get_field, rows, key_cols=None):
+        """
+        Insert the rows which are not in DB yet, with one set-based statement per batch of rows
+        instead of a SELECT and an INSERT per row
+        :param table_name: table name of the Database. e.g. CV, CC, MDT...
+        :param get_field: get field needs to be returned, e.g. cv_id, or '1' for a table without id
+        :param rows: list of insert_dictionary
+        :param key_cols: columns checked for an existing row, e.g. from LoadPlan.key_cols, all columns if None
+        :return: list of the value of get_field of each row, None if get_field is 1
+        """
         addr = f"{db_address['insert']}.[{table_name}]"
-        # get value from DB using select_sql method
-        value = self.select_sql(
-            selector=get_field,
-            addr=addr,
-            where=where_dict if where_dict else insert_dict
+        ids = [None] * len(rows)
+        # (cols, key_cols): {key: positions of the rows}, a key is only written once
+        groups = {}
+        for i, row in enumerate(rows):
+            cols = tuple(row)
+            keys = tuple(key_cols) if key_cols else cols
+            groups.setdefault((cols, keys), {}).setdefault(tuple(row[col] for col in keys), []).append(i)
+        batch_rows = type(self).merge_batch_rows
+        for (cols, keys), key_dict in groups.items():
+            positions_list = list(key_dict.values())
+            for start in range(0, len(positions_list), batch_rows):
+                batch = positions_list[start:start + batch_rows]
+                batch_ids = self.merge_batch(addr, get_field, cols, keys, [rows[positions[0]] for positions in batch])
+                for positions, value in zip(batch, batch_ids):
+                    for i in positions:
+                        ids[i] = value
+        return ids
+
+    def merge_batch(self, addr, get_field, cols, key_cols, rows):
+        """
+        Insert a batch of rows of the same columns which are not in addr yet in one transaction,
+        the new rows are given contiguous ids from one block of IdAllocator
+        :return: list of the value of get_field of each row
+        """
+        col_list = ', '.join(cols)
+        values = ', '.join(
+            f"({seq}, {', '.join(type(self)._merge_value(row[col]) for col in cols)})"
+            for seq, row in enumerate(rows)
         )
-        # If it returns nothing/0/None
-        if not value:
-            # insert using insert_dict into DB
-            self.insert_sql(
-                addr=addr,
-                insert=insert_dict
-            )
-            # if get_field is 1, it check if it exist and do not need the value
-            if get_field != '1':
-                # get back the value using get_latest_id method
-                value = self.get_latest_id(
-                    addr=addr,
-                    col=get_field
-                )
-            else:
-                # for creating a DataFrame from insert_dict
-                value = len(self.df_dict[table_name])
-        # create a DataFrame from the inserted value and index is the value
-        df = pd.DataFrame(insert_dict, index=[value], columns=df_col)
-        if get_field != '1':
-            df.index.name = get_field
-        # if concat is enabled(in a loop of cv/sp), concat the current df and the existing df in out_df[table_name]
-        if concat:
-            self.df_dict[table_name] = pd.concat([self.df_dict[table_name], df],
-                                                 sort=False,
-                                                 ignore_index=True if get_field == '1' else False)
-        else:
-            # otherwise replace/set it
-            self.df_dict[table_name] = df
 
-        if get_field != '1':
-            return value
+        def matched(alias, selector='1'):
+            # the rows of the target table are locked until commit, so that no other loader inserts the same key
+            return (
+                f'SELECT {selector} FROM {addr} AS [T] WITH (UPDLOCK, HOLDLOCK) '
+                f"WHERE {' AND '.join(f'[T].{col} = [{alias}].{col}' for col in key_cols)}"
+            )
+        sql = (
+            f"DECLARE @V TABLE ([seq] INT PRIMARY KEY, [id] BIGINT, [new] BIT NOT NULL DEFAULT 0, "
+            f"{', '.join(f'{col} NVARCHAR(MAX)' for col in cols)}); "
+            f'INSERT INTO @V ([seq], {col_list}) VALUES {values}; '
+        )
+        if get_field == '1':
+            sql += (
+                f'INSERT INTO {addr} ({col_list}) SELECT {col_list} FROM @V AS [V] WHERE NOT EXISTS ({matched("V")});'
+            )
+            self.transaction_sql(sql, 'SELECT COUNT(*) FROM @V')
+            return [None] * len(rows)
+        allocator = type(self).id_allocator
+        start = allocator.take_ids(addr, get_field, len(rows))
+        insert = f'INSERT INTO {addr} ({get_field}, {col_list}) SELECT [id], {col_list} FROM @V WHERE [new] = 1'
+        if allocator.is_identity(addr, get_field):
+            insert = type(self)._identity_insert_sql(addr, insert)
+        sql += (
+            f'UPDATE [U] SET [id] = [N].[id], [new] = 1 FROM @V AS [U] JOIN ('
+            f'SELECT [seq], {start - 1} + ROW_NUMBER() OVER (ORDER BY [seq]) AS [id] FROM @V AS [V] '
+            f'WHERE NOT EXISTS ({matched("V")})) AS [N] ON [N].[seq] = [U].[seq]; '
+            f'{insert}; '
+            f"UPDATE [U] SET [id] = ({matched('U', f'MIN([T].{get_field})')}) "
+            'FROM @V AS [U] WHERE [new] = 0;'
+        )
+        try:
+            df = self.transaction_sql(sql, 'SELECT [seq], [id], [new] FROM @V ORDER BY [seq]', get_df=True)
+        except pymssql.Error:
+            allocator.return_ids(addr, start, len(rows), 0)
+            raise
+        allocator.return_ids(addr, start, len(rows), int(df['new'].sum()))
+        return [int(value) for value in df['id']]
 
     @staticmethod
     def write_excel(theme_code, df_dict, tb_code=''):
         filename = f"output\\{'_'.join([theme_code, tb_code]) if tb_code else theme_code}.xlsx"
-        with pd.ExcelWriter(filename) as writer:
+        with atomic_write(filename) as temp_filename, pd.ExcelWriter(temp_filename) as writer:
             for sheet_name, df in df_dict.items():
                 index = False
                 if df.index.name:
@@ -696,31 +1441,52 @@ class Converter(Connection):
                 df.columns = [column[1:-1] if column[0] == '[' else column for column in df.columns]
                 # if that DataFrame has index name i.e. has unique id column
                 df.to_excel(writer, sheet_name=sheet_name, index=index)
-        print(f'Written to {filename}.')
+        return filename
+
+    @classmethod
+    def write_excel_all(cls, jobs):
+        """
+        write workbooks in a process pool
+        :param jobs: list of (theme_code, df_dict, tb_code) for write_excel
+        """
+        total = len(jobs)
+        workers = min(cls.workers, total)
+        if workers <= 1:
+            for done, job in enumerate(jobs, start=1):
+                print(f'[{done}/{total}] Written to {cls.write_excel(*job)}.')
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(cls.write_excel, *job) for job in jobs]
+            for done, future in enumerate(as_completed(futures), start=1):
+                print(f'[{done}/{total}] Written to {future.result()}.')
 
     @classmethod
     def convert_table(cls):
-        for theme_code, table_df_dict in cls.out_df_dict.items():
-            for tb_code, df_dict in table_df_dict.items():
-                cls.write_excel(theme_code, df_dict, tb_code)
+        cls.write_excel_all([
+            (theme_code, df_dict, tb_code)
+            for theme_code, table_df_dict in cls.out_df_dict.items()
+            for tb_code, df_dict in table_df_dict.items()
+        ])
 
     @classmethod
     def convert_theme(cls):
         if cls.theme_df_dict:
-            for theme_code, merged_df_dict in cls.theme_df_dict.items():
-                cls.write_excel(theme_code, merged_df_dict)
+            cls.write_excel_all([
+                (theme_code, merged_df_dict, '')
+                for theme_code, merged_df_dict in cls.theme_df_dict.items()
+            ])
         else:
             print('Please run class method merge_df first!')
 
 
 class Translator(Connection):
-    try:
-        unit_dict = pd.read_csv(
-            'config\\unit.csv', dtype=str, index_col='Unit_desc_eng'
-        )['Unit_desc_chi'].str.lower().to_dict()
-    except FileNotFoundError:
-        print('unit.csv is not found in config!')
-        sys.exit(1)
+    unit_dict = LazyDict(lambda: {
+        unit: unit_tc.lower() for unit, unit_tc in config_dict('unit.csv', 'Unit_desc_eng', 'Unit_desc_chi').items()
+    })
+    # the most common translations fetched so far are kept for the other tables in the same run
+    all_field_cache = {}
+    queried_descs = set()
+    reference_cache = ReferenceCache('reference')
 
     #
     def __init__(self, tb_code):
@@ -729,7 +1495,24 @@ class Translator(Connection):
         self.table_field_dict = {}
         self.all_field_dict = {}
 
-    def load_data(self):
+    @classmethod
+    def clear_cache(cls):
+        """forget the translations fetched so far, so that they are read again from TB_FIELDLOOKUP"""
+        cls.all_field_cache = {}
+        cls.queried_descs = set()
+
+    @staticmethod
+    def get_variants(desc_eng):
+        return desc_eng, desc_eng.replace(' (', '('), desc_eng.replace('(', ' (')
+
+    def load_data(self, descs_eng, cached=False):
+        """
+        load the translations of TB_FIELDLOOKUP
+        :param descs_eng: English descriptions that may be translated, e.g. from Table.get_descs
+        :param cached: use the data saved by a previous load_data instead of DB if all descs_eng are in it
+        """
+        if cached and self.load_cached_data(descs_eng):
+            return
         table_field_df = self.select_sql(
             selector="[table_id] tb_code, LOWER(REPLACE(desc_eng, '<br>', '')) desc_eng, "
                      "REPLACE (desc_chi, '<br>', '') desc_chi",
@@ -737,29 +1520,65 @@ class Translator(Connection):
             where={'[table_id]': self.tb_code},
             get_df=True
         )
-        table_field_df = table_field_df[['desc_eng', 'desc_chi']].set_index('desc_eng')
+        table_field_df = table_field_df.reindex(columns=['desc_eng', 'desc_chi']).set_index('desc_eng')
         self.table_field_dict = table_field_df.to_dict()['desc_chi']
-        #
-        all_field_df = self.select_sql(
-            replace_sql=(
-                "SELECT desc_eng, desc_chi, COUNT(*) occurrence FROM ("
-                "SELECT LOWER(REPLACE(desc_eng, '<br>', '')) desc_eng, REPLACE(desc_chi, '<br>', '') desc_chi FROM "
-                f"{db_address['reference']}.[TB_FIELDLOOKUP]) AS T GROUP BY desc_eng, desc_chi"
-            ),
-            get_df=True
-        )
-        all_field_df = all_field_df[
-            all_field_df['occurrence'] == all_field_df.groupby('desc_eng', sort=False)['occurrence'].transform('max')
-            ]
-        all_field_df = all_field_df[['desc_eng', 'desc_chi']].set_index('desc_eng')
-        self.all_field_dict = all_field_df.to_dict()['desc_chi']
+        type(self).reference_cache.save(f'TB_FIELDLOOKUP_{self.tb_code}', self.table_field_dict)
+        # only the descriptions not fetched before are sent, and the server returns their most common translation
+        variants = set(chain.from_iterable(
+            type(self).get_variants(desc_eng.lower()) for desc_eng in descs_eng
+        )) - type(self).queried_descs
+        if variants:
+            all_field_df = self.select_sql(
+                replace_sql=(
+                    'WITH [descs] ([desc_eng]) AS (SELECT [desc_eng] FROM (VALUES '
+                    f"{', '.join(f'({self._sql_nstring(variant)})' for variant in sorted(variants))}"
+                    ') AS [V] ([desc_eng])), '
+                    "[T] AS (SELECT LOWER(REPLACE(desc_eng, '<br>', '')) desc_eng, "
+                    "REPLACE(desc_chi, '<br>', '') desc_chi "
+                    f"FROM {db_address['reference']}.[TB_FIELDLOOKUP]), "
+                    '[C] AS (SELECT desc_eng, desc_chi, '
+                    'ROW_NUMBER() OVER (PARTITION BY desc_eng ORDER BY COUNT(*) DESC, desc_chi) occurrence_rank '
+                    'FROM [T] WHERE desc_eng IN (SELECT [desc_eng] FROM [descs]) GROUP BY desc_eng, desc_chi) '
+                    'SELECT desc_eng, desc_chi FROM [C] WHERE occurrence_rank = 1'
+                ),
+                get_df=True
+            )
+            all_field_df = all_field_df.reindex(columns=['desc_eng', 'desc_chi']).set_index('desc_eng')
+            type(self).all_field_cache.update(all_field_df.to_dict()['desc_chi'])
+            type(self).queried_descs |= variants
+            type(self).reference_cache.save(
+                'TB_FIELDLOOKUP', {'dict': type(self).all_field_cache, 'queried': type(self).queried_descs})
+        self.all_field_dict = type(self).all_field_cache
+
+    def load_cached_data(self, descs_eng):
+        """
+        load the data saved by load_data without DB
+        :param descs_eng: English descriptions that may be translated
+        :return: False if the table or any of descs_eng has never been loaded
+        """
+        table_field_dict = type(self).reference_cache.load(f'TB_FIELDLOOKUP_{self.tb_code}')
+        all_field = type(self).reference_cache.load('TB_FIELDLOOKUP')
+        if table_field_dict is None or all_field is None:
+            return False
+        if any(
+                variant not in all_field['queried']
+                for desc_eng in descs_eng for variant in type(self).get_variants(desc_eng.lower())
+        ):
+            return False
+        self.table_field_dict = table_field_dict
+        self.all_field_dict = all_field['dict']
+        return True
+
+    def translate_all(self, descs_eng, is_unit=False):
+        """translate all descs_eng at once, each distinct desc is only looked up once"""
+        return {desc_eng: self.translate(desc_eng, is_unit) for desc_eng in set(descs_eng)}
 
     def translate(self, desc_eng, is_unit=False):
         check = self.all_field_dict if not is_unit else type(self).unit_dict
         if not is_unit:
             desc_eng = desc_eng.lower()
         # if it exists in the list filtered by table code
-        variants = (desc_eng, desc_eng.replace(' (', '('), desc_eng.replace('(', ' ('))
+        variants = type(self).get_variants(desc_eng)
         for variant in variants:
             if variant in check:
                 return check[variant]
@@ -771,6 +1590,11 @@ class Translator(Connection):
 
 
 class Fas(Dict, Connection):
+    reference_cache = ReferenceCache('reference')
+    # number of processes for parsing a table with more than chunk_rows rows in chunks
+    workers = 1
+    chunk_rows = 20000
+
     def __init__(self, tb_code, cdm_df_dict):
         Dict.__init__(self)
         Connection.__init__(self)
@@ -781,33 +1605,92 @@ class Fas(Dict, Connection):
         self.columns = []
         self.data = []
         self.df = None
+        self.obs_df = None
+        self.sd_df = None
 
     def load_columns(self):
         self.columns = [
             [fas_name, f'{fas_name}_footnote']
-            for fas_name in self.all_fas_names() if fas_name != 'undefined'
+            # in the order of CSV so that the query of load_fas_df is the same in every run
+            for fas_name in dict.fromkeys(chain.from_iterable(self.values())) if fas_name != 'undefined'
         ]
 
+    def get_fas_filter_sql(self):
+        """
+        generate a WHERE so that only rows with every CV/SV value described in CSV are transferred,
+        rows failing it are the ones update_footnote_and_parse_fas_df skips as not used in CSV
+        :return: WITH clause of the described values and the WHERE clause, empty strings if nothing to filter
+        """
+        fas_desc = set(self.all_fas_desc())
+        # 'N.A' is replaced as 'N.A.' after loading
+        if 'n.a.' in fas_desc:
+            fas_desc.add('n.a')
+        filter_cols = [
+            col_fas_name for col_fas_name, _ in self.columns
+            if col_fas_name not in self.get('MDT', {})
+        ]
+        if not filter_cols or not fas_desc:
+            return '', ''
+        with_sql = (
+            'WITH [fas_desc] ([desc]) AS (SELECT [desc] FROM (VALUES '
+            f"{', '.join(f'({self._sql_nstring(desc)})' for desc in sorted(fas_desc))}) AS [V] ([desc])) "
+        )
+        where_sql = ' WHERE ' + ' AND '.join(
+            f"([{col}] IS NULL OR [{col}] = '' "
+            f"OR LOWER(REPLACE([{col}], '<br>', '')) IN (SELECT [desc] FROM [fas_desc]))"
+            for col in filter_cols
+        )
+        return with_sql, where_sql
+
+    def probe_fas_table(self):
+        """a cheap check of TABLE{tb_code} on the server, the result changes if any row is changed"""
+        probe_df = self.select_sql(
+            replace_sql=(
+                'SELECT COUNT_BIG(*) [rows], CHECKSUM_AGG(BINARY_CHECKSUM(*)) [checksum] '
+                f"FROM {db_address['reference']}.[TABLE{self.tb_code}]"
+            ),
+            get_df=True
+        )
+        return tuple(probe_df.iloc[0].to_list())
+
     def load_fas_df(self):
+        """read TABLE{tb_code}, from the local snapshot if the probe of the table on the server is unchanged"""
         try:
-            fas_df = self.select_sql(
-                selector=','.join(
-                    chain.from_iterable(
-                        (f"REPLACE([{col_fas_name}], '<br>', '') [{col_fas_name}]", f'[{col_fas_footnote}]')
-                        for col_fas_name, col_fas_footnote in self.columns
-                    )
-                ),
-                addr=f"{db_address['reference']}.[TABLE{self.tb_code}]",
-                get_df=True
+            with_sql, where_sql = self.get_fas_filter_sql()
+            selector = ','.join(
+                chain.from_iterable(
+                    (f"REPLACE([{col_fas_name}], '<br>', '') [{col_fas_name}]", f'[{col_fas_footnote}]')
+                    for col_fas_name, col_fas_footnote in self.columns
+                )
             )
+            sql = f"{with_sql}SELECT {selector} FROM {db_address['reference']}.[TABLE{self.tb_code}]{where_sql}"
+            # read from the local snapshot if TABLE{tb_code} is unchanged since it was taken
+            snapshot = type(self).reference_cache.load(f'TABLE{self.tb_code}_snapshot')
+            if snapshot and snapshot['sql'] != sql:
+                snapshot = None
+            probe = self.probe_fas_table()
+            if snapshot and snapshot['probe'] == probe:
+                fas_df = snapshot['df'].copy()
+            else:
+                fas_df = self.select_sql(replace_sql=sql, get_df=True)
+                type(self).reference_cache.save(
+                    f'TABLE{self.tb_code}_snapshot', {'sql': sql, 'probe': probe, 'df': fas_df})
             fas_df.replace('', np.nan, inplace=True)
             # in case of typos :)
             fas_df.replace('N.A', 'N.A.', inplace=True)
             self.df = fas_df
+            # record the fas names known to exist for validating without DB
+            cached_names = type(self).reference_cache.load(f'TABLE{self.tb_code}_fas_names') or set()
+            type(self).reference_cache.save(
+                f'TABLE{self.tb_code}_fas_names', cached_names | {col_fas_name for col_fas_name, _ in self.columns})
         except pymssql.ProgrammingError:
             print('Database does not have an fas listed in CSV! Error!')
             sys.exit(1)
 
+    def get_cached_fas_names(self):
+        """fas names of TABLE{tb_code} known from previous runs, None if the table has never been loaded"""
+        return type(self).reference_cache.load(f'TABLE{self.tb_code}_fas_names')
+
     def parse_csv_dict(self):
         for field, field_df in self.cdm_df_dict.items():
             self[field] = {}
@@ -844,8 +1727,56 @@ class Fas(Dict, Connection):
             for desc in item
         ]
 
-    def update_footnote_and_parse_fas_df(self):
-        for i, row in self.df.iterrows():
+    def parse_mdt_values(self):
+        """
+        parse the MDT value columns as whole arrays, non-numeric values are SD symbols
+        :return: DataFrame of the values stripped of spaces and commas, bool DataFrame of SD symbols
+        """
+        mdt_cols = [sp_fas for sp_fas in self.get('MDT', {}) if sp_fas in self.df]
+        value_df = self.df[mdt_cols].astype(object).replace(r'[ ,]', '', regex=True)
+        obs_df = value_df.apply(pd.to_numeric, errors='coerce').astype('float64')
+        symbol_df = value_df.notna() & obs_df.isna()
+        # new symbols are collected in one pass and allocated together by insert_sd
+        for symbol in pd.unique(value_df.to_numpy()[symbol_df.to_numpy()]):
+            if symbol not in self.sd:
+                self.sd.add_sd(symbol, self.footnote[symbol]['NOTE_ENG'], self.footnote[symbol]['NOTE_CHI'])
+        self.obs_df = obs_df.mask(symbol_df, 0)
+        return value_df, symbol_df
+
+    def map_sd_values(self, value_df, symbol_df):
+        """map SD symbols to sd_value, other values use the sd_value of their MDT footnote"""
+        sd_values = self.sd.get_values()
+        sd_df = pd.DataFrame({
+            sp_fas: value_df[sp_fas].where(symbol_df[sp_fas]).map(sd_values).fillna(
+                value_df[sp_fas].where(~symbol_df[sp_fas]).map(self['MDT'][sp_fas]))
+            for sp_fas in value_df
+        }, index=value_df.index)
+        self.sd_df = sd_df.fillna(0).astype('int64')
+
+    def lookup_copy(self):
+        """a copy without the FAS DataFrames for parsing chunks in other processes"""
+        fas = copy.copy(self)
+        fas.df = None
+        fas.obs_df = None
+        fas.sd_df = None
+        fas.data = []
+        return fas
+
+    def parse_fas_rows(self, fas_df):
+        """
+        parse rows of the FAS DataFrame, self is only read so that chunks of rows can be parsed in parallel
+        :param fas_df: rows of self.df
+        :return: list of mdt_dict, list of their row index, list of args of update_footnote,
+        list of (fas name, desc, sd_value) of MDT footnotes, list of args of add_sd
+        """
+        all_fas_names = self.all_fas_names()
+        all_fas_desc = set(self.all_fas_desc())
+        data = []
+        mdt_rows = []
+        footnotes = []
+        mdt_footnotes = []
+        sd_footnotes = []
+        for i, row in fas_df.iterrows():
             row.dropna(inplace=True)
             for col_fas_name, col_fas_footnote in self.columns:
                 if col_fas_name in row and col_fas_footnote in row:
@@ -858,45 +1789,28 @@ class Fas(Dict, Connection):
                                 for note_no, note in enumerate(notes, start=1):
                                     if field == 'MDT':
                                         if note in self.footnote:
-                                            self[field][col_fas_name][desc.lower()] = self.sd[note]
+                                            mdt_footnotes.append((col_fas_name, desc.lower(), self.sd[note]))
                                         else:
-                                            self.sd.update_sd(note, self.footnote[note]['NOTE_ENG'],
-                                                              self.footnote[note]['NOTE_CHI'])
+                                            sd_footnotes.append((note, self.footnote[note]['NOTE_ENG'],
+                                                                 self.footnote[note]['NOTE_CHI']))
                                     else:
                                         if note in self.footnote:
-                                            self.update_footnote(field, col_fas_name, desc, note_no,
-                                                                 self.footnote[note]['NOTE_ENG'],
-                                                                 self.footnote[note]['NOTE_CHI'])
-            #
-            for sp_fas in self['MDT'].keys():
-                if sp_fas in row:
-                    row[sp_fas] = row[sp_fas].replace(' ', '').replace(',', '')
-                    value = row[sp_fas]
-                    try:
-                        float(value)
-                    except ValueError:
-                        if value not in self.sd.keys():
-                            self.sd.update_sd(value,
-                                              self.footnote[value]['NOTE_ENG'], self.footnote[value]['NOTE_CHI'])
+                                            footnotes.append((field, col_fas_name, desc, note_no,
+                                                              self.footnote[note]['NOTE_ENG'],
+                                                              self.footnote[note]['NOTE_CHI']))
             #
             row = row[~row.index.str.endswith('footnote')]
             mdt_dict = {'CV': {}, 'SV': {}, 'MDT': {}}
             insert = True
             for fas_name, value in row.items():
-                if fas_name in self.all_fas_names():
-                    if value.lower() in self.all_fas_desc() or fas_name in self['MDT']:
+                if fas_name in all_fas_names:
+                    if fas_name in self['MDT']:
+                        # filled by obs_df and sd_df after insert_sd
+                        mdt_dict['MDT'][fas_name] = {}
+                    elif value.lower() in all_fas_desc:
                         for field, fas_names in self:
-                            if fas_name in fas_names:
-                                if field == 'MDT':
-                                    mdt_dict[field][fas_name] = {}
-                                    try:
-                                        mdt_dict[field][fas_name]['obs_value'] = float(value)
-                                        mdt_dict[field][fas_name]['sd_value'] = self['MDT'][fas_name].get(value, 0)
-                                    except ValueError:
-                                        mdt_dict[field][fas_name]['obs_value'] = 0
-                                        mdt_dict[field][fas_name]['sd_value'] = self.sd[value]
-                                elif value.lower() in fas_names[fas_name]:
-                                    mdt_dict[field][fas_name] = value
+                            if fas_name in fas_names and value.lower() in fas_names[fas_name]:
+                                mdt_dict[field][fas_name] = value
                     else:
                         print(f'fas desc - {value} from TABLE{self.tb_code} is not used in CSV')
                         insert = False
@@ -907,50 +1821,119 @@ class Fas(Dict, Connection):
                 print('CV is empty for a row, skipped')
                 insert = False
             if insert:
-                self.data.append(mdt_dict)
+                data.append(mdt_dict)
+                mdt_rows.append(i)
+        return data, mdt_rows, footnotes, mdt_footnotes, sd_footnotes
+
+    def update_footnote_and_parse_fas_df(self, insert_sd=True):
+        """
+        parse self.df into self.data, a large table is parsed in chunks of rows in parallel,
+        the footnotes found in the chunks are updated afterwards in the order of rows
+        :param insert_sd: allocate sd_value of the new symbols in DB, otherwise they keep a provisional sd_value
+        """
+        value_df, symbol_df = self.parse_mdt_values()
+        chunk_rows = type(self).chunk_rows
+        chunks = [self.df.iloc[i:i + chunk_rows] for i in range(0, len(self.df), chunk_rows)]
+        owner = self if len(chunks) <= 1 else self.lookup_copy()
+        mdt_rows = []
+        for data, rows, footnotes, mdt_footnotes, sd_footnotes in map_chunks(
+                type(self).parse_fas_rows, owner, chunks, type(self).workers):
+            self.data.extend(data)
+            mdt_rows.extend(rows)
+            for footnote in footnotes:
+                self.update_footnote(*footnote)
+            for fas_name, desc, sd_value in mdt_footnotes:
+                self['MDT'][fas_name][desc] = sd_value
+            for sd_footnote in sd_footnotes:
+                self.sd.add_sd(*sd_footnote)
+        # allocate sd_value for all new symbols of this table at once
+        if insert_sd:
+            self.sd.insert_sd()
+        self.map_sd_values(value_df, symbol_df)
+        for i, mdt_dict in zip(mdt_rows, self.data):
+            for sp_fas, value_dict in mdt_dict['MDT'].items():
+                value_dict['obs_value'] = float(self.obs_df.at[i, sp_fas])
+                value_dict['sd_value'] = int(self.sd_df.at[i, sp_fas])
 
 
 class SD(Dict, Connection):
+    df_cols = ['sd_value', 'sd_symbol', 'sd_desc_eng', 'sd_desc_chi', 'sd_suppressed']
+    df_cols_sql = ', '.join(f'[{col}]' for col in df_cols)
+    reference_cache = ReferenceCache('reference')
+
     def __init__(self):
         Dict.__init__(self)
         Connection.__init__(self)
         self.df = None
+        self.pending = {}
 
-    def load_sd(self):
-        df = self.select_sql(
-            selector='*',
-            addr=f"{db_address['insert']}.[SD]",
-            get_df=True
-        )
-        self.df = df[['sd_value', 'sd_symbol', 'sd_desc_eng', 'sd_desc_chi', 'sd_suppressed']]
+    def load_sd(self, cached=False):
+        """
+        :param cached: use SD saved by a previous load_sd instead of DB if there is one
+        """
+        df = type(self).reference_cache.load('SD') if cached else None
+        if df is None:
+            df = self.select_sql(
+                selector='*',
+                addr=f"{db_address['insert']}.[SD]",
+                get_df=True
+            )
+            type(self).reference_cache.save('SD', df)
+        self.df = df[type(self).df_cols]
         self.update(df[['sd_value', 'sd_symbol']].set_index('sd_symbol')['sd_value'].to_dict())
 
-    def update_sd(self, sd_footnote, sd_footnote_desc, sd_footnote_desc_tc, suppressed=False):
-        sd_value = max(x for x in self.values() if x < 90) + 1
-        insert = {
-            '[sd_value]': sd_value,
-            '[sd_symbol]': sd_footnote,
-            '[sd_desc_eng]': sd_footnote_desc,
-            '[sd_desc_chi]': sd_footnote_desc_tc
-        }
-        if suppressed:
-            insert.update({'[sd_suppressed]': 1})
-        self.insert_sql(
-            addr=f"{db_address['insert']}.[SD]",
-            insert=insert
+    def add_sd(self, sd_footnote, sd_footnote_desc, sd_footnote_desc_tc, suppressed=False):
+        """collect a new symbol, its sd_value is allocated when insert_sd is called"""
+        if sd_footnote not in self and sd_footnote not in self.pending:
+            self.pending[sd_footnote] = {
+                '[sd_symbol]': sd_footnote,
+                '[sd_desc_eng]': sd_footnote_desc,
+                '[sd_desc_chi]': sd_footnote_desc_tc,
+                '[sd_suppressed]': 1 if suppressed else None
+            }
+
+    def get_values(self):
+        """sd_value of all symbols, the symbols not inserted yet get -1, -2, ... in the order they are added"""
+        values = dict(self.dict)
+        values.update({symbol: -seq for seq, symbol in enumerate(self.pending, start=1)})
+        return values
+
+    def insert_sd(self):
+        """
+        allocate sd_value for all collected symbols and insert them in one batch,
+        MAX(sd_value) is read under an update lock so that concurrent loaders never get the same sd_value,
+        a symbol inserted by another loader in the meantime is reused
+        """
+        if not self.pending:
+            return
+        addr = f"{db_address['insert']}.[SD]"
+        cols = ['[sd_symbol]', '[sd_desc_eng]', '[sd_desc_chi]']
+        if any(insert['[sd_suppressed]'] for insert in self.pending.values()):
+            cols.append('[sd_suppressed]')
+        values = ', '.join(
+            f"({seq}, {', '.join('NULL' if insert[col] is None else self._sql_string(insert[col]) for col in cols)})"
+            for seq, insert in enumerate(self.pending.values(), start=1)
         )
-        self.load_sd()
+        symbols = ', '.join(self._sql_string(symbol) for symbol in self.pending)
+        df = self.transaction_sql(
+            f'DECLARE @sd_value INT = (SELECT ISNULL(MAX([sd_value]), 0) FROM {addr} WITH (UPDLOCK, HOLDLOCK) '
+            'WHERE [sd_value] < 90); '
+            f"INSERT INTO {addr} ([sd_value], {', '.join(cols)}) "
+            f"SELECT @sd_value + ROW_NUMBER() OVER (ORDER BY [V].[seq]), {', '.join(f'[V].{col}' for col in cols)} "
+            f"FROM (VALUES {values}) AS [V] ([seq], {', '.join(cols)}) "
+            f'WHERE NOT EXISTS (SELECT 1 FROM {addr} WHERE [sd_symbol] = [V].[sd_symbol]);',
+            f'SELECT {self.df_cols_sql} FROM {addr} WHERE [sd_symbol] IN ({symbols})',
+            get_df=True
+        )[type(self).df_cols]
+        self.df = pd.concat([self.df, df[~df['sd_symbol'].isin(self.df['sd_symbol'])]], ignore_index=True)
+        self.update(df.set_index('sd_symbol')['sd_value'].to_dict())
+        self.pending = {}
 
 
 class Footnote(Dict, Connection):
-    try:
-        unused_note_dict = {
-            tb_code: note['NOTE'].to_list()
-            for tb_code, note in pd.read_csv('config\\table_info.csv', dtype=str).groupby('Table')
-        }
-    except FileNotFoundError:
-        print('table_info.csv is not found in config!')
-        sys.exit(1)
+    unused_note_dict = LazyDict(lambda: config_groups('table_info.csv', 'Table', 'NOTE'))
+    prefetched_dict = {}
+    reference_cache = ReferenceCache('reference')
 
     def __init__(self, tb_code):
         Dict.__init__(self)
@@ -959,43 +1942,75 @@ class Footnote(Dict, Connection):
         self.info_footnotes_df = None
         self.table_info_note_list = type(self).unused_note_dict.get(self.tb_code, [])
 
-    def load_footnote(self):
-        def filter_footnotes(note_type):
-            """
-            process a list and check if NOTE_TYPE of this item and the next two items are 1, 2, 3
-            :param note_type: a NOTE_TYPE item object
-            :return: return an index list of rows that should be removed
-            """
-            remove_list = []
-            count_list = []
-            while True:
-                try:
-                    count_list.append(next(note_type))
-                    if len(count_list) == 3:
-                        if all(count_list[__i][1] == __i + 1 for __i in range(3)):
-                            #
-                            remove_list.extend(count_list[1:])
-                            count_list = []
-                        else:
-                            # remove the first item in order to load a new item
-                            del count_list[0]
-                except StopIteration:
-                    break
-            return [row_index for row_index, note_type in remove_list]
-        #
-        footnotes_df = self.select_sql(
-            selector='[NOTE_NO], [NOTE], [NOTE_ENG], [NOTE_CHI], [NOTE_TYPE]',
+    @staticmethod
+    def filter_footnotes(footnotes_df):
+        """
+        check in each table if NOTE_TYPE of a row and the next two rows(NOTE_TYPE 0 is skipped) are 1, 2, 3
+        :param footnotes_df: TB_FOOTNOTE rows sorted by TABLE_ID and NOTE_NO
+        :return: return footnotes_df without the second and third rows of every 1, 2, 3 triplet
+        """
+        note_type = footnotes_df.loc[footnotes_df['NOTE_TYPE'] != 0, ['TABLE_ID', 'NOTE_TYPE']]
+        table_id = note_type['TABLE_ID']
+        shifted = note_type.groupby(table_id, sort=False)['NOTE_TYPE']
+        # triplets cannot overlap since a triplet must start with 1
+        triplet = (note_type['NOTE_TYPE'] == 1) & (shifted.shift(-1) == 2) & (shifted.shift(-2) == 3)
+        shifted = triplet.groupby(table_id, sort=False)
+        remove = shifted.shift(1, fill_value=False) | shifted.shift(2, fill_value=False)
+        return footnotes_df.drop(remove.index[remove])
+
+    @classmethod
+    def query_footnotes(cls, tb_codes):
+        """
+        get TB_FOOTNOTE of all tb_codes in one query
+        :param tb_codes: list of table codes
+        :return: dictionary of tb_code: filtered footnotes DataFrame
+        """
+        tb_codes = sorted(set(tb_codes))
+        cols = ['TABLE_ID', 'NOTE_NO', 'NOTE', 'NOTE_ENG', 'NOTE_CHI', 'NOTE_TYPE']
+        footnotes_df = Connection().select_sql(
+            selector=', '.join(f'[{col}]' for col in cols),
             addr=f"{db_address['reference']}.[TB_FOOTNOTE]",
-            where={
-                '[TABLE_ID]': self.tb_code
-            },
             get_df=True,
-            addition=' AND [NOTE_TYPE] < 4 ORDER BY [NOTE_NO]'
-        )
+            addition=(
+                f" WHERE [TABLE_ID] IN ({', '.join(Connection._sql_string(tb_code) for tb_code in tb_codes)})"
+                " AND [NOTE_TYPE] < 4 ORDER BY [TABLE_ID], [NOTE_NO]"
+            )
+        ).reindex(columns=cols)
         footnotes_df = footnotes_df.astype({'NOTE_NO': 'int32', 'NOTE_TYPE': 'int32'})
-        footnotes_filter = filter_footnotes(
-            footnotes_df[footnotes_df['NOTE_TYPE'] != 0]['NOTE_TYPE'].items())
-        footnotes_df.drop(footnotes_filter, inplace=True)
+        # TABLE_ID may come back as a number
+        footnotes_df['TABLE_ID'] = footnotes_df['TABLE_ID'].astype(str).str.zfill(3)
+        footnotes_df = cls.filter_footnotes(footnotes_df)
+        footnotes_dict = {
+            tb_code: tb_footnotes_df.drop(columns='TABLE_ID').reset_index(drop=True)
+            for tb_code, tb_footnotes_df in footnotes_df.groupby('TABLE_ID', sort=False)
+        }
+        for tb_code in tb_codes:
+            if tb_code not in footnotes_dict:
+                footnotes_dict[tb_code] = footnotes_df.drop(columns='TABLE_ID').iloc[:0]
+            cls.reference_cache.save(f'TB_FOOTNOTE_{tb_code}', footnotes_dict[tb_code])
+        return footnotes_dict
+
+    @classmethod
+    def prefetch(cls, tb_codes):
+        """prefetch the footnotes of all tables in a folder so that load_footnote does not query per table"""
+        if tb_codes:
+            cls.prefetched_dict.update(cls.query_footnotes(tb_codes))
+
+    @classmethod
+    def clear_prefetched(cls):
+        cls.prefetched_dict = {}
+
+    def load_footnote(self, cached=False):
+        """
+        :param cached: use the footnotes saved by a previous query instead of DB if there are
+        """
+        footnotes_df = type(self).prefetched_dict.get(self.tb_code)
+        if footnotes_df is None and cached:
+            footnotes_df = type(self).reference_cache.load(f'TB_FOOTNOTE_{self.tb_code}')
+        if footnotes_df is None:
+            footnotes_df = type(self).query_footnotes([self.tb_code])[self.tb_code]
+        else:
+            footnotes_df = footnotes_df.copy()
         footnotes_df.drop_duplicates(['NOTE_CHI', 'NOTE_ENG'], inplace=True)
         footnotes_df.reset_index(drop=True, inplace=True)
         #
@@ -1037,3 +2052,550 @@ class Footnote(Dict, Connection):
             if __i is not int(fn_df.index[-1]):
                 txt += '\n'
         return header + txt if txt else ''
+
+
+# a reference of a row of LoadPlan to the id of a row of another table by its natural key
+Ref = namedtuple('Ref', ['table_name', 'key'])
+
+
+class LoadPlan:
+    """
+    the rows of every target table parsed from an input file before any DB write, e.g. by plan_table in main.py,
+    the rows are kept per table by natural key and refer to the ids of other tables by Ref,
+    MDT rows by the codes of CC, SP and SV in mdt_keys, so that a plan can be made without DB contention
+    and applied later with a statement per table
+    """
+    folder = 'plan'
+    # the tables in the order of writing, a table only refers to the ids of the tables before it
+    table_names = [
+        'TB_INFO', 'THEME', 'CV', 'CV_TB', 'CCG', 'CC', 'CCG_CC', 'CC_TB', 'PAC', 'SP', 'SP_TB', 'SV', 'SV_TB',
+        'TB_COMP'
+    ]
+    # the tables of a level only refer to the ids of the levels before, so they are written concurrently
+    write_levels = [
+        ['TB_INFO', 'THEME'], ['CV', 'SP'], ['CV_TB', 'CCG', 'CC', 'SP_TB', 'SV'],
+        ['CCG_CC', 'CC_TB', 'PAC', 'SV_TB', 'TB_COMP']
+    ]
+    # the id of each table
+    id_cols = {
+        'THEME': '[theme_id]', 'TB_INFO': '[tb_id]', 'CV': '[cv_id]', 'CCG': '[ccg_id]', 'CC': '[cc_id]',
+        'SP': '[sp_id]', 'SV': '[sv_id]', 'MDT': '[mdt_id]'
+    }
+    # the natural key of each table, an existing row with the same key is not written again, all columns if not given
+    key_cols = {
+        'TB_INFO': ['[tb_code]'],
+        'THEME': ['[theme]'],
+        'CV': ['[class_var]', '[theme_id]'],
+        'CV_TB': ['[tb_id]', '[cv_id]'],
+        'CC': ['[cv_id]', '[class_code]'],
+        'CCG_CC': ['[ccg_id]', '[cc_id]'],
+        'CC_TB': ['[cc_id]', '[tb_id]'],
+        'SP': ['[stat_pres]', '[def_stat_pres_desc_en]', '[def_stat_pres_desc_tc]', '[theme_id]'],
+        'SP_TB': ['[sp_id]', '[tb_id]'],
+        'SV': ['[theme_id]', '[stat_var]'],
+        'SV_TB': ['[sv_id]', '[tb_id]']
+    }
+    # columns of the output DataFrames after the columns of the rows, set later or filled by footnotes
+    fn_cols = list(chain.from_iterable([[f'[fn{i}_en]', f'[fn{i}_tc]'] for i in range(1, 6)]))
+    df_cols = {
+        'THEME': [f'[cv{i}_id]' for i in range(1, 21)],
+        'CV_TB': fn_cols,
+        'CC_TB': fn_cols,
+        'PAC': ['[parent_ccg_id]', '[parent_cc_id]', '[child_ccg_id]', '[child_cc_id]'],
+        'SP_TB': fn_cols,
+        'SV_TB': fn_cols
+    }
+
+    def __init__(self, path, theme_code, table, sd):
+        self.path = path
+        self.file_key = FileCache.file_key(path)
+        self.theme_code = theme_code
+        self.tb_code = table.code
+        # table name: {natural key: row}
+        self.rows = {table_name: {} for table_name in type(self).table_names}
+        # Ref of the rows by code for MDT
+        self.theme_ref = None
+        self.cv_refs = {}
+        self.cc_refs = {}
+        self.sp_refs = {}
+        self.sv_refs = {}
+        self.mdt_keys = table.mdt_keys
+        self.add_rows(table)
+        # new symbols in the order of their provisional sd_value
+        self.sd_pending = dict(sd.pending)
+        # SD read while planning, it is not saved
+        self.sd = sd
+
+    def __getstate__(self):
+        return {**self.__dict__, 'sd': None}
+
+    def __str__(self):
+        return f'In {self.tb_code}, there is/are ' + ', '.join(
+            f'{len(rows)} {table_name}' for table_name, rows in self.rows.items()) + f', {len(self.mdt_keys)} MDT.'
+
+    def get_path(self):
+        return os.path.join(type(self).folder, f'{self.theme_code}_{self.tb_code}.pickle')
+
+    def is_current(self):
+        """check if the input file is unchanged since planning"""
+        try:
+            return FileCache.file_key(self.path) == self.file_key
+        except OSError:
+            return False
+
+    def add(self, table_name, row):
+        """
+        add a row if its natural key is new, only the first row of a key is written
+        :return: Ref of the row
+        """
+        key = tuple(row[col] for col in type(self).key_cols.get(table_name) or row)
+        self.rows[table_name].setdefault(key, row)
+        return Ref(table_name, key)
+
+    def add_rows(self, table):
+        """add the rows of all tables from the CV/SP models of table in the order of writing"""
+        theme = Theme(self.theme_code)
+        tb_ref = self.add('TB_INFO', {
+            '[tb_code]': table.code,
+            '[tb_title_en]': table.title,
+            '[tb_title_tc]': table.title_tc,
+            '[tb_fn_en]': table.fn,
+            '[tb_fn_tc]': table.fn_tc,
+            '[tb_src_en]': table.src,
+            '[tb_src_tc]': table.src_tc
+        })
+        self.theme_ref = self.add('THEME', {
+            '[theme]': theme.code,
+            '[theme_desc_en]': theme.desc,
+            '[theme_desc_tc]': theme.desc_tc
+        })
+        ccg_refs = {}
+        for cv_code, cv in table.cv_cc:
+            cv_ref = self.cv_refs[cv_code] = self.add('CV', {
+                '[theme_id]': self.theme_ref,
+                '[class_var]': cv_code,
+                '[def_class_desc_en]': cv.desc,
+                '[def_class_desc_tc]': cv.desc_tc
+            })
+            self.add('CV_TB', {
+                '[cv_id]': cv_ref,
+                '[tb_id]': tb_ref,
+                '[class_desc_en]': cv.get_tb_desc(),
+                '[class_desc_tc]': cv.get_tb_desc(tc=True)
+            })
+            for cc_code, cc in cv:
+                ccg_ref = ccg_refs[cv_code, cc_code] = self.add('CCG', {
+                    '[cv_id]': cv_ref,
+                    '[class_code_group]': cc.ccg
+                })
+                cc_ref = self.cc_refs[cv_code, cc_code] = self.add('CC', {
+                    '[cv_id]': cv_ref,
+                    '[class_code]': cc_code,
+                    '[def_class_code_desc_en]': cc.desc,
+                    '[def_class_code_desc_tc]': cc.desc_tc
+                })
+                self.add('CCG_CC', {
+                    '[ccg_id]': ccg_ref,
+                    '[cc_id]': cc_ref,
+                    '[cv_id]': cv_ref,
+                    '[class_code_seq]': cc.seq
+                })
+                self.add('CC_TB', {
+                    '[cc_id]': cc_ref,
+                    '[tb_id]': tb_ref,
+                    '[class_code_desc_en]': cc.get_tb_desc(),
+                    '[class_code_desc_tc]': cc.get_tb_desc(tc=True),
+                    '[ccg_id]': ccg_ref,
+                    **cc.footnote
+                })
+            for cc_code, cc in cv:
+                if cc.parent_cc_code:
+                    self.add('PAC', {
+                        '[parent_ccg_id]': ccg_refs[cv_code, cc.parent_cc_code],
+                        '[parent_cc_id]': self.cc_refs[cv_code, cc.parent_cc_code],
+                        '[child_ccg_id]': ccg_refs[cv_code, cc_code],
+                        '[child_cc_id]': self.cc_refs[cv_code, cc_code]
+                    })
+        for sp_code, sp in table.sp_sv:
+            sp_ref = self.sp_refs[sp_code] = self.add('SP', {
+                '[stat_pres]': sp_code,
+                '[theme_id]': self.theme_ref,
+                '[def_stat_pres_desc_en]': sp.desc,
+                '[def_stat_pres_desc_tc]': sp.desc_tc,
+                '[def_stat_type]': sp.type,
+                '[def_unit]': sp.unit,
+                '[def_unit_desc_en]': sp.unit_desc,
+                '[def_unit_desc_tc]': sp.unit_desc_tc,
+                '[def_decimals]': sp.dec,
+                '[def_unit_mult]': sp.multi,
+                '[def_separator_format]': sp.sep
+            })
+            self.add('SP_TB', {
+                '[sp_id]': sp_ref,
+                '[tb_id]': tb_ref,
+                '[stat_pres_desc_en]': sp.get_tb_desc(),
+                '[stat_pres_desc_tc]': sp.get_tb_desc(tc=True),
+                '[stat_type]': sp.type,
+                '[unit]': sp.unit,
+                '[unit_desc_en]': sp.unit_desc,
+                '[unit_desc_tc]': sp.unit_desc_tc,
+                '[decimals]': sp.dec,
+                '[unit_mult]': sp.multi,
+                '[separator_format]': sp.sep,
+                **sp.footnote
+            })
+            for sv_code, sv in sp:
+                sv_ref = self.sv_refs[sp_code, sv_code] = self.add('SV', {
+                    '[theme_id]': self.theme_ref,
+                    '[stat_var]': sv_code,
+                    '[def_stat_desc_en]': sv.desc,
+                    '[def_stat_desc_tc]': sv.desc_tc
+                })
+                self.add('SV_TB', {
+                    '[sv_id]': sv_ref,
+                    '[tb_id]': tb_ref,
+                    '[stat_desc_en]': sv.get_tb_desc(),
+                    '[stat_desc_tc]': sv.get_tb_desc(tc=True),
+                    **sv.footnote
+                })
+        # SV and SP used
+        for (sp_code, sv_code), sv_ref in self.sv_refs.items():
+            self.add('TB_COMP', {'[tb_id]': tb_ref, '[sv_id]': sv_ref, '[sp_id]': self.sp_refs[sp_code]})
+        # CCG used
+        for ccg_ref in ccg_refs.values():
+            self.add('TB_COMP', {'[tb_id]': tb_ref, '[ccg_id]': ccg_ref})
+
+    def resolve(self, table_name, ids):
+        """
+        :param ids: dictionary of Ref: id of the rows written so far
+        :return: list of the rows of table_name with the ids of their Ref
+        """
+        return [
+            {col: ids[value] if isinstance(value, Ref) else value for col, value in row.items()}
+            for row in self.rows[table_name].values()
+        ]
+
+    def get_refs(self, table_name):
+        return [Ref(table_name, key) for key in self.rows[table_name]]
+
+    def get_mdt_rows(self, ids, theme, sd_values=None):
+        """
+        build the MDT rows of mdt_keys with the ids
+        :param ids: dictionary of Ref: id of all tables
+        :param theme: Theme with its cv?_id slots
+        :param sd_values: dictionary of provisional sd_value: allocated sd_value, e.g. from get_sd_values
+        :return: list of MDT rows
+        """
+        sd_values = sd_values or {}
+        cv_cc_cols = {}
+        for cv_code, cv_ref in self.cv_refs.items():
+            cv_pos = int(re.search(r'\d+', theme[ids[cv_ref]]).group(0))
+            cv_cc_cols[cv_code] = f'[cv{cv_pos}_cc_id]'
+        theme_id = ids[self.theme_ref]
+        mdt_rows = []
+        for cvs, sp_code, sv_code, obs_value, sd_value in self.mdt_keys:
+            insert_dict = {
+                '[theme_id]': theme_id,
+                '[sv_id]': ids[self.sv_refs[sp_code, sv_code]],
+                '[sp_id]': ids[self.sp_refs[sp_code]],
+                '[obs_value]': obs_value,
+                '[sd_value]': sd_values.get(sd_value, sd_value)
+            }
+            for cv_code, cc_code in cvs:
+                insert_dict[cv_cc_cols[cv_code]] = ids[self.cc_refs[cv_code, cc_code]]
+            mdt_rows.append(insert_dict)
+        return mdt_rows
+
+    def get_sd_values(self, sd):
+        """provisional sd_value: sd_value allocated in sd after insert_sd"""
+        return {-seq: sd[symbol] for seq, symbol in enumerate(self.sd_pending, start=1)}
+
+    def save(self):
+        """save to plan folder"""
+        path = self.get_path()
+        with atomic_write(path) as temp_path, open(temp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return path
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+class BulkExport:
+    """
+    Rows of all target tables of plans with ids assigned locally, written as CSV files with a script of BULK INSERT,
+    for loading whole themes at once instead of writing them to DB with Converter.merge_rows
+    """
+    folder = 'bulk'
+    table_names = [
+        'THEME', 'TB_INFO', 'SD', 'CV', 'CV_TB', 'CCG', 'CC', 'CCG_CC', 'CC_TB', 'PAC', 'SP', 'SP_TB', 'SV', 'SV_TB',
+        'MDT', 'TB_COMP'
+    ]
+    # the id of each table, assigned from 1 and shifted by the offset of the table when saved
+    id_cols = LoadPlan.id_cols
+    # the natural key of each table, load.sql fails if a target table already has a row with a key of the files,
+    # all columns but the id if not given
+    key_cols = {**LoadPlan.key_cols, 'SD': ['[sd_symbol]']}
+    # the columns of each table referring to an id of a table
+    id_refs = {
+        'THEME': {'[theme_id]': 'THEME', **{f'[cv{i}_id]': 'CV' for i in range(1, 21)}},
+        'TB_INFO': {'[tb_id]': 'TB_INFO'},
+        'SD': {},
+        'CV': {'[cv_id]': 'CV', '[theme_id]': 'THEME'},
+        'CV_TB': {'[cv_id]': 'CV', '[tb_id]': 'TB_INFO'},
+        'CCG': {'[ccg_id]': 'CCG', '[cv_id]': 'CV'},
+        'CC': {'[cc_id]': 'CC', '[cv_id]': 'CV'},
+        'CCG_CC': {'[ccg_id]': 'CCG', '[cc_id]': 'CC', '[cv_id]': 'CV'},
+        'CC_TB': {'[cc_id]': 'CC', '[tb_id]': 'TB_INFO', '[ccg_id]': 'CCG'},
+        'PAC': {'[parent_ccg_id]': 'CCG', '[parent_cc_id]': 'CC', '[child_ccg_id]': 'CCG', '[child_cc_id]': 'CC'},
+        'SP': {'[sp_id]': 'SP', '[theme_id]': 'THEME'},
+        'SP_TB': {'[sp_id]': 'SP', '[tb_id]': 'TB_INFO'},
+        'SV': {'[sv_id]': 'SV', '[theme_id]': 'THEME'},
+        'SV_TB': {'[sv_id]': 'SV', '[tb_id]': 'TB_INFO'},
+        'MDT': {
+            '[mdt_id]': 'MDT', '[theme_id]': 'THEME', '[sv_id]': 'SV', '[sp_id]': 'SP',
+            **{f'[cv{i}_cc_id]': 'CC' for i in range(1, 21)}
+        },
+        'TB_COMP': {'[tb_id]': 'TB_INFO', '[sv_id]': 'SV', '[sp_id]': 'SP', '[ccg_id]': 'CCG'}
+    }
+
+    def __init__(self, sd):
+        """
+        :param sd: SD with the existing symbols, the new symbols of plans are given the next sd_value
+        """
+        self.sd = sd
+        # table name: {natural key: row}, a row is only added once per natural key like LoadPlan
+        self.rows = {table_name: {} for table_name in type(self).table_names}
+        self.themes = {}
+
+    def add(self, table_name, key, row):
+        """
+        add a row if its natural key is new, the id of the table is assigned to a new row
+        :return: the id of the row
+        """
+        rows = self.rows[table_name]
+        if key not in rows:
+            id_col = type(self).id_cols.get(table_name)
+            rows[key] = {id_col: len(rows) + 1, **row} if id_col else row
+        return rows[key].get(type(self).id_cols.get(table_name))
+
+    def get_theme(self, theme_code):
+        """Theme of theme_code with its id and the cv?_id slots assigned so far"""
+        if theme_code not in self.themes:
+            theme = Theme(theme_code)
+            theme.id = self.add('THEME', theme_code, {
+                '[theme]': theme.code,
+                '[theme_desc_en]': theme.desc,
+                '[theme_desc_tc]': theme.desc_tc
+            })
+            self.themes[theme_code] = theme
+        return self.themes[theme_code]
+
+    def add_sd(self, plan):
+        """give the new symbols of plan the next sd_value below 90 like SD.insert_sd"""
+        for symbol, insert in plan.sd_pending.items():
+            if symbol not in self.sd:
+                used = [sd_value for sd_value in self.sd.values() if sd_value < 90]
+                self.sd[symbol] = max(used, default=0) + 1
+                self.add('SD', symbol, {'[sd_value]': self.sd[symbol], **insert})
+
+    def add_plan(self, plan):
+        """add all rows of a plan in the order of apply_plan in main.py, the ids of plan are the local ids"""
+        theme = self.get_theme(plan.theme_code)
+        self.add_sd(plan)
+        ids = {plan.theme_ref: theme.id}
+        for table_name in LoadPlan.table_names:
+            if table_name in ('THEME', 'TB_COMP'):
+                continue
+            key_cols = LoadPlan.key_cols.get(table_name)
+            for ref, row in zip(plan.get_refs(table_name), plan.resolve(table_name, ids)):
+                ids[ref] = self.add(table_name, tuple(row[col] for col in key_cols or row), row)
+            if table_name == 'PAC':
+                self.add_slots(theme, [ids[cv_ref] for cv_ref in plan.cv_refs.values()])
+        # an MDT row is matched on all its columns like Converter.merge_rows, so repeated rows are written once
+        for insert_dict in plan.get_mdt_rows(ids, theme, plan.get_sd_values(self.sd)):
+            self.add('MDT', tuple(sorted(insert_dict.items())), insert_dict)
+        for row in plan.resolve('TB_COMP', ids):
+            self.add('TB_COMP', tuple(row.values()), row)
+
+    def add_slots(self, theme, cv_ids):
+        """the next free cv?_id slots of THEME like Theme.insert_cv_ids, the export fails if there are not enough"""
+        theme_row = self.rows['THEME'][theme.code]
+        for cv_id in cv_ids:
+            if cv_id not in theme:
+                free_cols = [col for col in Theme.slot_cols if f'[{col}]' not in theme_row]
+                if not free_cols:
+                    print(f'THEME {theme.code} does not have a free cv?_id for cv_id {cv_id}, '
+                          f'all {len(Theme.slot_cols)} are used! Export is failed.')
+                    sys.exit(1)
+                theme[cv_id] = free_cols[0]
+                theme_row[f'[{free_cols[0]}]'] = cv_id
+
+    def reserve_offsets(self):
+        """reserve a block of ids per table from IdAllocator, so that the ids never clash with other loaders"""
+        offsets = {}
+        allocator = Converter.id_allocator
+        for table_name, id_col in type(self).id_cols.items():
+            count = len(self.rows[table_name])
+            if count:
+                addr = f"{db_address['insert']}.[{table_name}]"
+                allocator.reserve(addr, id_col, count)
+                with allocator.lock:
+                    block = allocator.blocks[addr]
+                    offsets[table_name] = block[0] - 1
+                    block[0] += count
+        return offsets
+
+    @staticmethod
+    def csv_line(values):
+        """strings are quoted, so that an empty field without quotes is a NULL"""
+        return ','.join(
+            '' if value is None else
+            str(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else
+            '"' + str(value).replace('"', '""') + '"'
+            for value in values
+        ) + '\r\n'
+
+    @staticmethod
+    def csv_value(value):
+        """None/NaN as an empty field, an integral float as int so that it can be loaded into an int column"""
+        if isinstance(value, np.generic):
+            value = value.item()
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return None
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    def save(self, offsets=None):
+        """
+        write a CSV file per table, manifest.json and load.sql into folder
+        :param offsets: dictionary of table name: offset added to its ids, e.g. from reserve_offsets,
+            without offsets the ids start from 1 and load.sql only loads into empty tables
+        :return: folder path
+        """
+        check_empty = offsets is None
+        offsets = offsets or {}
+        folder = type(self).folder
+        os.makedirs(folder, exist_ok=True)
+        manifest = {}
+        for table_name in type(self).table_names:
+            rows = list(self.rows[table_name].values())
+            cols = list(dict.fromkeys(chain.from_iterable(rows)))
+            id_refs = type(self).id_refs[table_name]
+            filename = f'{table_name}.csv'
+            with open(os.path.join(folder, filename), 'w', encoding='utf-8', newline='') as f:
+                f.write(type(self).csv_line([col[1:-1] for col in cols]))
+                for row in rows:
+                    values = []
+                    for col in cols:
+                        value = type(self).csv_value(row.get(col))
+                        if col in id_refs and value is not None:
+                            value += offsets.get(id_refs[col], 0)
+                        values.append(value)
+                    f.write(type(self).csv_line(values))
+            manifest[table_name] = {'file': filename, 'columns': [col[1:-1] for col in cols], 'rows': len(rows)}
+        with open(os.path.join(folder, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        with open(os.path.join(folder, 'load.sql'), 'w', encoding='utf-8') as f:
+            f.write(self.load_script(manifest, os.path.abspath(folder), check_empty))
+        return folder
+
+    @classmethod
+    def load_script(cls, manifest, folder, check_empty=False):
+        """
+        BULK INSERT of every file into a staging table, then INSERT with the column names into the target table,
+        so that the columns do not have to be in the order of the target table, all in one transaction
+        :param check_empty: abort before loading if a target table other than SD has any row,
+            for ids which are not reserved and would clash with the existing ones
+        """
+        lines = [
+            '-- generated by main.py --export, the files must be readable by the server at the paths below',
+            'SET XACT_ABORT ON;',
+            'BEGIN TRANSACTION;'
+        ]
+        if check_empty:
+            for table_name, table_info in manifest.items():
+                if table_info['rows'] and table_name != 'SD':
+                    addr = f"{db_address['insert']}.[{table_name}]"
+                    message = f'{addr} is not empty, export again with --reserve-ids'.replace("'", "''")
+                    lines.append(f"IF EXISTS (SELECT 1 FROM {addr}) THROW 50000, N'{message}', 1;")
+        for table_name, table_info in manifest.items():
+            if not table_info['rows']:
+                continue
+            addr = f"{db_address['insert']}.[{table_name}]"
+            stage = f'#bulk_{table_name}'
+            cols = ', '.join(f'[{col}]' for col in table_info['columns'])
+            path = os.path.join(folder, table_info['file']).replace("'", "''")
+            lines += [
+                f'-- {table_name}: {table_info["rows"]} row(s)',
+                f"CREATE TABLE {stage} ({', '.join(f'[{col}] NVARCHAR(MAX)' for col in table_info['columns'])});",
+                f"BULK INSERT {stage} FROM '{path}' WITH (FORMAT = 'CSV', FIRSTROW = 2, FIELDQUOTE = '\"', "
+                "ROWTERMINATOR = '0x0d0a', CODEPAGE = '65001', KEEPNULLS, TABLOCK);"
+            ]
+            id_col = cls.id_cols.get(table_name)
+            # the ids of the files are new, so a row of the target table with a key of the files is a row loaded
+            # already, e.g. by another export, and nothing is loaded
+            key_cols = cls.key_cols.get(table_name) or [
+                f'[{col}]' for col in table_info['columns'] if f'[{col}]' != id_col]
+            matched = ' AND '.join(f'[T].{col} = [S].{col}' for col in key_cols)
+            message = f'{addr} already has a row of {table_info["file"]}'.replace("'", "''")
+            lines.append(
+                f'IF EXISTS (SELECT 1 FROM {addr} AS [T] JOIN {stage} AS [S] ON {matched}) '
+                f"THROW 50000, N'{message}', 1;"
+            )
+            identity = (
+                f"IF COLUMNPROPERTY(OBJECT_ID('{addr}'), '{id_col[1:-1]}', 'IsIdentity') = 1 "
+                f'SET IDENTITY_INSERT {addr}'
+            ) if id_col else ''
+            if identity:
+                lines.append(f'{identity} ON;')
+            lines.append(f'INSERT INTO {addr} ({cols}) SELECT {cols} FROM {stage};')
+            if identity:
+                lines.append(f'{identity} OFF;')
+            lines.append(f'DROP TABLE {stage};')
+        lines.append('COMMIT TRANSACTION;')
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def check(cls, folder):
+        """
+        check the files of an export without DB, the row count of every file, the uniqueness of the ids
+        and that every id referred to is in the file of its table
+        :param folder: export folder with manifest.json
+        :return: list of problems
+        """
+        with open(os.path.join(folder, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        problems = []
+        rows_dict = {}
+        for table_name, table_info in manifest.items():
+            with open(os.path.join(folder, table_info['file']), encoding='utf-8', newline='') as f:
+                reader = csv.reader(f)
+                header = next(reader, [])
+                rows_dict[table_name] = [dict(zip(header, row)) for row in reader]
+            if header != table_info['columns']:
+                problems.append(f'{table_name} has columns {header} instead of {table_info["columns"]}')
+            if len(rows_dict[table_name]) != table_info['rows']:
+                problems.append(f'{table_name} has {len(rows_dict[table_name])} row(s) instead of {table_info["rows"]}')
+        ids_dict = {}
+        for table_name, id_col in cls.id_cols.items():
+            ids = [row.get(id_col[1:-1], '') for row in rows_dict.get(table_name, [])]
+            if '' in ids:
+                problems.append(f'{table_name} has a row without {id_col}')
+            ids_dict[table_name] = set(ids) - {''}
+            if len(ids_dict[table_name]) != len(ids) - ids.count(''):
+                problems.append(f'{table_name} has duplicate {id_col}')
+        for table_name, rows in rows_dict.items():
+            for col, ref_table in cls.id_refs.get(table_name, {}).items():
+                if ref_table == table_name and col == cls.id_cols.get(table_name):
+                    continue
+                valid = ids_dict.get(ref_table, set()) | {''}
+                missing = {row[col[1:-1]] for row in rows if row.get(col[1:-1], '') not in valid}
+                if missing:
+                    problems.append(
+                        f'{table_name}.{col} refers to {len(missing)} id(s) not in {ref_table}, '
+                        f'e.g. {sorted(missing)[:5]}')
+        return problems
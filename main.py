@@ -1,374 +1,518 @@
 #!/usr/bin/env python3
 # coding=UTF-8
 import argparse
+import atexit
 import os
+import json
+import time
+from collections import deque
 from classes import *
+from concurrent.futures import ThreadPoolExecutor
 
+# threads for reading reference data at the start of process_table
+reference_executor = ThreadPoolExecutor(max_workers=4)
+# threads writing the independent tables of a plan, kept for all plans so that their connections stay open
+writer_executor = None
 
-def process_table(path):
+
+def get_writer_executor():
+    global writer_executor
+    if writer_executor is None:
+        writer_executor = ThreadPoolExecutor(max_workers=Converter.write_workers)
+    return writer_executor
+
+
+def resume_table(path):
+    checkpoint = Converter.load_checkpoint(path)
+    if checkpoint:
+        print(f"Table {checkpoint['tb_code']} is completed in a previous run, skipped : {path}")
+    return checkpoint
+
+
+def plan_table(path, cached=False):
+    """
+    parse a file and match it to the reference data, nothing is written to DB
+    :param path: CSV/XLSX path
+    :param cached: use SD, footnotes and translations saved by previous runs where possible, the rest is read from DB,
+    TABLE{tb_code} is always checked on the server
+    :return: LoadPlan
+    """
     table = Table()
     table.load_csv(path)
     table.parse_config_df()
     table.parse_cdm_df()
-    theme = Theme(table.get_theme_code())
-    print(table.code, theme.code, theme.desc, theme.desc_tc, table.title, table.title_tc)
-
-    converter = Converter(theme.code, table.code)
+    theme_code = table.get_theme_code()
 
     translator = Translator(table.code)
-    translator.load_data()
-
     fas = Fas(table.code, table.dict)
     fas.parse_csv_dict()
-    fas.sd.load_sd()
-    fas.footnote.load_footnote()
+    fas.load_columns()
+    # the reference data are independent and read concurrently, each thread on its own connection
+    loading = {
+        'translator': reference_executor.submit(translator.load_data, table.get_descs(), cached),
+        'sd': reference_executor.submit(fas.sd.load_sd, cached),
+        'footnote': reference_executor.submit(fas.footnote.load_footnote, cached),
+        'fas': reference_executor.submit(fas.load_fas_df)
+    }
+    loading['footnote'].result()
     table.parse_footnote(fas.footnote)
 
-    fas.load_columns()
-    fas.load_fas_df()
-    fas.update_footnote_and_parse_fas_df()
-
-    # TB_INFO - get tb_id
-    table.id = converter.process_part(
-        table_name='TB_INFO',
-        get_field='[tb_id]',
-        where_dict={
-            '[tb_code]': table.code
-        },
-        insert_dict={
-            '[tb_code]': table.code,
-            '[tb_title_en]': table.title,
-            '[tb_title_tc]': table.title_tc,
-            '[tb_fn_en]': table.fn,
-            '[tb_fn_tc]': table.fn_tc,
-            '[tb_src_en]': table.src,
-            '[tb_src_tc]': table.src_tc
-        }
-    )
+    loading['sd'].result()
+    loading['fas'].result()
+    # new SD symbols get a provisional sd_value until the plan is applied
+    fas.update_footnote_and_parse_fas_df(insert_sd=False)
 
-    # THEME - get theme_id
-    theme.id = converter.process_part(
-        table_name='THEME',
-        get_field='[theme_id]',
-        where_dict={
-            '[theme]': theme.code
-        },
-        insert_dict={
-            '[theme]': theme.code,
-            '[theme_desc_en]': theme.desc,
-            '[theme_desc_tc]': theme.desc_tc
-        },
-        df_col=[f'[cv{i}_id]' for i in range(1, 21)]
-    )
-    theme.load_dict()
+    loading['translator'].result()
+    table.init_cv_cc(translator, fas.dict)
+    table.init_sp_sv(translator, fas.dict)
+    table.init_mdt_keys(fas)
+    return LoadPlan(path, theme_code, table, fas.sd)
 
-    #
-    converter.df_dict['SD'] = fas.sd.df
 
-    #
-    print('[--CV & CC--]')
-    table.init_cv_cc(translator, fas.dict)
-    print(table.cv_cc)
-    for cv_code, cv in table.cv_cc:
-        # CV - get cv_id
-        cv_id = converter.process_part(
-            table_name='CV',
-            get_field='[cv_id]',
-            where_dict={
-                '[class_var]': cv_code,
-                '[theme_id]': theme.id
-            },
-            insert_dict={
-                '[theme_id]': theme.id,
-                '[class_var]': cv_code,
-                '[def_class_desc_en]': cv.desc,
-                '[def_class_desc_tc]': cv.desc_tc
-            },
-            concat=True
-        )
-        table.cv_cc.update_cdm(
-            cv_code, id=cv_id
-        )
-        # CV_TB
-        converter.process_part(
-            table_name='CV_TB',
-            get_field='1',
-            where_dict={
-                '[tb_id]': table.id,
-                '[cv_id]': cv_id
-            },
-            insert_dict={
-                '[cv_id]': cv_id,
-                '[tb_id]': table.id,
-                '[class_desc_en]': cv.get_tb_desc(),
-                '[class_desc_tc]': cv.get_tb_desc(tc=True)
-            },
-            concat=True,
-            df_col=list(chain.from_iterable([[f'[fn{i}_en]', f'[fn{i}_tc]'] for i in range(1, 6)]))
-        )
-        for cc_code, cc in cv:
-            # CCG - get ccg_id
-            ccg_id = converter.process_part(
-                table_name='CCG',
-                get_field='[ccg_id]',
-                insert_dict={
-                    '[cv_id]': cv_id,
-                    '[class_code_group]': cc.ccg
-                },
-                concat=True
-            )
-            table.cv_cc.update_cdm_child(
-                cv_code, cc_code, ccg_id=ccg_id
-            )
-            # CC - get cc_id
-            cc_id = converter.process_part(
-                table_name='CC',
-                get_field='[cc_id]',
-                where_dict={
-                    '[cv_id]': cv_id,
-                    '[class_code]': cc_code
-                },
-                insert_dict={
-                    '[cv_id]': cv_id,
-                    '[class_code]': cc_code,
-                    '[def_class_code_desc_en]': cc.desc,
-                    '[def_class_code_desc_tc]': cc.desc_tc
-                },
-                concat=True
-            )
-            table.cv_cc.update_cdm_child(
-                cv_code, cc_code, id=cc_id
-            )
-            # CCG_CC
-            converter.process_part(
-                table_name='CCG_CC',
-                get_field='1',
-                where_dict={
-                    '[ccg_id]': ccg_id,
-                    '[cc_id]': cc_id
-                },
-                insert_dict={
-                    '[ccg_id]': ccg_id,
-                    '[cc_id]': cc_id,
-                    '[cv_id]': cv_id,
-                    '[class_code_seq]': cc.seq
-                },
-                concat=True
-            )
-            # CC_TB
-            converter.process_part(
-                table_name='CC_TB',
-                get_field='1',
-                where_dict={
-                    '[cc_id]': cc_id,
-                    '[tb_id]': table.id
-                },
-                insert_dict={
-                    '[cc_id]': cc_id,
-                    '[tb_id]': table.id,
-                    '[class_code_desc_en]': cc.get_tb_desc(),
-                    '[class_code_desc_tc]': cc.get_tb_desc(tc=True),
-                    '[ccg_id]': ccg_id
-                },
-                concat=True,
-                additional_dict=cc.footnote,
-                df_col=list(chain.from_iterable([[f'[fn{i}_en]', f'[fn{i}_tc]'] for i in range(1, 6)]))
-            )
-        # PAC
-        for cc_code, cc in cv:
-            if cc.parent_cc_code:
-                parent = cv[cc.parent_cc_code]
-                converter.process_part(
-                    table_name='PAC',
-                    get_field='1',
-                    insert_dict={
-                        '[parent_ccg_id]': parent.ccg_id,
-                        '[parent_cc_id]': parent.id,
-                        '[child_ccg_id]': cc.ccg_id,
-                        '[child_cc_id]': cc.id
-                    },
-                    concat=True
-                )
-        if 'PAC' not in converter.df_dict:
-            converter.df_dict['PAC'] = pd.DataFrame(
-                columns=['[parent_ccg_id]', '[parent_cc_id]', '[child_ccg_id]', '[child_cc_id]']
-            )
+def apply_plans(plans, sd=None):
+    """
+    write plans to DB in order, the new SD symbols of all plans are inserted in one batch
+    :param plans: list of LoadPlan
+    :param sd: SD read from DB, e.g. the one read while planning, it is read if not given
+    :return: list of Converter
+    """
+    if sd is None:
+        sd = SD()
+        sd.load_sd()
+    for plan in plans:
+        for symbol, insert in plan.sd_pending.items():
+            sd.add_sd(symbol, insert['[sd_desc_eng]'], insert['[sd_desc_chi]'], insert['[sd_suppressed]'])
+    sd.insert_sd()
+    return [apply_plan(plan, sd) for plan in plans]
 
-    #
-    print('[--THEME - cv(s)_ id--]')
-    # update the processed newly assigned cv_id to THEME
-    for cv_id in table.cv_cc.all_ids():
-        if cv_id not in theme:
-            theme.insert_cv_id(cv_id)
-    for cv_id, col, in theme:
-        # create the DataFrame in out_df, where the index is the theme id and the column is the col respective cv?_id
-        converter.df_dict['THEME'].loc[theme.id, f'[{col}]'] = cv_id
 
-    #
-    print('[--SP & SV related-]')
-    table.init_sp_sv(translator, fas.dict)
-    print(table.sp_sv)
-    # print(sp_sv)
-    for sp_code, sp in table.sp_sv:
-        # SP - get sp_id
-        sp_id = converter.process_part(
-            table_name='SP',
-            get_field='[sp_id]',
-            where_dict={
-                '[stat_pres]': sp_code,
-                '[def_stat_pres_desc_en]': sp.desc,
-                '[def_stat_pres_desc_tc]': sp.desc_tc,
-                '[theme_id]': theme.id
-            },
-            insert_dict={
-                '[stat_pres]': sp_code,
-                '[theme_id]': theme.id,
-                '[def_stat_pres_desc_en]': sp.desc,
-                '[def_stat_pres_desc_tc]': sp.desc_tc,
-                '[def_stat_type]': sp.type,
-                '[def_unit]': sp.unit,
-                '[def_unit_desc_en]': sp.unit_desc,
-                '[def_unit_desc_tc]': sp.unit_desc_tc,
-                '[def_decimals]': sp.dec,
-                '[def_unit_mult]': sp.multi,
-                '[def_separator_format]': sp.sep
-            },
-            concat=True
-        )
-        table.sp_sv.update_cdm(sp_code, id=sp_id)
-        # SP_TB
-        converter.process_part(
-            table_name='SP_TB',
-            get_field='1',
-            where_dict={
-                '[sp_id]': sp_id,
-                '[tb_id]': table.id
-            },
-            insert_dict={
-                '[sp_id]': sp_id,
-                '[tb_id]': table.id,
-                '[stat_pres_desc_en]': sp.get_tb_desc(),
-                '[stat_pres_desc_tc]': sp.get_tb_desc(tc=True),
-                '[stat_type]': sp.type,
-                '[unit]': sp.unit,
-                '[unit_desc_en]': sp.unit_desc,
-                '[unit_desc_tc]': sp.unit_desc_tc,
-                '[decimals]': sp.dec,
-                '[unit_mult]': sp.multi,
-                '[separator_format]': sp.sep
-            },
-            concat=True,
-            additional_dict=sp.footnote,
-            df_col=list(chain.from_iterable([[f'[fn{i}_en]', f'[fn{i}_tc]'] for i in range(1, 6)]))
-        )
-        for sv_code, sv in sp:
-            # SV - get sv_id
-            sv_id = converter.process_part(
-                table_name='SV',
-                get_field='[sv_id]',
-                where_dict={
-                    '[theme_id]': theme.id,
-                    '[stat_var]': sv_code
-                },
-                insert_dict={
-                    '[theme_id]': theme.id,
-                    '[stat_var]': sv_code,
-                    '[def_stat_desc_en]': sv.desc,
-                    '[def_stat_desc_tc]': sv.desc_tc
-                },
-                concat=True
-            )
-            table.sp_sv.update_cdm_child(sp_code, sv_code, id=sv_id)
-            # SV_TB
-            converter.process_part(
-                table_name='SV_TB',
-                get_field='1',
-                where_dict={
-                    '[sv_id]': sv_id,
-                    '[tb_id]': table.id
-                },
-                insert_dict={
-                    '[sv_id]': sv_id,
-                    '[tb_id]': table.id,
-                    '[stat_desc_en]': sv.get_tb_desc(),
-                    '[stat_desc_tc]': sv.get_tb_desc(tc=True)
-                },
-                concat=True,
-                additional_dict=sv.footnote,
-                df_col=list(chain.from_iterable([[f'[fn{i}_en]', f'[fn{i}_tc]'] for i in range(1, 6)]))
-            )
+def apply_rows(converter, plan, table_name, ids):
+    """
+    write the rows of a table of plan with a set-based statement per batch of rows
+    :param converter: Converter of the table
+    :param ids: dictionary of Ref: id of the rows written so far, the ids of the rows are added
+    :return: list of the rows with their id
+    """
+    id_col = LoadPlan.id_cols.get(table_name)
+    rows = plan.resolve(table_name, ids)
+    values = converter.merge_rows(table_name, id_col or '1', rows, LoadPlan.key_cols.get(table_name))
+    if id_col:
+        for ref, row, value in zip(plan.get_refs(table_name), rows, values):
+            ids[ref] = value
+            row[id_col] = value
+    return rows
+
+
+def apply_plan(plan, sd):
+    """
+    resolve the ids of a plan by writing it to DB table by table and build the output DataFrames
+    :param plan: LoadPlan
+    :param sd: SD with the new symbols of plan inserted
+    :return: Converter
+    """
+    theme = Theme(plan.theme_code)
+    tb_info = next(iter(plan.rows['TB_INFO'].values()))
+    print(plan.tb_code, theme.code, theme.desc, theme.desc_tc, tb_info['[tb_title_en]'], tb_info['[tb_title_tc]'])
+    print(plan)
+
+    converter = Converter(theme.code, plan.tb_code)
+    # a full THEME fails the table before anything of it is written
+    theme.check_slots(list(plan.cv_refs))
+    # Ref: id
+    ids = {}
+    # table name: rows with their id
+    written = {}
+    executor = get_writer_executor()
+    for level in LoadPlan.write_levels:
+        futures = {
+            table_name: executor.submit(apply_rows, converter, plan, table_name, ids) for table_name in level
+        }
+        if 'CV_TB' in level:
+            #
+            print('[--THEME - cv(s)_ id--]')
+            # update the processed newly assigned cv_id to THEME while the tables of the level are being written
+            theme.insert_cv_ids([ids[cv_ref] for cv_ref in plan.cv_refs.values()])
+        for table_name, future in futures.items():
+            written[table_name] = future.result()
+        if 'THEME' in level:
+            theme.id = ids[plan.theme_ref]
+            theme.load_dict()
 
     #
     print('[--MDT--]')
-    table.init_mdt(theme, fas)
-    for i, insert_dict in enumerate(table.mdt):
-        # MDT - get mtd_id
-        mdt_id = converter.process_part(
-            table_name='MDT',
-            get_field='[mdt_id]',
-            insert_dict=insert_dict,
-            df_col=[f'[cv{i}_cc_id]' for i in range(1, 21)],
-            concat=True
-        )
-        table.mdt[i]['[mdt_id]'] = mdt_id
+    mdt_rows = plan.get_mdt_rows(ids, theme, plan.get_sd_values(sd))
+    # MDT - get mtd_id, a statement per batch of rows
+    for insert_dict, mdt_id in zip(mdt_rows, converter.merge_rows('MDT', '[mdt_id]', mdt_rows)):
+        insert_dict['[mdt_id]'] = mdt_id
 
-    #
-    print('[--TB_COMP--]')
-    # SV and SP used
-    for sp_id, sv_id in table.sp_sv.all_ids(include_child=True):
-        converter.process_part(
-            table_name='TB_COMP',
-            get_field='1',
-            insert_dict={
-                '[tb_id]': table.id,
-                '[sv_id]': sv_id,
-                '[sp_id]': sp_id
-            },
-            concat=True
-        )
-    # CCG used
-    for ccg_id in table.cv_cc.all_ccg():
-        converter.process_part(
-            table_name='TB_COMP',
-            get_field='1',
-            insert_dict={
-                '[tb_id]': table.id,
-                '[ccg_id]': ccg_id
-            },
-            concat=True
-        )
+    # the DataFrames are built once per table in the order of the sheets
+    for table_name in LoadPlan.table_names:
+        converter.df_dict[table_name] = Converter.rows_df(
+            written[table_name], LoadPlan.id_cols.get(table_name), LoadPlan.df_cols.get(table_name))
+        if table_name == 'THEME':
+            for cv_id, col, in theme:
+                # in out_df, the index is the theme id and the column is the col respective cv?_id
+                converter.df_dict['THEME'].loc[theme.id, f'[{col}]'] = cv_id
+            converter.df_dict['SD'] = sd.df
+        elif table_name == 'SV_TB' and mdt_rows:
+            converter.df_dict['MDT'] = Converter.compact_mdt_df(pd.DataFrame.from_records(mdt_rows, index='[mdt_id]'))
+    converter.path = plan.path
     converter.save_df_dict()
+    # a checkpoint is only valid for the input file the plan was made from
+    if plan.is_current():
+        converter.save_checkpoint(plan.path)
+    return converter
+
+
+def process_table(path):
+    plan = plan_table(path)
+    return apply_plans([plan], plan.sd)[0]
+
+
+def list_input_files(folder_name):
+    return [
+        f'{folder_name}\\{file_name}'
+        for file_name in os.listdir(folder_name)
+        if file_name.lower().endswith(".csv") or file_name.lower().endswith(".xlsx")
+    ]
+
+
+def plan_file(path, cached=False):
+    """plan a file and save the plan, for use in a process pool"""
+    return plan_table(path, cached).save()
+
+
+def plan_files(file_list, workers, cached=False):
+    """
+    plan all files in parallel, the plans are saved in plan folder
+    :param cached: see plan_table
+    :return: list of plan paths
+    """
+    # the queries are only recorded or replayed in this process
+    if Connection.capture:
+        workers = 0
+    plan_paths = []
+    executor = ProcessPoolExecutor(max_workers=min(workers, len(file_list))) if workers and file_list else None
+    plan = partial(plan_file, cached=cached)
+    try:
+        for file_name, plan_path in zip(file_list, executor.map(plan, file_list) if executor else map(plan, file_list)):
+            print(f'{file_name} is planned : {plan_path}')
+            plan_paths.append(plan_path)
+    finally:
+        if executor:
+            executor.shutdown()
+    return plan_paths
+
+
+def list_plan_files(folder_name):
+    return sorted(
+        f'{folder_name}\\{file_name}'
+        for file_name in os.listdir(folder_name)
+        if file_name.lower().endswith('.pickle')
+    )
+
+
+def export_plans(plans, reserve_ids=False):
+    """
+    write plans as files for BULK INSERT into bulk folder instead of DB and check the files
+    :param plans: list of LoadPlan
+    :param reserve_ids: reserve the ids from ID_BLOCK, otherwise they start from 1 for loading into empty tables
+    :return: True if the files pass the check
+    """
+    sd = SD()
+    # the sd_values of the new symbols follow the ones in DB at the time of export
+    sd.load_sd()
+    bulk_export = BulkExport(sd)
+    for plan in plans:
+        bulk_export.add_plan(plan)
+    folder = bulk_export.save(bulk_export.reserve_offsets() if reserve_ids else None)
+    print(f'Exported to {folder} : ' + ', '.join(
+        f'{table_name} {len(rows)}' for table_name, rows in bulk_export.rows.items()))
+    return check_export(folder)
+
+
+def check_export(folder):
+    problems = BulkExport.check(folder)
+    for problem in problems:
+        print(f'  - {problem}')
+    print(f'{len(problems)} problem(s) found in {folder}.')
+    return not problems
+
+
+def write_status(status):
+    """write the status of watch mode to output"""
+    with atomic_write('output\\watch_status.json') as temp_path, open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(status, f, ensure_ascii=False, indent=2)
+
+
+def watch_folder(folder_name, interval):
+    """
+    poll folder_name and process a file once it is new or changed and then unchanged for one interval,
+    connections and config are kept for the next tables, the reference data are read again for each batch,
+    a failed file is retried at the next poll
+    """
+    observed = {}
+    queued = {}
+    queue = deque()
+    status = {'queue': [], 'processing': '', 'tables': {}}
+    while True:
+        for file_name in list_input_files(folder_name):
+            try:
+                key = FileCache.file_key(file_name)
+            except FileNotFoundError:
+                continue
+            if observed.get(file_name) == key and queued.get(file_name) != key:
+                queued[file_name] = key
+                if file_name not in queue:
+                    queue.append(file_name)
+            observed[file_name] = key
+        if queue:
+            # TB_FIELDLOOKUP and TB_FOOTNOTE may have been changed since the last batch
+            Translator.clear_cache()
+            Footnote.clear_prefetched()
+            try:
+                Footnote.prefetch([Table.read_code(file_name) for file_name in queue])
+            except Exception as e:
+                print(f'Footnotes are not prefetched: {e!r}')
+        written = []
+        while queue:
+            file_name = queue.popleft()
+            status.update(queue=list(queue), processing=file_name, updated=time.strftime('%Y-%m-%d %H:%M:%S'))
+            write_status(status)
+            start = time.perf_counter()
+            attempts = status['tables'].get(file_name, {}).get('attempts', 0)
+            try:
+                converter = process_table(file_name)
+                written.append((converter.theme_code, converter.df_dict, converter.tb_code))
+                result = 'done'
+                attempts = 0
+            except Exception as e:
+                print(f'{file_name} is failed: {e!r}')
+                result = 'failed'
+                attempts += 1
+                # queued again by the next poll even if the file is unchanged
+                queued.pop(file_name, None)
+            status['tables'][file_name] = {
+                'result': result,
+                'attempts': attempts,
+                'latency': round(time.perf_counter() - start, 3),
+                'finished': time.strftime('%Y-%m-%d %H:%M:%S')
+            }
+            if not queue:
+                # only the processed tables are rewritten, themes are merged with the tables stored earlier
+                Converter.write_excel_all(written)
+                Converter.merge_df()
+                Converter.convert_theme()
+                # the next batch only merges and writes the themes of its own tables
+                Converter.clear_df_dict()
+        status.update(queue=[], processing='', updated=time.strftime('%Y-%m-%d %H:%M:%S'))
+        write_status(status)
+        time.sleep(interval)
+
+
+def validate_table(path):
+    """
+    parse a file and build the CV/SP models like process_table but only with cached reference data and no writes
+    :param path: CSV/XLSX path
+    :return: list of problems
+    """
+    problems = []
+    try:
+        table = Table()
+        table.load_csv(path)
+        table.parse_config_df()
+        table.parse_cdm_df()
+    except Exception as e:
+        return [f'cannot be parsed: {e!r}']
+    theme_code = table.get_theme_code()
+    if theme_code not in Theme.theme_dict:
+        problems.append(f'THEME {theme_code} is not in theme.csv')
+    translator = Translator(table.code)
+    translation_cached = translator.load_cached_data(table.get_descs())
+    if not translation_cached:
+        problems.append(f'TB_FIELDLOOKUP of table {table.code} is not cached, translations are not checked')
+    fas = Fas(table.code, table.dict)
+    try:
+        fas.parse_csv_dict()
+    except Exception as e:
+        return problems + [f'FAS field names cannot be parsed: {e!r}']
+    fas_names = fas.get_cached_fas_names()
+    if fas_names is not None:
+        for fas_name in sorted(fas.all_fas_names() - fas_names - {'undefined'}):
+            problems.append(f'fas - {fas_name} is not known in TABLE{table.code}')
+    for field, init in [('CV', table.init_cv_cc), ('SV', table.init_sp_sv)]:
+        try:
+            init(translator, fas.dict)
+        except Exception as e:
+            problems.append(f'{field} cannot be built (e.g. a bad CC Group): {e!r}')
+    if translation_cached:
+        for cdm_model in (table.cv_cc, table.sp_sv):
+            for cdm_code, cdm in cdm_model:
+                for cdm_child_code, cdm_child in chain([(cdm_code, cdm)], cdm):
+                    for attr in ('desc_tc', 'alt_desc_tc', 'unit_desc_tc'):
+                        if 'NOT FOUND' in str(cdm_child.get_attr(attr, '')):
+                            problems.append(
+                                f'{cdm_model.name} {cdm_child_code} - {cdm_child.get_attr(attr[:-3])} '
+                                f'is not found in TB_FIELDLOOKUP')
+    return problems
+
+
+def validate_files(file_list, workers):
+    """validate all files in parallel and report all problems at once"""
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(file_list)))) as executor:
+        results = list(executor.map(validate_table, file_list))
+    failed = 0
+    for file_name, problems in zip(file_list, results):
+        if problems:
+            failed += 1
+            print(f'{file_name}:')
+            for problem in problems:
+                print(f'  - {problem}')
+    print(f'{len(file_list) - failed} of {len(file_list)} file(s) passed validation.')
+    return failed == 0
+
+
+def start_capture(path, replay, latency):
+    """record or replay all queries of this run, the capture is saved and summarized on exit"""
+    Connection.capture = QueryCapture(path, replay=replay, latency=latency)
+    # reference data and checkpoints would skip queries, so that a replay would depend on the local cache folder
+    for cache in (Table.input_cache, Converter.checkpoint_cache, Translator.reference_cache, Fas.reference_cache,
+                  SD.reference_cache, Footnote.reference_cache):
+        cache.enabled = False
+    started = time.perf_counter()
+
+    def stop_capture():
+        Connection.capture.save()
+        print(f'{"Replayed" if replay else "Recorded"} {path} : '
+              f'{Connection.capture.summary()}, {time.perf_counter() - started:.3f}s in total')
+    atexit.register(stop_capture)
 
 
 def main():
     # add an arg parser to process args
-    parser = argparse.ArgumentParser(usage='--file [CSV/XLSX path] / --folder [folder path]')
+    parser = argparse.ArgumentParser(
+        usage='--file [CSV/XLSX path] / --folder [folder path] / --watch [folder path] / --apply [plan folder]')
     # add an exclusive group so that either file other folder arg will be accepted
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--file', help='File mode to process a single file')
     group.add_argument('--folder', help='Process all files in a folder')
+    group.add_argument('--watch', help='Keep running and process new or changed files in a folder')
+    group.add_argument('--apply', help='Write all load plans in a folder to DB')
+    group.add_argument('--check-export', help='Check the files of --export in a folder without DB')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='Seconds between polls of the watched folder')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip tables completed in a previous run and reload their output from checkpoint')
+    parser.add_argument('--this-run-only', action='store_true',
+                        help='Merge the theme workbooks only from the tables of this run, not the ones stored earlier')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes for writing output workbooks, validation and parsing large tables')
+    parser.add_argument('--writers', type=int, default=Converter.write_workers,
+                        help='Number of threads writing the independent tables of a plan to DB')
+    parser.add_argument('--validate', action='store_true',
+                        help='Only check the files with cached reference data, nothing is written to DB')
+    parser.add_argument('--export', action='store_true',
+                        help='Write the files or the plans of --apply into bulk folder for BULK INSERT instead of DB')
+    parser.add_argument('--reserve-ids', action='store_true',
+                        help='Reserve the ids of --export from DB, otherwise they start from 1')
+    parser.add_argument('--plan', action='store_true',
+                        help='Only parse the files into load plans in plan folder, nothing is written to DB')
+    parser.add_argument('--cached-reference', action='store_true',
+                        help='Plan with SD, footnotes and translations saved by previous runs instead of reading DB')
+    capture_group = parser.add_mutually_exclusive_group()
+    capture_group.add_argument('--record', help='Record all queries and their results into a capture file')
+    capture_group.add_argument('--replay', help='Serve all queries from a capture file of --record instead of DB')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds added to every round trip of --replay')
     args = parser.parse_args()
+    atexit.register(Connection.close_all)
+    # --apply and --check-export read plans and exports, not input files
+    source = args.file or args.folder or args.watch
+    if (args.validate or args.plan) and not source:
+        parser.error('--validate and --plan need --file, --folder or --watch')
+    if args.export and not (source or args.apply):
+        parser.error('--export needs --file, --folder, --watch or --apply')
+    Converter.workers = args.workers
+    Fas.workers = args.workers
+    Converter.write_workers = args.writers
+    Converter.merge_stored = not args.this_run_only
+    if args.record or args.replay:
+        start_capture(args.record or args.replay, bool(args.replay), args.latency)
+        # ids are assigned in the same order in every run so that the queries of a replay are the recorded ones
+        Converter.write_workers = 1
+    #
+    if args.validate:
+        print('----Validate mode----')
+        if args.file:
+            file_list = [args.file]
+        else:
+            file_list = list_input_files(args.folder or args.watch)
+        sys.exit(0 if validate_files(file_list, args.workers) else 1)
+    #
+    if args.check_export:
+        print('----Check export mode----')
+        sys.exit(0 if check_export(args.check_export) else 1)
+    #
+    if args.export:
+        print('----Export mode----')
+        if args.apply:
+            plans = [LoadPlan.load(plan_name) for plan_name in list_plan_files(args.apply)]
+        else:
+            file_list = [args.file] if args.file else list_input_files(args.folder or args.watch)
+            plan_paths = plan_files(file_list, args.workers, args.cached_reference)
+            plans = [LoadPlan.load(plan_name) for plan_name in plan_paths]
+        sys.exit(0 if export_plans(plans, args.reserve_ids) else 1)
+    #
+    if args.plan:
+        print('----Plan mode----')
+        if args.file:
+            file_list = [args.file]
+        else:
+            file_list = list_input_files(args.folder or args.watch)
+        plan_files(file_list, args.workers, args.cached_reference)
+        return
     #
     # if its file mode
     if args.file:
         print('----File mode----')
         file_name = args.file
-        process_table(file_name)
+        checkpoint = resume_table(file_name) if args.resume else None
+        if checkpoint:
+            Converter.restore_checkpoint(checkpoint, file_name)
+        else:
+            process_table(file_name)
+        # the theme workbook is merged with the other tables of the theme stored in previous runs
+        Converter.merge_df()
         Converter.convert_table()
+        Converter.convert_theme()
     # if its folder mode
     elif args.folder:
         print('----Folder mode----')
         folder_name = args.folder
-        file_list = [
-            f'{folder_name}\\{file_name}'
-            for file_name in os.listdir(folder_name)
-            if file_name.lower().endswith(".csv") or file_name.lower().endswith(".xlsx")
-        ]
+        file_list = list_input_files(folder_name)
+        checkpoints = {file_name: resume_table(file_name) for file_name in file_list} if args.resume else {}
+        # footnotes of all tables to be processed in the folder are loaded in one query
+        Footnote.prefetch([Table.read_code(file_name) for file_name in file_list if not checkpoints.get(file_name)])
+        # resumed and processed tables are added in the order of the files, so the workbooks are the same as a full run
         for file_name in file_list:
-            process_table(file_name)
+            if checkpoints.get(file_name):
+                Converter.restore_checkpoint(checkpoints[file_name], file_name)
+            else:
+                process_table(file_name)
+        Converter.merge_df()
+        Converter.convert_table()
+        Converter.convert_theme()
+    # if its apply mode
+    elif args.apply:
+        print('----Apply mode----')
+        apply_plans([LoadPlan.load(plan_name) for plan_name in list_plan_files(args.apply)])
         Converter.merge_df()
         Converter.convert_table()
         Converter.convert_theme()
+    # if its watch mode
+    elif args.watch:
+        print('----Watch mode----')
+        watch_folder(args.watch, args.interval)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,7 @@
+-- ID_BLOCK keeps the next free id of every table for IdAllocator in classes.py.
+-- Run once in the insert database (db_address 'insert' in config\db_config.csv) before loading.
+IF OBJECT_ID('[dbo].[ID_BLOCK]') IS NULL
+CREATE TABLE [dbo].[ID_BLOCK] (
+    [table_name] NVARCHAR(256) NOT NULL PRIMARY KEY,
+    [next_id] BIGINT NOT NULL
+);
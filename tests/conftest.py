@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# classes.py and main.py are imported from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from classes import CDM, CDMGroup, LoadPlan, SD, Table, Theme
+
+
+@pytest.fixture
+def plan(tmp_path, monkeypatch):
+    """LoadPlan of table 193 in theme 001 with a CV of two CCs and an SV, planned without DB"""
+    monkeypatch.setattr(Theme.theme_dict, '_loaded', {'001': {'THEME_DESC_ENG': 'Pop', 'THEME_DESC_CHI': 'pop tc'}})
+    monkeypatch.setattr(LoadPlan, 'folder', str(tmp_path / 'plan'))
+    source = tmp_path / 'input_193.xlsx'
+    source.write_bytes(b'workbook')
+    table = Table()
+    table.code = '193'
+    table.cv_cc['AGE'] = CDMGroup('Age', 'age tc', '', '')
+    footnote = {'[fn1_en]': 'note', '[fn1_tc]': 'note tc'}
+    table.cv_cc['AGE']['A1'] = CDM('All', 'all tc', '', '', footnote=footnote, seq=1, ccg=1, parent_cc_code='')
+    table.cv_cc['AGE']['A2'] = CDM('0-14', '0-14', '', '', footnote={}, seq=2, ccg=2, parent_cc_code='A1')
+    table.sp_sv['SP1'] = CDMGroup('', '', '', '', type='N', unit='u', unit_desc='ud', unit_desc_tc='ud tc', dec=0,
+                                  multi=0, sep='', footnote={})
+    table.sp_sv['SP1']['SV1'] = CDM('Population', 'population tc', '', '', footnote={})
+    table.mdt_keys = [((('AGE', 'A2'),), 'SP1', 'SV1', 5.0, -1), ((('AGE', 'A1'),), 'SP1', 'SV1', 7.0, 0)]
+    sd = SD()
+    sd.pending = {'#': {'[sd_symbol]': '#'}}
+    return LoadPlan(str(source), '001', table, sd)
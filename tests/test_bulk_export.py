@@ -0,0 +1,85 @@
+import csv
+import os
+
+import pytest
+
+from classes import BulkExport, LoadPlan, SD, Theme
+
+
+@pytest.fixture
+def bulk_export(tmp_path, monkeypatch):
+    monkeypatch.setattr(BulkExport, 'folder', str(tmp_path / 'bulk'))
+    monkeypatch.setattr('classes.db_address._loaded', {'insert': '[db].[dbo]'})
+    sd = SD()
+    sd.update({'-': 1})
+    return BulkExport(sd)
+
+
+def read_rows(folder, table_name):
+    with open(os.path.join(folder, f'{table_name}.csv'), encoding='utf-8', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_saved_plan_passes_check(plan, bulk_export):
+    bulk_export.add_plan(LoadPlan.load(plan.save()))
+    folder = bulk_export.save()
+    assert BulkExport.check(folder) == []
+    theme_row = read_rows(folder, 'THEME')[0]
+    cv_row = read_rows(folder, 'CV')[0]
+    assert theme_row['cv1_id'] == cv_row['cv_id']
+    # the new symbol follows the ones in SD
+    assert read_rows(folder, 'SD')[0]['sd_value'] == '2'
+    assert sorted(row['sd_value'] for row in read_rows(folder, 'MDT')) == ['0', '2']
+
+
+def test_check_finds_a_missing_reference(plan, bulk_export):
+    bulk_export.add_plan(plan)
+    folder = bulk_export.save()
+    cc_rows = read_rows(folder, 'CC')
+    with open(os.path.join(folder, 'CC.csv'), 'w', encoding='utf-8', newline='') as f:
+        f.write(BulkExport.csv_line(cc_rows[0]))
+        for row in cc_rows[1:]:
+            f.write(BulkExport.csv_line(row.values()))
+    assert any(problem.startswith('CC has 1 row(s) instead of 2') for problem in BulkExport.check(folder))
+    assert any('refers to 1 id(s) not in CC' in problem for problem in BulkExport.check(folder))
+
+
+def test_load_script_only_loads_into_empty_tables(plan, bulk_export):
+    bulk_export.add_plan(plan)
+    with open(os.path.join(bulk_export.save(), 'load.sql'), encoding='utf-8') as f:
+        script = f.read()
+    assert "IF EXISTS (SELECT 1 FROM [db].[dbo].[THEME]) THROW 50000, N'[db].[dbo].[THEME] is not empty" in script
+    assert 'FROM [db].[dbo].[SD])' not in script
+    # the checks run before any row is loaded
+    assert script.index('THROW') < script.index('BULK INSERT')
+    with open(os.path.join(bulk_export.save({}), 'load.sql'), encoding='utf-8') as f:
+        assert 'is not empty' not in f.read()
+
+
+def test_load_script_fails_on_an_existing_natural_key(plan, bulk_export):
+    bulk_export.add_plan(plan)
+    with open(os.path.join(bulk_export.save({'THEME': 10, 'CV': 20}), 'load.sql'), encoding='utf-8') as f:
+        script = f.read()
+    theme_check = (
+        'IF EXISTS (SELECT 1 FROM [db].[dbo].[THEME] AS [T] JOIN #bulk_THEME AS [S] ON [T].[theme] = [S].[theme]) '
+        "THROW 50000, N'[db].[dbo].[THEME] already has a row of THEME.csv', 1;"
+    )
+    assert theme_check in script
+    assert 'JOIN #bulk_SD AS [S] ON [T].[sd_symbol] = [S].[sd_symbol])' in script
+    assert 'JOIN #bulk_CV AS [S] ON [T].[class_var] = [S].[class_var] AND [T].[theme_id] = [S].[theme_id])' in script
+    # a table without a natural key is matched on all its columns but the id
+    mdt_check = script[script.index('JOIN #bulk_MDT'):script.index('THROW', script.index('JOIN #bulk_MDT'))]
+    assert '[T].[obs_value] = [S].[obs_value]' in mdt_check and '[mdt_id]' not in mdt_check
+    # each check runs after its file is staged and before any of its rows is inserted
+    assert script.index('BULK INSERT #bulk_THEME') < script.index(theme_check) \
+        < script.index('INSERT INTO [db].[dbo].[THEME]')
+
+
+def test_export_fails_without_a_free_cv_slot(plan, bulk_export):
+    theme = bulk_export.get_theme('001')
+    theme_row = bulk_export.rows['THEME']['001']
+    for i, col in enumerate(Theme.slot_cols, 100):
+        theme[i] = col
+        theme_row[f'[{col}]'] = i
+    with pytest.raises(SystemExit):
+        bulk_export.add_plan(plan)
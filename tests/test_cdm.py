@@ -0,0 +1,39 @@
+import numpy as np
+
+from classes import CDM, CDMGroup, CommonDataModel
+
+
+def test_ids_are_stored_as_int():
+    cc = CDM('desc', 'desc tc', '', '')
+    cc.set_attr('id', np.int64(5))
+    cc.set_attr('ccg_id', '7')
+    assert cc.id == 5 and type(cc.id) is int
+    assert cc.ccg_id == 7 and type(cc.ccg_id) is int
+
+
+def test_seq_and_ccg_are_kept_as_given():
+    # a year CC keeps its code as seq, e.g. '1900' is written as text like before
+    year = CDM('1900', '1900', '', '', seq='1900', ccg=1)
+    other = CDM('desc', 'desc tc', '', '', seq=2, ccg=2)
+    assert year.seq == '1900' and other.seq == 2
+    assert year.ccg == 1
+
+
+def test_other_attributes_are_allowed():
+    cc = CDM('desc', 'desc tc', '', '', **{'Custom Note': 'x'})
+    cc.set_attr('Another Key', 1)
+    assert cc.get_attr('customnote') == 'x'
+    assert cc.get_attr('anotherkey') == 1
+    assert cc.get_attr('missing') == 0
+
+
+def test_group_keeps_children_and_attributes():
+    cv_cc = CommonDataModel('CV')
+    cv_cc['CCYY_F'] = CDMGroup('Financial Year', '財政年度', '', '')
+    cv_cc['CCYY_F']['1900'] = CDM('1900', '1900', '', '', fas='year', seq='1900', ccg=1, parent_cc_code='')
+    cv_cc['CCYY_F'].set_attr('id', 3)
+    cv_cc['CCYY_F']['1900'].set_attr('id', np.int64(10))
+    cv_cc['CCYY_F']['1900'].set_attr('ccg_id', 20)
+    assert cv_cc['CCYY_F']['1900'].ccg_id == 20
+    assert cv_cc.get_id_by_desc('1900', 'ccg', fas='year') == [
+        {'cdm_code': 'CCYY_F', 'code': '1900', 'id': 3, 'child_id': 10, 'ccg': 1}]
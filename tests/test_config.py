@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from classes import LazyDict, config_dict, config_groups, read_config
+
+
+@pytest.fixture
+def config_folder(tmp_path, monkeypatch):
+    """write CSVs where read_config looks for them and read them from scratch"""
+    def write(filename, text):
+        (tmp_path / 'config').mkdir(exist_ok=True)
+        with open(tmp_path / f'config\\{filename}', 'w', encoding='utf-8-sig', newline='') as f:
+            f.write(text)
+    monkeypatch.chdir(tmp_path)
+    read_config.cache_clear()
+    yield write
+    read_config.cache_clear()
+
+
+def test_read_config_drops_empty_cells(config_folder):
+    config_folder('unit.csv', 'Unit_desc_eng,Unit_desc_chi\r\nNumber,數目\r\nPercent,\r\n')
+    header, rows = read_config('unit.csv')
+    assert header == ['Unit_desc_eng', 'Unit_desc_chi']
+    assert rows == ({'Unit_desc_eng': 'Number', 'Unit_desc_chi': '數目'}, {'Unit_desc_eng': 'Percent'})
+
+
+def test_read_config_missing_file_exits(config_folder):
+    with pytest.raises(SystemExit):
+        read_config('missing.csv')
+
+
+def test_config_dict_later_row_wins(config_folder):
+    config_folder('theme.csv', 'THEME,THEME_DESC_ENG\r\n001,Old\r\n002,Other\r\n001,New\r\n')
+    assert config_dict('theme.csv', 'THEME') == {'001': {'THEME_DESC_ENG': 'New'}, '002': {'THEME_DESC_ENG': 'Other'}}
+    assert config_dict('theme.csv', 0, 'THEME_DESC_ENG') == {'001': 'New', '002': 'Other'}
+
+
+def test_config_groups(config_folder):
+    config_folder('table_info.csv', 'Table,NOTE\r\n193,a\r\n194,b\r\n193,c\r\n')
+    assert config_groups('table_info.csv', 'Table', 'NOTE') == {'193': ['a', 'c'], '194': ['b']}
+
+
+def test_lazy_dict_loads_once_on_first_access():
+    calls = []
+    lazy = LazyDict(lambda: calls.append(1) or {'a': 1})
+    assert not calls
+    assert lazy['a'] == 1 and 'a' in lazy and len(lazy) == 1
+    assert calls == [1]
+
+
+def test_import_does_not_read_config(tmp_path):
+    # importing without config folder must not exit, config is only read when it is first needed
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-c', 'import classes; print(classes.db_config._loaded, classes.Theme.theme_dict._loaded)'],
+        cwd=tmp_path, env={**os.environ, 'PYTHONPATH': repo}, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == ['None', 'None']
@@ -0,0 +1,104 @@
+import pandas as pd
+import pytest
+
+from classes import Converter, FileCache, ThemeStore
+
+
+@pytest.fixture
+def converter_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(FileCache, 'folder', str(tmp_path / 'cache'))
+    monkeypatch.setattr(Converter, 'out_df_dict', {})
+    monkeypatch.setattr(Converter, 'unstored_df_dict', {})
+    monkeypatch.setattr(Converter, 'theme_df_dict', {})
+    monkeypatch.setattr('classes.db_config._loaded', {'server': 'db1'})
+    monkeypatch.setattr('classes.db_address._loaded', {'insert': '[db].[dbo]'})
+    # every stored table is in DB unless a test removes it
+    monkeypatch.setattr(Converter, 'select_tb_ids', staticmethod(lambda tb_ids: set(tb_ids)))
+    return tmp_path
+
+
+def make_converter(tb_code):
+    converter = Converter('001', tb_code)
+    tb_info_df = pd.DataFrame({'[tb_code]': [tb_code]}, index=pd.Index([int(tb_code)], name='[tb_id]'))
+    converter.df_dict = {'TB_INFO': tb_info_df}
+    return converter
+
+
+def test_checkpoint_round_trip(converter_state):
+    source = converter_state / 'input_193.xlsx'
+    source.write_bytes(b'workbook')
+    make_converter('193').save_checkpoint(str(source))
+    checkpoint = Converter.load_checkpoint(str(source))
+    assert set(checkpoint) == {'theme_code', 'tb_code', 'df_dict'}
+    # loading does not add the table to the output until it is restored
+    assert Converter.out_df_dict == {}
+    converter = Converter.restore_checkpoint(checkpoint)
+    assert converter.tb_code == '193'
+    assert list(Converter.out_df_dict['001']) == ['193']
+    source.write_bytes(b'changed workbook')
+    assert Converter.load_checkpoint(str(source)) is None
+
+
+def test_restored_tables_keep_file_order(converter_state):
+    checkpoints = {}
+    for tb_code in ('193', '195'):
+        source = converter_state / f'input_{tb_code}.xlsx'
+        source.write_bytes(b'workbook')
+        make_converter(tb_code).save_checkpoint(str(source))
+        checkpoints[tb_code] = Converter.load_checkpoint(str(source))
+    Converter.restore_checkpoint(checkpoints['193'])
+    make_converter('194').save_df_dict()
+    Converter.restore_checkpoint(checkpoints['195'])
+    assert list(Converter.out_df_dict['001']) == ['193', '194', '195']
+
+
+def test_merged_mdt_is_typed(converter_state):
+    for tb_code, cv_col, sd_value in (('193', '[cv1_cc_id]', None), ('195', '[cv2_cc_id]', 7)):
+        converter = make_converter(tb_code)
+        mdt_df = pd.DataFrame.from_records([{
+            '[mdt_id]': int(tb_code), '[theme_id]': 1, '[sv_id]': 2, '[sp_id]': 3, '[obs_value]': 1.5,
+            '[sd_value]': sd_value, cv_col: 4
+        }], index='[mdt_id]')
+        converter.df_dict['MDT'] = Converter.compact_mdt_df(mdt_df)
+        converter.save_df_dict()
+    Converter.merge_df()
+    mdt_df = Converter.theme_df_dict['001']['MDT']
+    assert list(mdt_df.index) == [193, 195]
+    assert str(mdt_df['[cv1_cc_id]'].dtype) == str(mdt_df['[cv2_cc_id]'].dtype) == 'Int32'
+    assert isinstance(mdt_df['[cv3_cc_id]'].dtype, pd.SparseDtype)
+    assert str(mdt_df['[sd_value]'].dtype) == 'Int16'
+
+
+def store_tables(converter_state, tb_codes):
+    """process tb_codes in a run of their own, each from an input file"""
+    Converter.out_df_dict.clear()
+    for tb_code in tb_codes:
+        source = converter_state / f'input_{tb_code}.xlsx'
+        source.write_bytes(b'workbook')
+        converter = make_converter(tb_code)
+        converter.path = str(source)
+        converter.save_df_dict()
+    Converter.merge_df()
+    return list(Converter.theme_df_dict['001']['TB_INFO'].index)
+
+
+def test_stored_tables_are_pruned(converter_state, monkeypatch):
+    assert store_tables(converter_state, ['193', '194', '195']) == [193, 194, 195]
+    (converter_state / 'input_194.xlsx').unlink()
+    monkeypatch.setattr(Converter, 'select_tb_ids', staticmethod(lambda tb_ids: set(tb_ids) - {195}))
+    assert store_tables(converter_state, ['196']) == [193, 196]
+    assert ThemeStore('001').tb_ids() == [193, 196]
+
+
+def test_stored_tables_are_kept_per_db(converter_state, monkeypatch):
+    store_tables(converter_state, ['193'])
+    monkeypatch.setattr('classes.db_address._loaded', {'insert': '[other].[dbo]'})
+    assert store_tables(converter_state, ['194']) == [194]
+
+
+def test_merge_only_this_run(converter_state, monkeypatch):
+    store_tables(converter_state, ['193'])
+    monkeypatch.setattr(Converter, 'merge_stored', False)
+    assert store_tables(converter_state, ['194', '195']) == [194, 195]
+    # the tables of previous runs are still stored
+    assert ThemeStore('001').tb_ids() == [193, 194, 195]
@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from classes import SD, Connection, Dict, Fas, FileCache, Footnote, db_address, map_chunks
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        self.conn.sql.append(sql)
+
+    def fetchall(self):
+        return self.conn.results.pop(0)
+
+
+class FakeConnection:
+    def __init__(self, results):
+        self.results = list(results)
+        self.sql = []
+
+    def cursor(self, as_dict=False):
+        return FakeCursor(self)
+
+
+@pytest.fixture
+def fake_conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(FileCache, 'folder', str(tmp_path / 'cache'))
+    monkeypatch.setattr(db_address, '_loaded', {'reference': '[ref].[dbo]'})
+    monkeypatch.setattr(Footnote.unused_note_dict, '_loaded', {})
+
+    def connect(results):
+        conn = FakeConnection(results)
+        monkeypatch.setattr(Connection._local, 'conn', conn, raising=False)
+        return conn
+    yield connect
+    Connection._local.conn = None
+
+
+def make_fas(values):
+    """a Fas of one MDT column without DB, '#' is a known SD symbol and 'x' a footnote not in SD yet"""
+    fas = Fas.__new__(Fas)
+    Dict.__init__(fas)
+    fas.tb_code = '193'
+    fas['MDT'] = {'value': {}}
+    fas.sd = SD.__new__(SD)
+    Dict.__init__(fas.sd)
+    fas.sd.pending = {}
+    fas.sd.update({'#': 6})
+    fas.footnote = Footnote.__new__(Footnote)
+    Dict.__init__(fas.footnote)
+    fas.footnote.update({'x': {'NOTE_ENG': 'not available', 'NOTE_CHI': '不適用'}})
+    fas.df = pd.DataFrame({'value': values, 'year': ['2019'] * len(values)})
+    return fas
+
+
+def test_parse_mdt_values():
+    fas = make_fas(['1 234', '5.5', '#', 'x', np.nan, '-1,000'])
+    value_df, symbol_df = fas.parse_mdt_values()
+    assert list(value_df.columns) == ['value']
+    assert symbol_df['value'].to_list() == [False, False, True, True, False, False]
+    # symbols are 0, an empty value stays NaN
+    obs = fas.obs_df['value'].to_list()
+    assert obs[:4] + obs[5:] == [1234.0, 5.5, 0.0, 0.0, -1000.0]
+    assert np.isnan(obs[4])
+    # only the new symbol is collected for insert_sd
+    assert list(fas.sd.pending) == ['x']
+    assert fas.sd.pending['x']['[sd_desc_eng]'] == 'not available'
+
+
+def test_map_sd_values():
+    fas = make_fas(['1', '#', 'x', '2'])
+    fas['MDT']['value'] = {'2': 7}
+    fas.map_sd_values(*fas.parse_mdt_values())
+    # '#' is in SD, 'x' has a provisional sd_value until it is inserted, '2' has the sd_value of its MDT footnote
+    assert fas.sd_df['value'].to_list() == [0, 6, -1, 7]
+
+
+def age_fas():
+    fas = Fas('193', {})
+    fas['CV'] = {'age': {"men's": {}, '男': {}}}
+    fas.load_columns()
+    return fas
+
+
+def test_fas_filter_sends_unicode_literals(fake_conn):
+    conn = fake_conn([[{'rows': 1, 'checksum': 5}], [{'age': '男', 'age_footnote': ''}]])
+    fas = age_fas()
+    fas.load_fas_df()
+    sql = conn.sql[1]
+    assert sql.startswith("WITH [fas_desc] ([desc]) AS (SELECT [desc] FROM (VALUES (N'men''s'), (N'男')) AS [V] ")
+    assert "FROM [ref].[dbo].[TABLE193] WHERE ([age] IS NULL OR [age] = '' " in sql
+    assert fas.df['age'].to_list() == ['男']
+
+
+def test_fas_snapshot_is_used_until_the_probe_changes(fake_conn):
+    rows = [{'age': '男', 'age_footnote': ''}]
+    conn = fake_conn([[{'rows': 1, 'checksum': 5}], rows, [{'rows': 1, 'checksum': 5}]])
+    age_fas().load_fas_df()
+    fas = age_fas()
+    fas.load_fas_df()
+    # only the probe is sent when TABLE193 is unchanged
+    assert len(conn.sql) == 3 and conn.sql[2].startswith('SELECT COUNT_BIG(*) [rows]')
+    assert fas.df['age'].to_list() == ['男']
+    conn = fake_conn([[{'rows': 2, 'checksum': 5}], rows + [{'age': "men's", 'age_footnote': 'a'}]])
+    fas = age_fas()
+    fas.load_fas_df()
+    # a changed probe reads the table again and replaces the snapshot
+    assert len(conn.sql) == 2 and conn.sql[1].startswith('WITH [fas_desc]')
+    assert fas.df['age'].to_list() == ['男', "men's"]
+    conn = fake_conn([[{'rows': 2, 'checksum': 5}]])
+    age_fas().load_fas_df()
+    assert len(conn.sql) == 1
+
+
+def chunk_pid(owner, chunk):
+    return os.getpid()
+
+
+def map_pids(chunks):
+    return os.getpid(), map_chunks(chunk_pid, None, chunks, 4)
+
+
+def test_chunks_are_not_mapped_in_a_nested_pool():
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        pid, chunk_pids = executor.submit(map_pids, [1, 2, 3]).result()
+    # the process of the outer pool runs all of its chunks itself
+    assert chunk_pids == [pid] * 3
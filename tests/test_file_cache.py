@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from classes import FileCache, ReferenceCache, atomic_write
+
+
+@pytest.fixture
+def cache_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(FileCache, 'folder', str(tmp_path / 'cache'))
+    return tmp_path
+
+
+def test_round_trip(cache_folder):
+    source = cache_folder / 'input.xlsx'
+    source.write_bytes(b'workbook')
+    cache = FileCache('input')
+    assert cache.load(str(source)) is None
+    cache.save(str(source), {'rows': [1, 2]})
+    assert cache.load(str(source)) == {'rows': [1, 2]}
+
+
+def test_changed_source_is_not_used(cache_folder):
+    source = cache_folder / 'input.xlsx'
+    source.write_bytes(b'workbook')
+    cache = FileCache('input')
+    cache.save(str(source), 'old')
+    source.write_bytes(b'changed workbook')
+    assert cache.load(str(source)) is None
+
+
+def test_partial_cache_is_not_used(cache_folder):
+    source = cache_folder / 'input.xlsx'
+    source.write_bytes(b'workbook')
+    cache = FileCache('input')
+    cache.save(str(source), 'result')
+    with open(cache.get_path(str(source)), 'r+b') as f:
+        f.truncate(5)
+    assert cache.load(str(source)) is None
+
+
+def test_reference_cache_by_name(cache_folder):
+    cache = ReferenceCache('reference')
+    cache.save('SD', {'#': 6})
+    assert cache.load('SD') == {'#': 6}
+    assert cache.load('TB_FOOTNOTE_193') is None
+    assert os.path.exists(os.path.join(FileCache.folder, 'reference', 'SD.pickle'))
+
+
+def test_atomic_write_keeps_the_old_file_on_failure(tmp_path):
+    path = str(tmp_path / 'output' / 'status.json')
+    with atomic_write(path) as temp_path, open(temp_path, 'w') as f:
+        assert temp_path.endswith('.tmp.json')
+        f.write('old')
+    with pytest.raises(ValueError):
+        with atomic_write(path) as temp_path, open(temp_path, 'w') as f:
+            f.write('partial')
+            raise ValueError
+    assert os.listdir(tmp_path / 'output') == ['status.json']
+    with open(path) as f:
+        assert f.read() == 'old'
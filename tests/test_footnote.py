@@ -0,0 +1,27 @@
+import pandas as pd
+
+from classes import Footnote
+
+
+def footnotes(rows):
+    return pd.DataFrame(rows, columns=['TABLE_ID', 'NOTE_NO', 'NOTE_TYPE'])
+
+
+def test_filter_footnotes_drops_second_and_third_of_triplet():
+    df = footnotes([
+        ('193', 1, 1), ('193', 2, 2), ('193', 3, 3),
+        ('193', 4, 1), ('193', 5, 0), ('193', 6, 2), ('193', 7, 3),
+        ('193', 8, 2)
+    ])
+    # NOTE_TYPE 0 is skipped when looking for the next rows of a triplet, but it is kept
+    assert Footnote.filter_footnotes(df)['NOTE_NO'].to_list() == [1, 4, 5, 8]
+
+
+def test_filter_footnotes_triplet_does_not_cross_tables():
+    df = footnotes([('193', 1, 1), ('193', 2, 2), ('194', 1, 3), ('194', 2, 1), ('194', 3, 2)])
+    assert Footnote.filter_footnotes(df).equals(df)
+
+
+def test_filter_footnotes_keeps_index():
+    df = footnotes([('193', 1, 3), ('193', 2, 1), ('193', 3, 2), ('193', 4, 3)])
+    assert Footnote.filter_footnotes(df).index.to_list() == [0, 1]
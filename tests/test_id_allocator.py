@@ -0,0 +1,186 @@
+import threading
+
+import pymssql
+import pytest
+
+from classes import Connection, Converter, IdAllocator, db_address
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        self.conn.sql.append(sql)
+        if self.conn.error:
+            raise self.conn.error
+
+    def fetchall(self):
+        result = self.conn.results.pop(0)
+        return result if isinstance(result, list) else [(result,)]
+
+
+class FakeConnection:
+    def __init__(self, results=(), error=None):
+        self.results = list(results)
+        self.error = error
+        self.sql = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self, as_dict=False):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.error = None
+
+
+@pytest.fixture
+def fake_conn(monkeypatch):
+    monkeypatch.setattr(db_address, '_loaded', {'insert': '[db].[dbo]'})
+    monkeypatch.setattr(IdAllocator, 'block_size', 3)
+
+    def connect(results=(), error=None):
+        conn = FakeConnection(results, error)
+        monkeypatch.setattr(Connection._local, 'conn', conn, raising=False)
+        return conn
+    yield connect
+    Connection._local.conn = None
+
+
+def test_blocks_extend_when_contiguous(fake_conn):
+    fake_conn(results=[4, 7, 20])
+    allocator = IdAllocator()
+    allocator.reserve('[T]', '[id]')
+    assert allocator.blocks['[T]'] == [1, 4]
+    allocator.reserve('[T]', '[id]')
+    assert allocator.blocks['[T]'] == [1, 7]
+    # another loader reserved in between, the unused ids are dropped
+    allocator.reserve('[T]', '[id]')
+    assert allocator.blocks['[T]'] == [17, 20]
+
+
+def test_take_ids_reserves_when_used_up(fake_conn):
+    conn = fake_conn(results=[4, 10])
+    allocator = IdAllocator()
+    assert [allocator.take_ids('[T]', '[id]', 1) for _ in range(5)] == [1, 2, 3, 7, 8]
+    assert conn.commits == 2
+
+
+def test_take_ids_is_unique_across_threads(fake_conn):
+    allocator = IdAllocator()
+    end = iter(range(3, 10000, 3))
+    ids = []
+
+    def reserve(addr, col, count=0):
+        with allocator.lock:
+            allocator.blocks[addr] = [next(end) - 3, allocator.blocks.get(addr, [0, 0])[1] + 3]
+
+    allocator.reserve = reserve
+
+    def take():
+        ids.extend(allocator.take_ids('[T]', '[id]', 1) for _ in range(200))
+    threads = [threading.Thread(target=take) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 800
+
+
+def test_reserve_resets_options_and_does_not_lock_the_table(fake_conn):
+    conn = fake_conn(results=[4])
+    IdAllocator().reserve('[db].[dbo].[T]', '[id]')
+    sql = conn.sql[0]
+    assert 'CREATE TABLE' not in sql
+    assert 'FROM [db].[dbo].[T]);' in sql
+    assert sql.count('SET XACT_ABORT OFF; SET NOCOUNT OFF;') == 2
+    assert sql.endswith('SELECT @end')
+
+
+def test_missing_id_block_exits(fake_conn):
+    conn = fake_conn(error=pymssql.ProgrammingError(208, b"Invalid object name 'ID_BLOCK'"))
+    with pytest.raises(SystemExit):
+        IdAllocator().reserve('[T]', '[id]')
+    assert conn.rollbacks == 1
+    assert conn.sql[-1] == 'SET XACT_ABORT OFF; SET NOCOUNT OFF'
+
+
+def test_identity_insert_is_always_switched_off(fake_conn, monkeypatch):
+    allocator = IdAllocator()
+    allocator.identity['[db].[dbo].[CC]'] = True
+    allocator.blocks['[db].[dbo].[CC]'] = [11, 20]
+    monkeypatch.setattr(Converter, 'id_allocator', allocator)
+    conn = fake_conn(results=[[{'seq': 0, 'id': 11, 'new': True}]])
+    rows = [{'[cv_id]': 1, '[class_code]': 'A'}]
+    Converter('001', '193').merge_rows('CC', '[cc_id]', rows, ['[cv_id]', '[class_code]'])
+    assert 'SET IDENTITY_INSERT [db].[dbo].[CC] ON; BEGIN TRY INSERT INTO [db].[dbo].[CC] ([cc_id]' in conn.sql[0]
+    assert 'BEGIN CATCH SET IDENTITY_INSERT [db].[dbo].[CC] OFF; THROW; END CATCH; ' \
+        'SET IDENTITY_INSERT [db].[dbo].[CC] OFF;' in conn.sql[0]
+
+
+def test_take_ids_is_contiguous_and_unused_ids_are_returned(fake_conn):
+    fake_conn(results=[10])
+    allocator = IdAllocator()
+    # a block of at least 7 ids is reserved at once
+    assert allocator.take_ids('[T]', '[id]', 7) == 3
+    allocator.return_ids('[T]', 3, 7, 2)
+    assert allocator.blocks['[T]'] == [5, 10]
+    assert allocator.take_ids('[T]', '[id]', 2) == 5
+    # ids taken after the returned ones are kept
+    allocator.return_ids('[T]', 3, 2, 0)
+    assert allocator.blocks['[T]'] == [7, 10]
+
+
+def test_merge_rows_writes_a_batch_per_statement(fake_conn, monkeypatch):
+    allocator = IdAllocator()
+    allocator.identity['[db].[dbo].[CC]'] = False
+    allocator.blocks['[db].[dbo].[CC]'] = [11, 20]
+    monkeypatch.setattr(Converter, 'id_allocator', allocator)
+    monkeypatch.setattr(Converter, 'merge_batch_rows', 2)
+    conn = fake_conn(results=[
+        [{'seq': 0, 'id': 11, 'new': True}, {'seq': 1, 'id': 5, 'new': False}],
+        [{'seq': 0, 'id': 12, 'new': True}]
+    ])
+    rows = [
+        {'[cv_id]': 1, '[class_code]': 'A', '[def_class_code_desc_en]': "it's"},
+        {'[cv_id]': 1, '[class_code]': 'B', '[def_class_code_desc_en]': None},
+        {'[cv_id]': 1, '[class_code]': 'A', '[def_class_code_desc_en]': 'again'},
+        {'[cv_id]': 1, '[class_code]': 'C', '[def_class_code_desc_en]': 'c'}
+    ]
+    ids = Converter('001', '193').merge_rows('CC', '[cc_id]', rows, ['[cv_id]', '[class_code]'])
+    # a repeated key gets the id of its first row
+    assert ids == [11, 5, 11, 12]
+    assert len(conn.sql) == 2
+    assert "VALUES (0, '1', 'A', 'it''s'), (1, '1', 'B', NULL);" in conn.sql[0]
+    assert '10 + ROW_NUMBER()' in conn.sql[0]
+    assert 'WITH (UPDLOCK, HOLDLOCK) WHERE [T].[cv_id] = [V].[cv_id] AND [T].[class_code] = [V].[class_code]' \
+        in conn.sql[0]
+    # one id is used by the first batch, the second one is given back
+    assert '11 + ROW_NUMBER()' in conn.sql[1]
+    assert allocator.blocks['[db].[dbo].[CC]'] == [13, 20]
+    assert conn.commits == 2
+
+
+def test_close_all_closes_the_connections_of_all_threads(monkeypatch):
+    closed = []
+
+    class Closing(FakeConnection):
+        def close(self):
+            closed.append(self)
+    monkeypatch.setattr('classes.pymssql.connect', lambda **kwargs: Closing())
+    monkeypatch.setattr('classes.db_config._loaded', {})
+    thread = threading.Thread(target=lambda: Connection()._conn)
+    thread.start()
+    thread.join()
+    conn = Connection()._conn
+    Connection.close_all()
+    assert len(closed) == 2 and conn in closed
+    assert Connection.connections == []
+    # a new connection is opened on the next use
+    assert Connection()._conn is not conn
+    Connection.close_all()
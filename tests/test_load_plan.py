@@ -0,0 +1,45 @@
+from classes import LoadPlan, Ref, Theme
+
+
+def all_ids(plan):
+    """an id for every row of plan"""
+    return {
+        ref: i
+        for i, ref in enumerate((ref for table_name in LoadPlan.table_names for ref in plan.get_refs(table_name)), 1)
+    }
+
+
+def test_rows_are_keyed_by_natural_key(plan):
+    theme_ref = Ref('THEME', ('001',))
+    cv_ref = Ref('CV', ('AGE', theme_ref))
+    assert plan.theme_ref == theme_ref and plan.cv_refs == {'AGE': cv_ref}
+    assert list(plan.rows['CC']) == [(cv_ref, 'A1'), (cv_ref, 'A2')]
+    assert plan.rows['CC_TB'][Ref('CC', (cv_ref, 'A1')), Ref('TB_INFO', ('193',))]['[fn1_en]'] == 'note'
+    assert len(plan.rows['CCG']) == 2 and len(plan.rows['PAC']) == 1
+    # SV and SP used, then CCG used
+    assert [len(key) for key in plan.rows['TB_COMP']] == [3, 2, 2]
+
+
+def test_rows_are_resolved_with_the_ids(plan):
+    ids = all_ids(plan)
+    pac = plan.resolve('PAC', ids)[0]
+    assert pac['[parent_cc_id]'] == ids[plan.cc_refs['AGE', 'A1']]
+    assert pac['[child_cc_id]'] == ids[plan.cc_refs['AGE', 'A2']]
+    theme = Theme('001')
+    theme[ids[plan.cv_refs['AGE']]] = 'cv3_id'
+    mdt_rows = plan.get_mdt_rows(ids, theme, plan.get_sd_values({'#': 61}))
+    assert mdt_rows[0] == {
+        '[theme_id]': ids[plan.theme_ref], '[sv_id]': ids[plan.sv_refs['SP1', 'SV1']],
+        '[sp_id]': ids[plan.sp_refs['SP1']], '[obs_value]': 5.0, '[sd_value]': 61,
+        '[cv3_cc_id]': ids[plan.cc_refs['AGE', 'A2']]
+    }
+    assert mdt_rows[1]['[sd_value]'] == 0
+
+
+def test_plan_round_trip(plan):
+    loaded = LoadPlan.load(plan.save())
+    assert loaded.rows == plan.rows
+    assert loaded.mdt_keys == plan.mdt_keys
+    assert loaded.sd_pending == plan.sd_pending and loaded.sd is None
+    assert loaded.is_current()
+    assert all_ids(loaded) == all_ids(plan)
@@ -0,0 +1,80 @@
+import threading
+
+import pandas as pd
+import pytest
+
+import main
+from classes import SD, Converter, LoadPlan, Theme
+
+
+@pytest.mark.parametrize('argv', [
+    ['--apply', 'plan', '--validate'],
+    ['--check-export', 'bulk', '--plan'],
+    ['--check-export', 'bulk', '--export'],
+])
+def test_input_files_are_required(argv, monkeypatch, capsys):
+    monkeypatch.setattr(main, 'list_input_files', lambda folder_name: pytest.fail('the current folder is listed'))
+    monkeypatch.setattr(main.sys, 'argv', ['main.py'] + argv)
+    with pytest.raises(SystemExit) as exit_info:
+        main.main()
+    assert exit_info.value.code == 2
+    assert 'need' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('argv, cached', [([], False), (['--cached-reference'], True)])
+def test_reference_cache_is_opt_in(argv, cached, monkeypatch):
+    planned = []
+
+    class Plan:
+        def save(self):
+            return 'plan\\input_193.pickle'
+
+    def plan_table(path, cached=False):
+        planned.append((path, cached))
+        return Plan()
+    monkeypatch.setattr(main, 'plan_table', plan_table)
+    monkeypatch.setattr(main.sys, 'argv', ['main.py', '--plan', '--file', 'input_193.csv', '--workers', '0'] + argv)
+    main.main()
+    assert planned == [('input_193.csv', cached)]
+
+
+def test_cv_ids_are_set_after_the_cv_level_and_before_mdt(plan, monkeypatch):
+    calls = []
+    lock = threading.Lock()
+
+    def apply_rows(converter, plan, table_name, ids):
+        rows = plan.resolve(table_name, ids)
+        id_col = LoadPlan.id_cols.get(table_name)
+        with lock:
+            calls.append(table_name)
+            if id_col:
+                for ref, row in zip(plan.get_refs(table_name), rows):
+                    ids[ref] = row[id_col] = len(ids) + 1
+        return rows
+
+    def insert_cv_ids(theme, cv_ids):
+        calls.append('insert_cv_ids')
+        for pos, cv_id in enumerate(cv_ids, 1):
+            theme[cv_id] = f'cv{pos}_id'
+
+    def merge_rows(converter, table_name, get_field, rows, key_cols=None):
+        calls.append(table_name)
+        return list(range(1, len(rows) + 1))
+    monkeypatch.setattr(main, 'apply_rows', apply_rows)
+    monkeypatch.setattr(Theme, 'check_slots', lambda theme, cv_codes: calls.append('check_slots'))
+    monkeypatch.setattr(Theme, 'load_dict', lambda theme: None)
+    monkeypatch.setattr(Theme, 'insert_cv_ids', insert_cv_ids)
+    monkeypatch.setattr(Converter, 'merge_rows', merge_rows)
+    monkeypatch.setattr(Converter, 'save_df_dict', lambda converter: None)
+    monkeypatch.setattr(Converter, 'save_checkpoint', lambda converter, path: None)
+    sd = SD()
+    sd['#'] = 61
+    sd.df = pd.DataFrame()
+    converter = main.apply_plan(plan, sd)
+    # THEME is only updated once all CVs are written, and MDT refers to the cv?_cc_id columns of the slots
+    assert calls[0] == 'check_slots'
+    assert calls.index('CV') < calls.index('insert_cv_ids') < calls.index('MDT')
+    assert set(calls[:calls.index('insert_cv_ids')]) >= {'TB_INFO', 'THEME', 'CV', 'SP'}
+    assert calls[-1] == 'MDT'
+    assert converter.df_dict['THEME']['[cv1_id]'].notna().all()
+    assert converter.df_dict['MDT']['[cv1_cc_id]'].notna().all()
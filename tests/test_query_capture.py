@@ -0,0 +1,119 @@
+import time
+
+import pymssql
+import pytest
+
+import main
+from classes import Connection, Fas, FileCache, QueryCapture, ThemeStore
+
+
+class FakeCursor:
+    def __init__(self, conn, as_dict):
+        self.conn = conn
+        self.as_dict = as_dict
+        self.description = None
+
+    def execute(self, sql):
+        self.conn.sql.append(sql)
+        if 'missing' in sql:
+            raise pymssql.ProgrammingError(208, b"Invalid object name 'missing'")
+        self.description = [('n',)]
+        self.rows = [{'n': len(self.conn.sql)}] if self.as_dict else [(len(self.conn.sql),)]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self):
+        self.sql = []
+        self.commits = 0
+
+    def cursor(self, as_dict=False):
+        return FakeCursor(self, as_dict)
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def capture(tmp_path, monkeypatch):
+    server = FakeConnection()
+    monkeypatch.setattr('classes.pymssql.connect', lambda **kwargs: server)
+    monkeypatch.setattr('classes.db_config._loaded', {})
+
+    def start(replay=False, latency=0.0):
+        Connection.close_all()
+        monkeypatch.setattr(Connection, 'capture', QueryCapture(str(tmp_path / 'run.capture'), replay, latency))
+        return Connection.capture
+    yield start, server
+    Connection.close_all()
+
+
+def run_queries():
+    conn = Connection()
+    results = [conn.select_sql('n', '[T]'), conn.select_sql('n', '[T]'), conn.select_sql('n', '[U]', get_df=True)]
+    conn._conn.commit()
+    with pytest.raises(pymssql.ProgrammingError):
+        conn.select_sql('n', '[missing]')
+    return results
+
+
+def test_replay_serves_the_recorded_results_without_db(capture):
+    start, server = capture
+    recording = start()
+    recorded = run_queries()
+    recording.save()
+    assert len(server.sql) == 4 and server.commits == 1
+    replaying = start(replay=True)
+    replayed = run_queries()
+    # nothing reaches the server
+    assert len(server.sql) == 4 and server.commits == 1
+    assert replayed[:2] == recorded[:2] == [1, 2]
+    assert replayed[2].equals(recorded[2])
+    assert replaying.round_trips == recording.round_trips == 5
+
+
+def test_replay_latency_is_added_to_every_round_trip(capture):
+    start, _ = capture
+    start()
+    run_queries()
+    Connection.capture.save()
+    replaying = start(replay=True, latency=0.01)
+    started = time.perf_counter()
+    run_queries()
+    assert time.perf_counter() - started >= 5 * 0.01
+    assert replaying.db_time >= 5 * 0.01
+
+
+def test_query_missing_from_capture_exits(capture):
+    start, _ = capture
+    start()
+    Connection.capture.save()
+    start(replay=True)
+    with pytest.raises(SystemExit):
+        Connection().select_sql('n', '[T]')
+
+
+def test_capture_disables_the_caches_of_reference_data(tmp_path, monkeypatch):
+    monkeypatch.setattr(FileCache, 'folder', str(tmp_path / 'cache'))
+    monkeypatch.setattr(main.atexit, 'register', lambda func: None)
+    monkeypatch.setattr(Connection, 'capture', None)
+    monkeypatch.setattr('classes.db_config._loaded', {})
+    monkeypatch.setattr('classes.db_address._loaded', {'insert': '[db].[dbo]'})
+    Fas.reference_cache.save('TABLE193_snapshot', 'snapshot')
+    try:
+        main.start_capture(str(tmp_path / 'run.capture'), False, 0)
+        # a snapshot taken before would skip the query of the FAS table
+        assert Fas.reference_cache.load('TABLE193_snapshot') is None
+        Fas.reference_cache.save('TABLE194_snapshot', 'snapshot')
+        assert not (tmp_path / 'cache' / 'reference' / 'TABLE194_snapshot.pickle').exists()
+        # the theme workbooks are still merged from the stored tables
+        assert ThemeStore('001').cache.enabled
+    finally:
+        for cache in (main.Table.input_cache, main.Converter.checkpoint_cache, main.Translator.reference_cache,
+                      Fas.reference_cache, main.SD.reference_cache, main.Footnote.reference_cache):
+            cache.enabled = True
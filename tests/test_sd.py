@@ -0,0 +1,69 @@
+import pandas as pd
+import pytest
+
+from classes import SD, Connection, db_address
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        self.conn.sql.append(sql)
+
+    def fetchall(self):
+        return self.conn.results.pop(0)
+
+
+class FakeConnection:
+    def __init__(self, results):
+        self.results = list(results)
+        self.sql = []
+        self.commits = 0
+
+    def cursor(self, as_dict=False):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+@pytest.fixture
+def fake_conn(monkeypatch):
+    monkeypatch.setattr(db_address, '_loaded', {'insert': '[db].[dbo]'})
+
+    def connect(results):
+        conn = FakeConnection(results)
+        monkeypatch.setattr(Connection._local, 'conn', conn, raising=False)
+        return conn
+    yield connect
+    Connection._local.conn = None
+
+
+def test_insert_sd_allocates_below_90_under_lock(fake_conn):
+    conn = fake_conn([[
+        {'sd_value': 7, 'sd_symbol': 'x', 'sd_desc_eng': 'n.a.', 'sd_desc_chi': '不適用', 'sd_suppressed': None},
+        {'sd_value': 8, 'sd_symbol': 'y', 'sd_desc_eng': "it's", 'sd_desc_chi': None, 'sd_suppressed': None}
+    ]])
+    sd = SD()
+    sd.df = pd.DataFrame([[6, '#', 'provisional', '臨時', None]], columns=SD.df_cols)
+    sd.update({'#': 6})
+    sd.add_sd('x', 'n.a.', '不適用')
+    sd.add_sd('#', 'provisional', '臨時')
+    sd.add_sd('y', "it's", None)
+    assert sd.get_values() == {'#': 6, 'x': -1, 'y': -2}
+    sd.insert_sd()
+    assert len(conn.sql) == 1 and conn.commits == 1
+    sql = conn.sql[0]
+    # the next sd_value is read and used in one transaction, SD rows from 90 are not allocated from
+    assert ('DECLARE @sd_value INT = (SELECT ISNULL(MAX([sd_value]), 0) FROM [db].[dbo].[SD] WITH (UPDLOCK, HOLDLOCK) '
+            'WHERE [sd_value] < 90); ') in sql
+    assert "(VALUES (1, 'x', 'n.a.', '不適用'), (2, 'y', 'it''s', NULL))" in sql
+    assert 'WHERE NOT EXISTS (SELECT 1 FROM [db].[dbo].[SD] WHERE [sd_symbol] = [V].[sd_symbol])' in sql
+    assert "WHERE [sd_symbol] IN ('x', 'y')" in sql
+    assert sd.get_values() == {'#': 6, 'x': 7, 'y': 8}
+    assert sd.pending == {}
+    assert sd.df['sd_symbol'].to_list() == ['#', 'x', 'y']
+    # nothing is sent without new symbols
+    sd.insert_sd()
+    assert len(conn.sql) == 1
@@ -0,0 +1,71 @@
+import pandas as pd
+import pytest
+
+from classes import FileCache, Table
+
+
+@pytest.fixture
+def cache_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(FileCache, 'folder', str(tmp_path / 'cache'))
+    return tmp_path
+
+
+def write_input(path):
+    path.write_text(
+        'Table,7,Title,標題\n'
+        'Theme,1,,\n'
+        'Field,Common Data Model Code,FAS field name,CC Description\n'
+        'CV,CCYY_F,year,2019\n',
+        encoding='utf-8'
+    )
+    return str(path)
+
+
+def test_read_code_only_reads_config_block(cache_folder, capsys):
+    path = write_input(cache_folder / 'input.csv')
+    assert Table.read_code(path) == '007'
+    # the file is not loaded and not cached by reading its code
+    assert 'will be loaded' not in capsys.readouterr().out
+    assert Table.input_cache.load(path) is None
+
+
+def test_read_code_matches_parsed_table(cache_folder):
+    path = write_input(cache_folder / 'input.csv')
+    table = Table()
+    table.load_csv(path)
+    table.parse_config_df()
+    # read from the cached config block after load_csv
+    assert Table.read_code(path) == table.code == '007'
+
+
+@pytest.mark.parametrize('expr, value', [('2019', 2019), ('2019-1', 2018), (' 2019 + 2 ', 2021), ('-(1-2019)', 2018)])
+def test_eval_period(expr, value):
+    assert Table.eval_period(expr) == value
+
+
+@pytest.mark.parametrize('expr', ['__import__("os")', 'YYYY', '2019 ** 2', '[2019]'])
+def test_eval_period_rejects_other_expressions(expr):
+    with pytest.raises((ValueError, SyntaxError)):
+        Table.eval_period(expr)
+
+
+def test_period_yyyy():
+    assert Table.period_yyyy('[YYYY-1]/[YYYY]', '2019') == '2018/2019'
+    assert Table.period_yyyy('Q1 YYYY', '2020') == 'Q1 2020'
+    assert Table.period_yyyy(None, '2020') is None
+
+
+def test_parse_cdm_df_expands_period_by_year():
+    table = Table()
+    table.cdm_df = pd.DataFrame({
+        'Field': ['CV'] * 4,
+        'Common Data Model Code': ['M3M'] * 4,
+        'FAS field name': ['year', 'year', 'period', 'period'],
+        'CC Code': ['2019', '2020', '1', '2'],
+        'CC Description': ['2019', '2020', 'Jan-Mar [YYYY]', 'Apr-Jun [YYYY-1]']
+    })
+    table.parse_cdm_df()
+    cv_df = table['CV']
+    assert cv_df['CC Description'].to_list() == [
+        '2019', '2020', 'Jan-Mar 2019', 'Apr-Jun 2018', 'Jan-Mar 2020', 'Apr-Jun 2019']
+    assert cv_df['CC Code'].to_list() == ['2019', '2020', '1', '2', '3', '4']
@@ -0,0 +1,98 @@
+import pymssql
+import pytest
+
+from classes import Connection, Theme, db_address
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        self.conn.sql.append(sql)
+        if sql.startswith('UPDATE') and self.conn.update_error:
+            raise pymssql.IntegrityError(2627, b'Violation of UNIQUE KEY constraint')
+
+    def fetchall(self):
+        return self.conn.results.pop(0)
+
+
+class FakeConnection:
+    def __init__(self, results, update_error=False):
+        self.results = list(results)
+        self.update_error = update_error
+        self.sql = []
+        self.commits = 0
+
+    def cursor(self, as_dict=False):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+@pytest.fixture
+def fake_conn(monkeypatch):
+    monkeypatch.setattr(db_address, '_loaded', {'insert': '[db].[dbo]'})
+    monkeypatch.setattr(Theme.theme_dict, '_loaded', {'001': {'THEME_DESC_ENG': 'Population'}})
+
+    def connect(results, update_error=False):
+        conn = FakeConnection(results, update_error)
+        monkeypatch.setattr(Connection._local, 'conn', conn, raising=False)
+        return conn
+    yield connect
+    Connection._local.conn = None
+
+
+def slot_row(cv_ids):
+    """THEME row of select_slots with cv_ids in the first slots"""
+    return [{col: cv_ids[i] if i < len(cv_ids) else None for i, col in enumerate(Theme.slot_cols)}]
+
+
+def test_check_slots_counts_the_used_slots(fake_conn, capsys):
+    used = [{'class_var': f'CV{i}'} for i in range(1, 19)] + [{'class_var': None}]
+    conn = fake_conn([used, used])
+    theme = Theme('001')
+    # CV1 has a slot already, one slot is free for AGE
+    theme.check_slots(['CV1', 'AGE', 'CV1'])
+    assert "WHERE [T].[theme] = '001' AND [S].[cv_id] IS NOT NULL" in conn.sql[0]
+    with pytest.raises(SystemExit):
+        theme.check_slots(['AGE', 'SEX'])
+    assert "['AGE', 'SEX'], 19 of 20 are used" in capsys.readouterr().out
+
+
+def test_check_slots_of_a_new_theme(fake_conn):
+    fake_conn([[]])
+    Theme('001').check_slots([f'CV{i}' for i in range(1, 21)])
+
+
+def test_insert_cv_ids_writes_all_slots_in_one_update(fake_conn):
+    conn = fake_conn([slot_row([5])])
+    theme = Theme('001')
+    theme.id = 3
+    theme.insert_cv_ids([5, 8, 9, 8])
+    assert conn.sql[1] == 'UPDATE [db].[dbo].[THEME] SET [cv2_id] = 8, [cv3_id] = 9 WHERE [theme_id] = 3'
+    assert dict(theme) == {5: 'cv1_id', 8: 'cv2_id', 9: 'cv3_id'}
+    # nothing is sent if all cv_ids have a slot
+    theme.insert_cv_ids([9, 5])
+    assert len(conn.sql) == 2
+
+
+def test_insert_cv_ids_exits_without_update_if_the_slots_are_full(fake_conn):
+    conn = fake_conn([slot_row(list(range(1, 20)))])
+    theme = Theme('001')
+    theme.id = 3
+    with pytest.raises(SystemExit):
+        theme.insert_cv_ids([30, 31])
+    # the lock of the THEME row is released and no slot is written
+    assert len(conn.sql) == 1 and conn.commits == 1
+    assert len(theme) == 0
+
+
+def test_insert_cv_ids_keeps_the_slots_if_the_update_fails(fake_conn):
+    fake_conn([slot_row([5])], update_error=True)
+    theme = Theme('001')
+    theme.id = 3
+    with pytest.raises(SystemExit):
+        theme.insert_cv_ids([8])
+    assert 8 not in theme
@@ -0,0 +1,56 @@
+import pytest
+
+from classes import Connection, FileCache, Translator, db_address
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        self.conn.sql.append(sql)
+
+    def fetchall(self):
+        return self.conn.results.pop(0)
+
+
+class FakeConnection:
+    def __init__(self, results):
+        self.results = list(results)
+        self.sql = []
+
+    def cursor(self, as_dict=False):
+        return FakeCursor(self)
+
+
+@pytest.fixture
+def fake_conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(FileCache, 'folder', str(tmp_path / 'cache'))
+    monkeypatch.setattr(db_address, '_loaded', {'reference': '[ref].[dbo]'})
+    monkeypatch.setattr(Translator, 'all_field_cache', {})
+    monkeypatch.setattr(Translator, 'queried_descs', set())
+
+    def connect(results):
+        conn = FakeConnection(results)
+        monkeypatch.setattr(Connection._local, 'conn', conn, raising=False)
+        return conn
+    yield connect
+    Connection._local.conn = None
+
+
+def test_descriptions_are_sent_as_unicode_literals(fake_conn):
+    conn = fake_conn([
+        [{'tb_code': '193', 'desc_eng': 'sex', 'desc_chi': '性別'}],
+        [{'desc_eng': "men's", 'desc_chi': '男'}]
+    ])
+    translator = Translator('193')
+    translator.load_data(["Men's", 'Age(years)'])
+    assert conn.sql[0].endswith("[ref].[dbo].[TB_FIELDLOOKUP] WHERE [table_id] = '193'")
+    assert ("WITH [descs] ([desc_eng]) AS (SELECT [desc_eng] FROM (VALUES "
+            "(N'age (years)'), (N'age(years)'), (N'men''s')) AS [V] ([desc_eng])), ") in conn.sql[1]
+    assert translator.translate("Men's") == '男'
+    assert translator.translate('Sex') == '(NOT IN FIELDLOOKUP)性別'
+    # the descriptions queried before are not sent again
+    conn = fake_conn([[]])
+    Translator('194').load_data(["men's"])
+    assert len(conn.sql) == 1
@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+import main
+from classes import Converter, Footnote, Table, Translator
+
+
+class StopWatching(Exception):
+    pass
+
+
+@pytest.fixture
+def watched(tmp_path, monkeypatch):
+    """a watched folder with one file, the outputs and the sleep between polls are replaced"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'watch').mkdir()
+    # list_input_files joins the folder and the file name with a backslash
+    for path in {os.path.join('watch', 'a.csv'), 'watch\\a.csv'}:
+        with open(path, 'w') as f:
+            f.write('a')
+    statuses = []
+    monkeypatch.setattr(main, 'write_status', lambda status: statuses.append(dict(status, tables=dict(
+        (name, dict(table)) for name, table in status['tables'].items()))))
+    monkeypatch.setattr(Table, 'read_code', staticmethod(lambda path: '193'))
+    monkeypatch.setattr(Footnote, 'prefetch', classmethod(lambda cls, tb_codes: None))
+    for name in ('write_excel_all', 'merge_df', 'convert_theme'):
+        monkeypatch.setattr(Converter, name, staticmethod(lambda *args: None))
+    return statuses
+
+
+def stop_after(polls):
+    calls = []
+
+    def sleep(interval):
+        calls.append(interval)
+        if len(calls) >= polls:
+            raise StopWatching
+    return sleep
+
+
+def test_failed_table_is_retried(watched, monkeypatch):
+    results = iter([ValueError('DB is busy'), Converter('001', '193')])
+
+    def process_table(path):
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    monkeypatch.setattr(main, 'process_table', process_table)
+    monkeypatch.setattr(main.time, 'sleep', stop_after(4))
+    with pytest.raises(StopWatching):
+        main.watch_folder('watch', 0)
+    tables = [status['tables']['watch\\a.csv'] for status in watched if 'watch\\a.csv' in status['tables']]
+    assert tables[0]['result'] == 'failed' and tables[0]['attempts'] == 1
+    assert tables[-1]['result'] == 'done' and tables[-1]['attempts'] == 0
+
+
+def test_reference_data_are_read_again_for_each_batch(watched, monkeypatch):
+    Translator.all_field_cache['stale'] = 'stale'
+    Footnote.prefetched_dict['193'] = 'stale'
+    monkeypatch.setattr(main, 'process_table', lambda path: Converter('001', '193'))
+    monkeypatch.setattr(main.time, 'sleep', stop_after(2))
+    with pytest.raises(StopWatching):
+        main.watch_folder('watch', 0)
+    assert 'stale' not in Translator.all_field_cache
+    assert '193' not in Footnote.prefetched_dict
+
+
+def test_config_error_stops_watching(watched, monkeypatch):
+    def process_table(path):
+        raise SystemExit(1)
+    monkeypatch.setattr(main, 'process_table', process_table)
+    monkeypatch.setattr(main.time, 'sleep', stop_after(4))
+    with pytest.raises(SystemExit):
+        main.watch_folder('watch', 0)
+
+
+def test_each_batch_only_merges_its_own_themes(watched, monkeypatch):
+    for name in ('out_df_dict', 'theme_df_dict', 'unstored_df_dict'):
+        monkeypatch.setattr(Converter, name, {})
+    themes = {'watch\\a.csv': '001', 'watch\\b.csv': '002'}
+
+    def process_table(path):
+        converter = Converter(themes[path], '193')
+        converter.save_df_dict()
+        return converter
+    merged = []
+    monkeypatch.setattr(main, 'process_table', process_table)
+    monkeypatch.setattr(Converter, 'merge_df', classmethod(lambda cls: merged.append(sorted(cls.out_df_dict))))
+    stop = stop_after(5)
+
+    def sleep(interval):
+        if len(merged) == 1 and not os.path.exists('watch\\b.csv'):
+            # a new file after the first batch
+            for path in {os.path.join('watch', 'b.csv'), 'watch\\b.csv'}:
+                with open(path, 'w') as f:
+                    f.write('b')
+        stop(interval)
+    monkeypatch.setattr(main.time, 'sleep', sleep)
+    with pytest.raises(StopWatching):
+        main.watch_folder('watch', 0)
+    assert merged == [['001'], ['002']]
+    assert Converter.out_df_dict == {} and Converter.unstored_df_dict == {}